@@ -0,0 +1,43 @@
+"""Benchmark adaptive timestepping against runs with a fixed timestep.
+
+Runs TaylorGreen2D with adaptive_timestep and then with a fixed timestep
+equal to the smallest and to the largest dt used by the adaptive run, and
+reports the number of timesteps, the total computing time and the final
+error of each run.
+
+    python benchmarks/adaptive_timestep.py [solver] [T] [N] [CFL]
+
+"""
+import re
+import subprocess
+import sys
+
+number = "([0-9]+.[0-9]+e[+-][0-9]+)"
+cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+       "T={} dt={} Nx={} Ny={} print_intermediate_info=100000 "
+       "adaptive_timestep='{{\"active\": {}, \"CFL\": {}}}'")
+
+
+def run(solver, T, N, CFL, dt, adaptive):
+    d = str(subprocess.check_output(cmd.format(solver, T, dt, N, N, adaptive, CFL),
+                                    shell=True))
+    wall = float(re.search("Total computing time = ([0-9]+.[0-9]+)", d).groups()[0])
+    err = re.search("Final Error: u0=" + number, d).groups()[0]
+    dts = re.search(r"dt in \[" + number + ", " + number, d)
+    steps = re.search("Adaptive timestepping: ([0-9]+) timesteps", d)
+    steps = int(steps.groups()[0]) if steps else int(round(T / dt))
+    return wall, float(err), steps, dts
+
+
+if __name__ == '__main__':
+    solver = sys.argv[1] if len(sys.argv) > 1 else "IPCS_ABCN"
+    T = float(sys.argv[2]) if len(sys.argv) > 2 else 1.
+    N = int(sys.argv[3]) if len(sys.argv) > 3 else 40
+    CFL = float(sys.argv[4]) if len(sys.argv) > 4 else 0.5
+    wall, err, steps, dts = run(solver, T, N, CFL, 0.001, True)
+    print("{0:24s} {1:>8s} {2:>12s} {3:>12s}".format("run", "steps", "time", "error u0"))
+    print("{0:24s} {1:8d} {2:12.4f} {3:12.4e}".format("adaptive", steps, wall, err))
+    for dt in sorted(set(float(x) for x in dts.groups())):
+        wall, err, steps, _ = run(solver, T, N, CFL, dt, False)
+        print("{0:24s} {1:8d} {2:12.4f} {3:12.4e}".format(
+            "fixed dt={:2.4e}".format(dt), steps, wall, err))
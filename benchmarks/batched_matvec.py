@@ -0,0 +1,58 @@
+"""Benchmark one sparse matrix-dense block product against separate matvecs.
+
+Computes z_j = y_j + A*x_j for j < k with k calls to MatMultAdd and with
+one call to matvec_add_multiple (MatMatMult), for the P1 and P2 mass
+matrices of a unit cube. Reports the time per product and the effective
+memory bandwidth, counting the bytes of A that must be read (once per
+vector for the separate matvecs).
+
+    python benchmarks/batched_matvec.py [N] [k] [repeats]
+
+"""
+import sys
+from time import perf_counter
+from dolfin import (UnitCubeMesh, FunctionSpace, TrialFunction, TestFunction,
+                    Vector, inner, dx, assemble, MPI)
+from oasis.common import matvec_add, matvec_add_multiple
+from oasis.problems import matrix_memory
+
+
+def run(mesh, degree, k, repeats):
+    V = FunctionSpace(mesh, 'CG', degree)
+    u, v = TrialFunction(V), TestFunction(V)
+    A = assemble(inner(u, v) * dx)
+    xs = [Vector() for j in range(k)]
+    for x in xs:
+        A.init_vector(x, 1)
+        x[:] = 1.
+    ys = [Vector(x) for x in xs]
+    zs = [Vector(x) for x in xs]
+
+    t0 = perf_counter()
+    for i in range(repeats):
+        for x, y, z in zip(xs, ys, zs):
+            matvec_add(A, x, y, z)
+    t_loop = (perf_counter() - t0) / repeats
+
+    matvec_add_multiple(A, xs, ys, zs)  # Allocate dense blocks
+    t0 = perf_counter()
+    for i in range(repeats):
+        matvec_add_multiple(A, xs, ys, zs)
+    t_batched = (perf_counter() - t0) / repeats
+
+    nbytes = MPI.sum(MPI.comm_world, float(matrix_memory(A)))
+    return t_loop, t_batched, nbytes
+
+
+if __name__ == '__main__':
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    mesh = UnitCubeMesh(N, N, N)
+    print("{0:6s} {1:>12s} {2:>12s} {3:>8s} {4:>14s} {5:>14s}".format(
+        "case", "separate", "batched", "speedup", "GB/s separate", "GB/s batched"))
+    for degree in (1, 2):
+        tl, tb, nbytes = run(mesh, degree, k, repeats)
+        print("{0:6s} {1:12.4e} {2:12.4e} {3:8.2f} {4:14.2f} {5:14.2f}".format(
+            "P{}".format(degree), tl, tb, tl / tb, k * nbytes / tl / 1e9,
+            nbytes / tb / 1e9))
@@ -0,0 +1,58 @@
+"""Benchmark assembly of the convection matrix.
+
+Compares assemble(a_conv, tensor=A) with ConvectionOperator.assemble(A)
+for P1 and P2 in 2D and 3D, and reports the time per assembly, the extra
+memory used by the precomputed data and the difference between the two
+matrices.
+
+    python benchmarks/convection_operator.py [N2D] [N3D] [repeats]
+
+"""
+import sys
+from time import perf_counter
+from dolfin import (UnitSquareMesh, UnitCubeMesh, FunctionSpace, Function,
+                    TrialFunction, TestFunction, Expression, as_vector, inner,
+                    dot, nabla_grad, dx, assemble, interpolate, Matrix, MPI)
+from oasis.common import ConvectionOperator
+
+
+def run(mesh, degree, repeats):
+    V = FunctionSpace(mesh, 'CG', degree)
+    u, v = TrialFunction(V), TestFunction(V)
+    dim = mesh.geometry().dim()
+    expr = ("sin(pi*x[1])", "cos(pi*x[0])", "x[0]*x[1]")
+    w = as_vector([interpolate(Expression(expr[i], degree=2), V) for i in range(dim)])
+    a_conv = inner(v, dot(w, nabla_grad(u))) * dx
+    A = assemble(a_conv)
+
+    t0 = perf_counter()
+    for i in range(repeats):
+        assemble(a_conv, tensor=A)
+    t_assemble = (perf_counter() - t0) / repeats
+
+    t0 = perf_counter()
+    convection = ConvectionOperator(V, w)
+    t_setup = perf_counter() - t0
+    B = Matrix(A)
+    t0 = perf_counter()
+    for i in range(repeats):
+        convection.assemble(B)
+    t_contract = (perf_counter() - t0) / repeats
+
+    B.axpy(-1., A, True)
+    error = B.norm('frobenius') / A.norm('frobenius')
+    memory = MPI.sum(MPI.comm_world, float(convection.memory())) / 1024**2
+    return t_assemble, t_setup, t_contract, memory, error
+
+
+if __name__ == '__main__':
+    N2 = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    N3 = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    print("{0:8s} {1:>12s} {2:>12s} {3:>12s} {4:>8s} {5:>12s} {6:>10s}".format(
+        "case", "assemble", "setup", "contract", "speedup", "memory (MB)", "rel. diff"))
+    for dim, mesh in ((2, UnitSquareMesh(N2, N2)), (3, UnitCubeMesh(N3, N3, N3))):
+        for degree in (1, 2):
+            ta, ts, tc, mem, err = run(mesh, degree, repeats)
+            print("{0:8s} {1:12.4e} {2:12.4e} {3:12.4e} {4:8.2f} {5:12.2f} {6:10.2e}".format(
+                "P{}-{}D".format(degree, dim), ta, ts, tc, ta / tc, mem, err))
@@ -0,0 +1,65 @@
+"""Benchmark the update of the dynamic Lagrangian LES models.
+
+Sets up DynamicLagrangian and ScaleDepDynamicLagrangian for a P1 velocity
+field on the unit square and the unit cube and reports the time per call
+of les_update, with Cs computed every call, for each strain_solver. The
+accuracy of each strain_solver is reported as the relative difference of
+nut_ from the default solver. Run on two versions of the code to compare
+the kernels.
+
+    python benchmarks/les_update.py [N2D] [N3D] [repeats]
+
+"""
+import sys
+from time import perf_counter
+from dolfin import (UnitSquareMesh, UnitCubeMesh, VectorFunctionSpace,
+                    Expression, interpolate, as_vector)
+from oasis.common import (assemble_matrix, CG1Function, as_symmetric_storage,
+                          Solver_cache, solve_multiple)
+from oasis.problems.NSfracStep import NS_parameters
+from oasis.solvers.NSfracStep.LES import (DynamicLagrangian,
+                                          ScaleDepDynamicLagrangian)
+
+
+def run(mesh, model, strain_solver, repeats):
+    dim = mesh.geometry().dim()
+    expr = ("sin(pi*x[0])*cos(pi*x[1])", "-cos(pi*x[0])*sin(pi*x[1])", "x[0]*x[1]")
+    V = VectorFunctionSpace(mesh, 'CG', 1)
+    u = interpolate(Expression(expr[:dim], degree=2), V)
+    u_ = as_vector([u.sub(i, deepcopy=True) for i in range(dim)])
+    namespace = dict(u_=u_, u_ab=u_, mesh=mesh, dt=0.01, tstep=0,
+                     V=u_[0].function_space(), bcs={'u0': []},
+                     krylov_solvers=NS_parameters['krylov_solvers'],
+                     nut_krylov_solver=NS_parameters['nut_krylov_solver'],
+                     DynamicSmagorinsky=dict(Cs_comp_step=1,
+                                             strain_solver=strain_solver),
+                     assemble_matrix=assemble_matrix, CG1Function=CG1Function,
+                     symmetric_storage=False,
+                     as_symmetric_storage=as_symmetric_storage,
+                     Solver_cache=Solver_cache, solve_multiple=solve_multiple)
+    namespace.update(model.les_setup(**namespace))
+    model.les_update(**namespace)
+    nut = namespace['nut_'].vector().copy()
+
+    t0 = perf_counter()
+    for i in range(repeats):
+        model.les_update(**namespace)
+    return (perf_counter() - t0) / repeats, nut
+
+
+if __name__ == '__main__':
+    N2 = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    N3 = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    print("{0:28s} {1:>8s} {2:>12s} {3:>10s}".format(
+        "case", "strain", "les_update", "rel. diff"))
+    for dim, mesh in ((2, UnitSquareMesh(N2, N2)), (3, UnitCubeMesh(N3, N3, N3))):
+        for model in (DynamicLagrangian, ScaleDepDynamicLagrangian):
+            case = "{}-{}D".format(model.__name__.split('.')[-1], dim)
+            for strain_solver in ("default", "cached", "lumping"):
+                t, nut = run(mesh, model, strain_solver, repeats)
+                if strain_solver == "default":
+                    nut0 = nut.copy()
+                nut.axpy(-1., nut0)
+                print("{0:28s} {1:>8s} {2:12.4e} {3:10.2e}".format(
+                    case, strain_solver, t, nut.norm('l2') / nut0.norm('l2')))
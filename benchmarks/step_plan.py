@@ -0,0 +1,35 @@
+"""Benchmark the per-timestep driver overhead with and without StepPlan.
+
+Runs IPCS_ABCN on TaylorGreen2D on a small mesh, where the Python overhead
+of the time loop is a noticeable part of each timestep, and compares the
+total computing time per timestep with use_step_plan=True/False.
+
+    python benchmarks/step_plan.py [num_steps] [N]
+
+"""
+import re
+import subprocess
+import sys
+
+number = "([0-9]+.[0-9]+)"
+cmd = ("mpirun -np 1 oasis NSfracStep solver=IPCS_ABCN problem=TaylorGreen2D "
+       "T={} dt={} Nx={} Ny={} compute_error=100000 print_intermediate_info=100000 "
+       "use_step_plan={}")
+
+
+def time_per_step(use_step_plan, num_steps, N, dt=0.001):
+    d = subprocess.check_output(cmd.format(num_steps * dt, dt, N, N, use_step_plan),
+                                shell=True)
+    match = re.search("Total computing time = " + number, str(d))
+    return float(match.groups()[0]) / num_steps
+
+
+if __name__ == '__main__':
+    num_steps = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    N = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    before = time_per_step(False, num_steps, N)
+    after = time_per_step(True, num_steps, N)
+    print("Time per step   **vars(): {0:2.4e} s".format(before))
+    print("Time per step  StepPlan: {0:2.4e} s".format(after))
+    print("Driver overhead removed: {0:2.4e} s/step ({1:2.1f}%)".format(
+        before - after, 100 * (before - after) / before))
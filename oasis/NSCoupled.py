@@ -201,6 +201,7 @@ if len(scalar_components) > 0:
 list_timings(TimingClear.keep, [TimingType.wall])
 info_red('Total computing time = {0:f}'.format(timer.elapsed()[0]))
 oasis_memory('Final memory use ')
+oasis_memory.reduce()
 total_initial_dolfin_memory = MPI.sum(MPI.comm_world, initial_memory_use)
 info_red('Memory use for importing dolfin = {} MB (RSS)'.format(
     total_initial_dolfin_memory))
@@ -46,7 +46,8 @@ if problemspec is None:
 if problemspec is None:
     raise RuntimeError(problemname+' not found')
 
-# Import the problem module
+# Import the problem module (creates the mesh)
+oasis_memory.begin_phase('mesh')
 print('Importing problem module '+problemname+':\n'+problemspec.origin)
 problemmod = importlib.util.module_from_spec(problemspec)
 problemspec.loader.exec_module(problemmod)
@@ -59,6 +60,17 @@ problem_parameters(**vars())
 # Update current namespace with NS_parameters and commandline_kwargs ++
 vars().update(post_import_problem(**vars()))
 
+# With solve_multiple_rhs all components sharing a matrix are solved after
+# the hook of the last component, so problem specific hooks would see
+# components that are not solved yet
+if solve_multiple_rhs:
+    default_hooks = importlib.import_module('oasis.problems.NSfracStep')
+    if (velocity_tentative_hook is not default_hooks.velocity_tentative_hook or
+            (len(scalar_components) > 1 and
+             scalar_hook is not default_hooks.scalar_hook)):
+        raise ValueError("solve_multiple_rhs cannot be used with a problem "
+                         "specific velocity_tentative_hook or scalar_hook")
+
 # Import chosen functionality from solvers
 solver = importlib.import_module('.'.join(('oasis.solvers.NSfracStep', solver)))
 vars().update({name:solver.__dict__[name] for name in solver.__all__})
@@ -71,8 +83,15 @@ uc_comp = u_components + scalar_components
 
 # Set up initial folders for storing results
 newfolder, tstepfiles = create_initial_folders(**vars())
+solution_writer = create_solution_writer(**vars())
+
+# Load constant matrices from previous runs if possible
+A_cache.set_folder(matrix_cache_folder)
+A_cache.set_memory_budget(cache_memory_budget)
+Solver_cache.set_memory_budget(cache_memory_budget)
 
 # Declare FunctionSpaces and arguments
+oasis_memory.begin_phase('function spaces')
 V = Q = FunctionSpace(mesh, 'CG', velocity_degree,
                       constrained_domain=constrained_domain)
 if velocity_degree != pressure_degree:
@@ -127,6 +146,7 @@ print_solve_info = use_krylov_solvers and krylov_solvers['monitor_convergence']
 bcs = create_bcs(**vars())
 
 # LES setup
+oasis_memory.begin_phase('LES setup')
 #exec("from oasis.solvers.NSfracStep.LES.{} import *".format(les_model))
 lesmodel = importlib.import_module('.'.join(('oasis.solvers.NSfracStep.LES', les_model)))
 vars().update({name:lesmodel.__dict__[name] for name in lesmodel.__all__})
@@ -134,11 +154,15 @@ vars().update({name:lesmodel.__dict__[name] for name in lesmodel.__all__})
 vars().update(les_setup(**vars()))
 
 # Initialize solution
+oasis_memory.begin_phase('preassembly')
 initialize(**vars())
 
 #  Fetch linear algebra solvers
 u_sol, p_sol, c_sol = get_solvers(**vars())
 
+# Initial guesses for Krylov solvers from previous solutions
+initial_guess = get_initial_guess(**vars())
+
 # Get constant body forces
 f = body_force(**vars())
 assert(isinstance(f, Coefficient))
@@ -156,6 +180,39 @@ vars().update(setup(**vars()))
 # Anything problem specific
 vars().update(pre_solve_hook(**vars()))
 
+# Timestep used on previous timestep (for variable timestep coefficients)
+dt_1 = dt
+if adaptive_timestep['active']:
+    timestepper = CFLTimestepper(V, dt, **adaptive_timestep)
+
+# Record timings and solver statistics for each timestep
+telemetry = Telemetry(newfolder) if record_telemetry else None
+managed_solvers = [sol for sol in (u_sol, p_sol, c_sol)
+                   if isinstance(sol, ManagedKrylovSolver)]
+for sol in managed_solvers:
+    sol.telemetry = telemetry
+allocations.telemetry = telemetry
+
+# Shift time levels by rotating arrays instead of copying data
+time_levels = TimeLevelRing(
+    [[x_[ui], x_1[ui], x_2[ui]] for ui in u_components] +
+    [[x_[ci], x_1[ci]] for ci in scalar_components]) if time_level_ring else None
+
+# Resolve the arguments of all functions called in the time loop
+plan = StepPlan(vars(), ["start_timestep_hook", "les_update",
+                         "assemble_first_inner_iter", "velocity_tentative_assemble",
+                         "velocity_tentative_hook", "velocity_tentative_solve",
+                         "pressure_assemble", "pressure_hook", "pressure_solve",
+                         "print_velocity_pressure_info", "velocity_update",
+                         "scalar_assemble", "scalar_hook", "scalar_solve",
+                         "temporal_hook", "save_solution"],
+                compiled=use_step_plan, telemetry=telemetry,
+                components=dict(velocity_tentative_assemble='ui',
+                                velocity_tentative_hook='ui',
+                                velocity_tentative_solve='ui',
+                                scalar_hook='ci', scalar_solve='ci'))
+
+oasis_memory.begin_phase('time loop')
 tx = OasisTimer('Timestep timer')
 tx.start()
 stop = False
@@ -166,61 +223,76 @@ while t < (T - tstep * DOLFIN_EPS) and not stop:
     inner_iter = 0
     udiff = array([1e8])  # Norm of velocity change over last inner iter
     num_iter = max(iters_on_first_timestep, max_iter) if tstep == 1 else max_iter
+    for sol in managed_solvers:
+        sol.new_step()
 
-    start_timestep_hook(**vars())
+    plan.start_timestep_hook()
 
     while udiff[0] > max_error and inner_iter < num_iter:
         inner_iter += 1
 
         t0 = OasisTimer("Tentative velocity")
         if inner_iter == 1:
-            les_update(**vars())
-            assemble_first_inner_iter(**vars())
+            plan.les_update()
+            plan.assemble_first_inner_iter()
         udiff[0] = 0.0
         for i, ui in enumerate(u_components):
             t1 = OasisTimer('Solving tentative velocity ' + ui, print_solve_info)
-            velocity_tentative_assemble(**vars())
-            velocity_tentative_hook(**vars())
-            velocity_tentative_solve(**vars())
+            plan.velocity_tentative_assemble()
+            plan.velocity_tentative_hook()
+            plan.velocity_tentative_solve()
             t1.stop()
 
         t0 = OasisTimer("Pressure solve", print_solve_info)
-        pressure_assemble(**vars())
-        pressure_hook(**vars())
-        pressure_solve(**vars())
+        plan.pressure_assemble()
+        plan.pressure_hook()
+        plan.pressure_solve()
         t0.stop()
 
-        print_velocity_pressure_info(**vars())
+        plan.print_velocity_pressure_info()
 
     # Update velocity
     t0 = OasisTimer("Velocity update")
-    velocity_update(**vars())
+    plan.velocity_update()
     t0.stop()
 
     # Solve for scalars
     if len(scalar_components) > 0:
-        scalar_assemble(**vars())
+        plan.scalar_assemble()
         for ci in scalar_components:
             t1 = OasisTimer('Solving scalar {}'.format(ci), print_solve_info)
-            scalar_hook(**vars())
-            scalar_solve(**vars())
+            plan.scalar_hook()
+            plan.scalar_solve()
             t1.stop()
 
-    temporal_hook(**vars())
+    plan.temporal_hook()
 
     # Save solution if required and check for killoasis file
-    stop = save_solution(**vars())
+    stop = plan.save_solution()
 
     # Update to a new timestep
-    for ui in u_components:
-        x_2[ui].zero()
-        x_2[ui].axpy(1.0, x_1[ui])
-        x_1[ui].zero()
-        x_1[ui].axpy(1.0, x_[ui])
+    if time_levels is not None:
+        time_levels.rotate()
 
-    for ci in scalar_components:
-        x_1[ci].zero()
-        x_1[ci].axpy(1., x_[ci])
+    else:
+        for ui in u_components:
+            x_2[ui].zero()
+            x_2[ui].axpy(1.0, x_1[ui])
+            x_1[ui].zero()
+            x_1[ui].axpy(1.0, x_[ui])
+
+        for ci in scalar_components:
+            x_1[ci].zero()
+            x_1[ci].axpy(1., x_[ci])
+
+    # Adapt timestep to the CFL number
+    dt_1 = dt
+    if adaptive_timestep['active'] and not stop:
+        dt = timestepper(x_, u_components, t, dt, T)
+        NS_parameters['dt'] = dt
+
+    if telemetry is not None:
+        telemetry.end_step(tstep, t, dt_1, inner_iterations=inner_iter)
 
     # Print some information
     if tstep % print_intermediate_info == 0:
@@ -231,19 +303,41 @@ while t < (T - tstep * DOLFIN_EPS) and not stop:
         list_timings(TimingClear.clear, [TimingType.wall])
         tx.start()
 
-    # AB projection for pressure on next timestep
+    # AB projection for pressure on next timestep (dt_1 is the previous dt)
     if AB_projection_pressure and t < (T - tstep * DOLFIN_EPS) and not stop:
-        x_['p'].axpy(0.5, dp_.vector())
+        x_['p'].axpy(0.5 * dt / dt_1, dp_.vector())
 
 total_timer.stop()
 list_timings(TimingClear.keep, [TimingType.wall])
 info_red('Total computing time = {0:f}'.format(total_timer.elapsed()[0]))
+if adaptive_timestep['active']:
+    info_red(timestepper.report(total_timer.elapsed()[0]))
+for sol in (u_sol, p_sol, c_sol):
+    if isinstance(sol, ManagedKrylovSolver):
+        info_red(sol.report())
+for guess in initial_guess.values():
+    info_red(guess.report())
+info_red('Vectors and matrices allocated = {} {}'.format(
+    allocations.total(), dict(allocations)))
+if report_cache:
+    info_red(A_cache.report())
+    info_red(Solver_cache.report())
 oasis_memory('Final memory use ')
+if report_memory:
+    oasis_memory.report(vars())
+oasis_memory.reduce()
 total_initial_dolfin_memory = MPI.sum(MPI.comm_world, initial_memory_use)
 info_red('Memory use for importing dolfin = {} MB (RSS)'.format(
     total_initial_dolfin_memory))
 info_red('Total memory use of solver = ' +
          str(oasis_memory.memory - total_initial_dolfin_memory) + " MB (RSS)")
 
+# Finish writing solutions before the final hook
+if solution_writer is not None:
+    solution_writer.close()
+
+if telemetry is not None:
+    telemetry.close()
+
 # Final hook
 theend_hook(**vars())
@@ -1,15 +1,23 @@
 from .io import *
 from .utilities import *
+from .stepplan import *
+from .timestepping import *
+from .telemetry import *
+from .initialguess import *
+from .preconditioner import *
+from .convection import *
+from .timelevels import *
+from .formsplit import *
 import sys
 import json
 
 def convert(input):
     if isinstance(input, dict):
-        return {convert(key): convert(value) for key, value in input.iter()}
+        return {convert(key): convert(value) for key, value in input.items()}
     elif isinstance(input, list):
         return [convert(element) for element in input]
-    elif isinstance(input, str):
-        return input.encode('utf-8')
+    elif isinstance(input, bytes):
+        return input.decode('utf-8')
     else:
         return input
 
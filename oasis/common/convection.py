@@ -0,0 +1,101 @@
+"""
+Fast assembly of the convection matrix from precomputed element data.
+
+The convection form
+
+    inner(v, dot(w, nabla_grad(u)))*dx
+
+is linear in the convecting velocity w. On affine simplices the element
+matrix of cell e is
+
+    C_e[a, b] = sum_{k, c} R[k, c, a, b] * Z_e[k, c],
+    Z_e[k, c] = |det J_e| * sum_j K_e[k, j] * w_j[c]
+
+where R[k, c, a, b] = int phi_a * phi_c * d(phi_b)/dX_k dX is computed
+once on the reference cell and K_e is the inverse Jacobian of cell e.
+Only K_e*|det J_e| (dim*dim numbers per cell) and the cell dofs are stored.
+All element matrices are then computed by one matrix-matrix product
+and added to the global matrix with one call to PETSc.
+
+"""
+
+__license__ = "GNU Lesser GPL version 3 or any later version"
+
+import numpy as np
+from dolfin import as_backend_type
+from ufl.tensors import ListTensor
+
+__all__ = ["ConvectionOperator", "convection_reference_tensor"]
+
+
+def convection_reference_tensor(dim, degree):
+    """Return R[k*nd + c, a*nd + b] = int phi_a*phi_c*d(phi_b)/dX_k dX on the
+    reference simplex, for Lagrange elements of degree with nd dofs."""
+    import FIAT
+    cell = FIAT.reference_element.ufc_simplex(dim)
+    element = FIAT.Lagrange(cell, degree)
+    # Integrand is a polynomial of degree 3*degree-1
+    quadrature = FIAT.quadrature.make_quadrature(cell, (3 * degree) // 2 + 1)
+    weights = np.array(quadrature.get_weights())
+    tabulated = element.tabulate(1, quadrature.get_points())
+    phi = tabulated[(0,) * dim]
+    dphi = np.array([tabulated[tuple(int(i == k) for i in range(dim))]
+                     for k in range(dim)])
+    R = np.einsum('q,aq,kbq,cq->kcab', weights, phi, dphi, phi)
+    nd = phi.shape[0]
+    return R.reshape(dim * nd, nd * nd)
+
+
+class ConvectionOperator(object):
+    """Assemble inner(v, dot(w, nabla_grad(u)))*dx into a matrix with the
+    sparsity pattern of the mass matrix on V.
+
+      V : Lagrange FunctionSpace on an affine simplex mesh
+      w : Convecting velocity, list (or as_vector) of Functions on V
+
+    """
+
+    def __init__(self, V, w):
+        from petsc4py import PETSc
+        mesh = V.mesh()
+        dim = mesh.topology().dim()
+        element = V.ufl_element()
+        assert element.family() == "Lagrange" and mesh.geometry().dim() == dim
+        assert mesh.ufl_cell().cellname() in ("triangle", "tetrahedron")
+        self.w = list(w.ufl_operands) if isinstance(w, ListTensor) else list(w)
+        self.dim = dim
+        self.R = convection_reference_tensor(dim, element.degree())
+
+        # Geometry: G_e = |det J_e| * inv(J_e)
+        X = mesh.coordinates()[mesh.cells()]
+        J = (X[:, 1:, :] - X[:, :1, :]).transpose(0, 2, 1)
+        self.G = np.linalg.inv(J) * abs(np.linalg.det(J))[:, None, None]
+
+        dofmap = V.dofmap()
+        self.dofs = np.array([dofmap.cell_dofs(i) for i in range(mesh.num_cells())],
+                             dtype=PETSc.IntType)
+        self.local_dofs = np.arange(self.dofs.max() + 1, dtype=np.intc)
+        nd = self.dofs.shape[1]
+        self.U = np.zeros((len(self.dofs), dim, nd))
+        self.Ce = np.zeros((len(self.dofs), nd * nd))
+        self.ADD = PETSc.InsertMode.ADD_VALUES
+
+    def assemble(self, A):
+        """Assemble convection matrix for current w into A."""
+        for j, wj in enumerate(self.w):
+            vec = as_backend_type(wj.vector())
+            vec.update_ghost_values()
+            self.U[:, j, :] = vec.get_local(self.local_dofs)[self.dofs]
+
+        Z = np.einsum('ekj,ejc->ekc', self.G, self.U)
+        np.dot(Z.reshape(len(self.dofs), -1), self.R, out=self.Ce)
+        A.zero()
+        as_backend_type(A).mat().setValuesLocalRCV(self.dofs, self.dofs,
+                                                   self.Ce, self.ADD)
+        A.apply("add")
+        return A
+
+    def memory(self):
+        """Return bytes of memory used by the stored data on this process."""
+        return sum(a.nbytes for a in (self.R, self.G, self.dofs, self.local_dofs,
+                                      self.U, self.Ce))
@@ -0,0 +1,187 @@
+"""
+Split the forms of the naive solvers into constant and time-dependent parts.
+
+The naive solvers (IPCS, Chorin, BDFPC) write each equation as one form F
+and solve lhs(F) == rhs(F). Reassembling all of F every timestep is slow,
+since most of the terms are either constant (mass and stiffness) or linear
+in one Function (e.g., q_1[ui] or p_). A SplitForm expands F into a sum of
+terms, distributing products and derivatives over sums, and sorts the
+terms into
+
+    - bilinear terms without coefficients, assembled once (A_cache)
+    - linear terms without coefficients, assembled once
+    - linear terms that are linear in one Function f and contain no other
+      coefficients. The matrix B of the term with f replaced by a
+      TrialFunction is assembled once (A_cache), and the term is computed
+      as B*f.vector()
+    - all other terms, assembled every time the form is solved
+
+Constants are coefficients that may be changed by hooks, so terms with
+Constants are assembled every time. With a constant lhs the LU
+factorization is computed only once.
+
+"""
+
+__license__ = "GNU Lesser GPL version 3 or any later version"
+
+from dolfin import (Vector, LUSolver, assemble, solve, lhs, rhs, TrialFunction,
+                    as_backend_type)
+from ufl import Form, replace
+from ufl.classes import (Sum, Product, Inner, Dot, Outer, Cross, Division,
+                         Indexed, ComponentTensor, IndexSum, Grad, Div,
+                         NablaGrad, NablaDiv, Curl, Transposed, Sym, Skew,
+                         Trace, Deviatoric, ListTensor, Zero)
+from ufl.algorithms import expand_derivatives
+from ufl.algorithms.apply_algebra_lowering import apply_algebra_lowering
+from ufl.algorithms.check_arities import check_form_arity, ArityMismatch
+from .utilities import A_cache, matvec_add
+
+__all__ = ["SplitForm", "split_terms", "solve_form"]
+
+# Operators that are linear in all operands
+_bilinear = (Product, Inner, Dot, Outer, Cross)
+
+# Operators that are linear in the first operand only
+_linear = (Division, ComponentTensor, IndexSum, Grad, Div, NablaGrad,
+           NablaDiv, Curl, Transposed, Sym, Skew, Trace, Deviatoric)
+
+
+def split_terms(e):
+    """Return list of terms with sum equal to expression e."""
+    if isinstance(e, Sum):
+        return split_terms(e.ufl_operands[0]) + split_terms(e.ufl_operands[1])
+
+    elif isinstance(e, _bilinear):
+        a, b = e.ufl_operands
+        return [e._ufl_expr_reconstruct_(ta, tb)
+                for ta in split_terms(a) for tb in split_terms(b)]
+
+    elif isinstance(e, Indexed):
+        # Indexing picks the component directly from a ListTensor
+        a, index = e.ufl_operands
+        return [t[tuple(index)] for t in split_terms(a)]
+
+    elif isinstance(e, _linear):
+        ops = e.ufl_operands
+        return [e._ufl_expr_reconstruct_(t, *ops[1:]) for t in split_terms(ops[0])]
+
+    elif isinstance(e, ListTensor):
+        # One term for each term of each component, zero elsewhere
+        ops = e.ufl_operands
+        terms = []
+        for k, op in enumerate(ops):
+            for t in split_terms(op):
+                zero = Zero(op.ufl_shape, t.ufl_free_indices, t.ufl_index_dimensions)
+                terms.append(ListTensor(*[t if j == k else zero
+                                          for j in range(len(ops))]))
+        return terms
+
+    return [e]
+
+
+def _sum(forms):
+    return sum(forms[1:], forms[0]) if len(forms) > 0 else None
+
+
+class SplitForm(object):
+    """Form F, as used in solve(lhs(F) == rhs(F)), split into constant and
+    time-dependent parts.
+    """
+
+    def __init__(self, F):
+        a_const, a_var, L_const, L_var = [], [], [], []
+        linear = {}
+        for integral in F.integrals():
+            for t in split_terms(integral.integrand()):
+                if isinstance(t, Zero):
+                    continue
+                term = Form([integral.reconstruct(integrand=t)])
+                coefficients = term.coefficients()
+                if len(term.arguments()) == 2:
+                    (a_var if coefficients else a_const).append(term)
+                    continue
+
+                term = -term  # Linear terms are moved to the rhs
+                if len(coefficients) == 0:
+                    L_const.append(term)
+
+                elif len(coefficients) == 1 and hasattr(coefficients[0], "vector"):
+                    f = coefficients[0]
+                    B = replace(term, {f: TrialFunction(f.function_space())})
+                    try:
+                        check_form_arity(expand_derivatives(apply_algebra_lowering(B)),
+                                         B.arguments())
+                        linear.setdefault(f, []).append(B)
+                    except ArityMismatch:
+                        L_var.append(term)
+
+                else:
+                    L_var.append(term)
+
+        self.a = _sum(a_const + a_var)
+        self.a_var = _sum(a_var)
+        self.L_var = _sum(L_var)
+        self.A_const = A_cache[(_sum(a_const), ())] if a_const else None
+        self.matvecs = [(A_cache[(_sum(B), ())], f) for f, B in linear.items()]
+
+        # Allocate with the sparsity pattern of the complete lhs
+        self.A = assemble(self.a)
+        self.b = Vector()
+        self.A.init_vector(self.b, 0)
+        self.b_const = assemble(_sum(L_const)) if L_const else None
+        self.solver = None
+
+    def assemble_lhs(self, bcs=[]):
+        """Assemble lhs and apply bcs. A constant lhs is only assembled once."""
+        if self.a_var is None and self.solver is not None:
+            return self.A
+
+        if self.a_var is not None:
+            assemble(self.a_var, tensor=self.A)
+        else:
+            self.A.zero()
+
+        if self.A_const is not None:
+            from petsc4py import PETSc
+            as_backend_type(self.A).mat().axpy(
+                1., as_backend_type(self.A_const).mat(),
+                PETSc.Mat.Structure.SUBSET_NONZERO_PATTERN)
+
+        for bc in bcs:
+            bc.apply(self.A)
+        return self.A
+
+    def assemble_rhs(self, bcs=[]):
+        """Assemble rhs and apply bcs."""
+        if self.L_var is not None:
+            assemble(self.L_var, tensor=self.b)
+        else:
+            self.b.zero()
+
+        if self.b_const is not None:
+            self.b.axpy(1., self.b_const)
+
+        for B, f in self.matvecs:
+            matvec_add(B, f.vector(), self.b, self.b)
+
+        for bc in bcs:
+            bc.apply(self.b)
+        return self.b
+
+    def solve(self, u, bcs=[]):
+        """Solve lhs == rhs for Function u."""
+        A = self.assemble_lhs(bcs)
+        b = self.assemble_rhs(bcs)
+        if self.solver is None:
+            self.solver = LUSolver(A)
+        elif self.a_var is not None:
+            self.solver.set_operator(A)
+        self.solver.solve(u.vector(), b)
+
+
+def solve_form(F, u, bcs=[]):
+    """Solve lhs(F) == rhs(F) for u, where F is a Form or a SplitForm."""
+    if isinstance(F, SplitForm):
+        F.solve(u, bcs)
+    else:
+        solve(lhs(F) == rhs(F), u, bcs)
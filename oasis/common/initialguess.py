@@ -0,0 +1,171 @@
+"""
+Initial guesses for the Krylov solvers computed from the solutions of
+previous timesteps.
+
+Two methods are available
+
+  extrapolation
+    Polynomial extrapolation through the last k solutions, assuming a
+    constant timestep, e.g., 2*x^{n-1} - x^{n-2} for k = 2.
+
+  projection
+    The initial guess minimizing the residual |b - A*x0| over the span of
+    the last k solutions (Fischer, Comput. Methods Appl. Mech. Engrg. 163,
+    1998). The vectors A*x_j are orthonormalized, such that the guess only
+    costs k inner products. For a constant matrix the basis is updated
+    with one matvec per timestep, otherwise it is rebuilt from the stored
+    solutions on each call.
+
+"""
+
+__license__ = "GNU Lesser GPL version 3 or any later version"
+
+from dolfin import Vector
+from .telemetry import get_ksp, allocations
+
+__all__ = ["SolutionHistory", "get_initial_guess", "extrapolation_coefficients"]
+
+
+def extrapolation_coefficients(n):
+    """Return weights of the n last solutions (newest first) for polynomial
+    extrapolation with constant timestep."""
+    c, binomial = [], 1
+    for j in range(n):
+        binomial = binomial * (n - j) // (j + 1)
+        c.append((-1)**j * binomial)
+    return c
+
+
+class SolutionHistory(object):
+    """History of the last k solutions of a linear system A*x = b.
+
+    Call with (A, b, x) before solving to set x to the initial guess, and
+    call record with (sol, A, x) after solving to add the solution x to the
+    history. With replace=True the solution replaces the newest solution
+    in the history, which is used for the inner iterations of a timestep.
+
+    """
+
+    def __init__(self, x, k=3, method="projection", constant_operator=False,
+                 name=""):
+        assert method in ("extrapolation", "projection")
+        self.k = k
+        self.method = method
+        self.constant_operator = constant_operator
+        self.name = name
+        self.solutions = []
+        self.X = []
+        self.W = []
+        self.spare = []
+        self.last_added = False
+        self.solves = 0
+        self.iterations = 0
+
+    def __call__(self, A, b, x):
+        if len(self.solutions) == 0:
+            return
+
+        if self.method == "extrapolation":
+            coefficients = extrapolation_coefficients(len(self.solutions))
+            x.zero()
+            for c, y in zip(coefficients, self.solutions):
+                x.axpy(c, y)
+            return
+
+        if not self.constant_operator:
+            self.build_basis(A)
+
+        x.zero()
+        for xj, wj in zip(self.X, self.W):
+            x.axpy(wj.inner(b), xj)
+
+    def push(self, A, x, replace=False):
+        """Add solution x to history, reusing the oldest vector if full."""
+        if replace and len(self.solutions) > 0:
+            y = self.solutions.pop(0)
+        elif len(self.solutions) < self.k:
+            y = Vector(x)
+            allocations.add("solution_history")
+        else:
+            y = self.solutions.pop()
+        y.zero()
+        y.axpy(1., x)
+        self.solutions.insert(0, y)
+        if self.method == "projection" and self.constant_operator:
+            if replace and self.last_added:
+                self.spare.append((self.X.pop(), self.W.pop()))
+            elif not replace and len(self.X) == self.k:
+                # Remaining vectors are still orthonormal
+                self.spare.append((self.X.pop(0), self.W.pop(0)))
+            self.last_added = self.add_to_basis(A, x)
+
+    def build_basis(self, A):
+        self.spare.extend(zip(self.X, self.W))
+        self.X = []
+        self.W = []
+        for y in reversed(self.solutions):
+            self.add_to_basis(A, y)
+
+    def add_to_basis(self, A, x):
+        """Orthonormalize A*x against the basis (modified Gram-Schmidt).
+
+        The basis vectors are taken from the spare vectors, which are
+        allocated once. Return False if A*x is linearly dependent on the
+        basis.
+        """
+        if self.spare:
+            xn, wn = self.spare.pop()
+        else:
+            xn, wn = Vector(x), Vector(x)
+            allocations.add("solution_history", 2)
+        xn.zero()
+        xn.axpy(1., x)
+        A.mult(xn, wn)
+        wnorm0 = wn.norm("l2")
+        for xj, wj in zip(self.X, self.W):
+            c = wn.inner(wj)
+            wn.axpy(-c, wj)
+            xn.axpy(-c, xj)
+        wnorm = wn.norm("l2")
+        if wnorm <= 1e-10 * wnorm0:
+            # Linearly dependent on the basis
+            self.spare.append((xn, wn))
+            return False
+        wn *= 1. / wnorm
+        xn *= 1. / wnorm
+        self.X.append(xn)
+        self.W.append(wn)
+        return True
+
+    def record(self, sol, A, x, replace=False):
+        """Add solution x of A*x = b to history and count Krylov iterations
+        of the last solve with sol."""
+        self.push(A, x, replace)
+        ksp = get_ksp(sol)
+        if ksp is not None:
+            self.solves += 1
+            self.iterations += ksp.getIterationNumber()
+
+    def report(self):
+        return "Initial guess {0} {1} (k={2:d}): {3:d} solves, {4:d} Krylov iterations ({5:2.2f} per solve)".format(
+            self.name, self.method, self.k, self.solves, self.iterations,
+            self.iterations / max(self.solves, 1))
+
+
+def get_initial_guess(u_components, x_, use_krylov_solvers, pressure_initial_guess,
+                      velocity_initial_guess, initial_guess_history, **NS_namespace):
+    """Return dictionary of SolutionHistory for pressure and velocity
+    components, where an initial guess from history is used."""
+    initial_guess = {}
+    if not use_krylov_solvers:
+        return initial_guess
+
+    if pressure_initial_guess != "previous":
+        initial_guess['p'] = SolutionHistory(x_['p'], initial_guess_history,
+                                             pressure_initial_guess,
+                                             constant_operator=True, name='p')
+    if velocity_initial_guess != "previous":
+        for ui in u_components:
+            initial_guess[ui] = SolutionHistory(x_[ui], initial_guess_history,
+                                                velocity_initial_guess, name=ui)
+    return initial_guess
@@ -4,14 +4,16 @@ __copyright__ = "Copyright (C) 2013 " + __author__
 __license__ = "GNU Lesser GPL version 3 or any later version"
 
 from os import makedirs, getcwd, listdir, remove, system, path
+import sys
 import pickle
-from dolfin import (MPI, Function, XDMFFile, HDF5File,
-    VectorFunctionSpace, FunctionAssigner)
-from oasis.problems import info_red
+import numpy as np
+from dolfin import (MPI, Function, XDMFFile, HDF5File, Mesh, FunctionSpace,
+    VectorFunctionSpace, FunctionAssigner, vertex_to_dof_map, as_backend_type)
+from oasis.problems import info_red, OasisXDMFFile
 
 __all__ = ["create_initial_folders", "save_solution", "save_tstep_solution_h5",
            "save_checkpoint_solution_h5", "check_if_kill", "check_if_reset_statistics",
-           "init_from_restart"]
+           "init_from_restart", "AsyncSolutionWriter", "create_solution_writer"]
 
 
 def create_initial_folders(folder, restart_folder, sys_comp, tstep, info_red,
@@ -54,7 +56,7 @@ def create_initial_folders(folder, restart_folder, sys_comp, tstep, info_red,
         comps = ['p', 'u'] + scalar_components
 
     for ui in comps:
-        tstepfiles[ui] = XDMFFile(MPI.comm_world, path.join(
+        tstepfiles[ui] = OasisXDMFFile(MPI.comm_world, path.join(
             tstepfolder, ui + '_from_tstep_{}.xdmf'.format(tstep)))
         tstepfiles[ui].parameters["rewrite_function_mesh"] = False
         tstepfiles[ui].parameters["flush_output"] = True
@@ -65,13 +67,16 @@ def create_initial_folders(folder, restart_folder, sys_comp, tstep, info_red,
 def save_solution(tstep, t, q_, q_1, folder, newfolder, save_step, checkpoint,
                   NS_parameters, tstepfiles, u_, u_components, scalar_components,
                   output_timeseries_as_vector, constrained_domain,
-                  AssignedVectorFunction, **NS_namespace):
+                  AssignedVectorFunction, solution_writer=None, **NS_namespace):
     """Called at end of timestep. Check for kill and save solution if required."""
     NS_parameters.update(t=t, tstep=tstep)
     if tstep % save_step == 0:
-        save_tstep_solution_h5(tstep, q_, u_, newfolder, tstepfiles, constrained_domain,
-                               output_timeseries_as_vector, u_components, AssignedVectorFunction,
-                               scalar_components, NS_parameters)
+        if (solution_writer is None or
+                not solution_writer.write(tstep, q_, u_, AssignedVectorFunction,
+                                          NS_parameters)):
+            save_tstep_solution_h5(tstep, q_, u_, newfolder, tstepfiles, constrained_domain,
+                                   output_timeseries_as_vector, u_components, AssignedVectorFunction,
+                                   scalar_components, NS_parameters)
 
     killoasis = check_if_kill(folder)
     if tstep % checkpoint == 0 or killoasis:
@@ -81,6 +86,210 @@ def save_solution(tstep, t, q_, q_1, folder, newfolder, save_step, checkpoint,
     return killoasis
 
 
+class AsyncSolutionWriter(object):
+    """Write the timeseries in tstepfiles from dedicated writer processes.
+
+    On the first write, one writer process is spawned (MPI_Comm_spawn) for
+    each solver process, and the mesh is handed over through an HDF5 file.
+    At each write the solver computes the vertex values of each function,
+    which is what XDMFFile.write stores, and sends them with a nonblocking
+    send to its writer process. The writer processes redistribute the values
+    to their own mesh partition and write the XDMF files on their own
+    communicator. The solver processes do no file I/O and no collectives for
+    the timeseries, and continue with the next timestep.
+
+    At most num_buffers solutions may be waiting to be written. After that,
+    write blocks until the oldest is written (backpressure). drain waits for
+    all sent solutions to be written.
+
+    If the writer processes cannot be spawned, write returns False and the
+    solution must be written synchronously.
+
+    """
+
+    def __init__(self, tstepfiles, output_timeseries_as_vector, newfolder,
+                 num_buffers=2):
+        self.tstepfiles = tstepfiles
+        self.as_vector = output_timeseries_as_vector
+        self.newfolder = newfolder
+        self.num_buffers = num_buffers
+        self.num_writes = 0
+        self.num_written = 0
+        self.requests = []
+        self.inter = None
+        self.failed = False
+
+    def _functions(self, q_, u_):
+        """Return dict of the functions to be written to each file."""
+        functions = {}
+        for comp, tstepfile in self.tstepfiles.items():
+            if self.as_vector and comp == "u":
+                self.uv()
+                functions[comp] = self.uv
+            else:
+                functions[comp] = q_[comp] if comp in q_ else tstepfile.function
+        return functions
+
+    def _start(self, q_, u_, AssignedVectorFunction):
+        """Spawn writer processes and send them the mesh and file names."""
+        comm = MPI.comm_world
+        self.uv = AssignedVectorFunction(u_) if self.as_vector else None
+        functions = self._functions(q_, u_)
+        mesh = next(iter(functions.values())).function_space().mesh()
+        meshfile = path.join(self.newfolder, "writer_mesh.h5")
+        h5 = HDF5File(comm, meshfile, "w")
+        h5.write(mesh, "/mesh")
+        h5.close()
+
+        root = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+        code = ("import sys; sys.path.insert(0, {!r}); "
+                "from oasis.common.io import solution_writer_process; "
+                "solution_writer_process()").format(root)
+        try:
+            self.inter = comm.Spawn(sys.executable, args=["-c", code],
+                                    maxprocs=comm.Get_size())
+        except Exception as e:
+            info_red("Could not spawn writer processes ({}). Using synchronous "
+                     "output".format(e))
+            self.failed = True
+            return
+
+        files = {comp: (self.tstepfiles[comp].filename, f.name(),
+                        f.value_size()) for comp, f in functions.items()}
+        self.inter.send(dict(meshfile=meshfile, files=files,
+                             vertices=mesh.topology().global_indices(0)),
+                        dest=comm.Get_rank(), tag=0)
+        info_red("Writing timeseries from {} writer processes".format(
+            comm.Get_size()))
+
+    def write(self, tstep, q_, u_, AssignedVectorFunction, NS_parameters):
+        """Send solution to the writer processes.
+
+        Return False if the solution must be written synchronously.
+        """
+        if self.num_writes == 0 and not self.failed:
+            self._start(q_, u_, AssignedVectorFunction)
+            if MPI.rank(MPI.comm_world) == 0:
+                timefolder = path.join(self.newfolder, 'Timeseries')
+                if not self.failed and not path.exists(path.join(timefolder, "params.dat")):
+                    with open(path.join(timefolder, 'params.dat'), 'wb') as f:
+                        pickle.dump(NS_parameters, f)
+        if self.failed:
+            return False
+
+        # Backpressure: wait until the oldest solution is written
+        if self.num_writes - self.num_written >= self.num_buffers:
+            self._wait_written()
+
+        data = {}
+        for comp, f in self._functions(q_, u_).items():
+            data[comp] = f.compute_vertex_values(f.function_space().mesh())
+        self.requests.append(self.inter.isend((float(tstep), data),
+                                              dest=MPI.rank(MPI.comm_world), tag=1))
+        self.num_writes += 1
+        return True
+
+    def _wait_written(self):
+        self.inter.recv(source=MPI.rank(MPI.comm_world), tag=2)
+        self.requests.pop(0).wait()
+        self.num_written += 1
+
+    def drain(self):
+        """Wait until all sent solutions are written."""
+        while self.num_written < self.num_writes:
+            self._wait_written()
+
+    def close(self):
+        """Write all sent solutions and stop the writer processes."""
+        if self.inter is None:
+            return
+        self.drain()
+        self.inter.send(None, dest=MPI.rank(MPI.comm_world), tag=1)
+        self.inter.Disconnect()
+        self.inter = None
+
+
+def solution_writer_process():
+    """Run a writer process spawned by AsyncSolutionWriter.
+
+    Writer process r receives the solutions of solver process r. The vertex
+    values are sent to the writer that owns each vertex through a directory
+    distributed by global vertex index (index % size).
+    """
+    from mpi4py import MPI as pyMPI
+    parent = pyMPI.Comm.Get_parent()
+    comm = MPI.comm_world
+    rank, size = comm.Get_rank(), comm.Get_size()
+    config = parent.recv(source=rank, tag=0)
+
+    mesh = Mesh(comm)
+    h5 = HDF5File(comm, config["meshfile"], "r")
+    h5.read(mesh, "/mesh", False)
+    h5.close()
+    comm.barrier()
+    if rank == 0:
+        remove(config["meshfile"])
+
+    # Directory of the vertices of the paired solver process and of this mesh
+    sent = np.asarray(config["vertices"])
+    local = mesh.topology().global_indices(0)
+    sent_pos = [np.where(sent % size == d)[0] for d in range(size)]
+    need_pos = [np.where(local % size == d)[0] for d in range(size)]
+    sent_g = comm.alltoall([sent[i] for i in sent_pos])
+    need_g = comm.alltoall([local[i] for i in need_pos])
+    all_g = np.concatenate(sent_g)
+    order = np.argsort(all_g, kind="mergesort")
+    fetch = [order[np.searchsorted(all_g[order], g)] for g in need_g]
+
+    functions, files = {}, {}
+    for comp, (filename, name, value_size) in config["files"].items():
+        if value_size == 1:
+            V = FunctionSpace(mesh, "CG", 1)
+        else:
+            V = VectorFunctionSpace(mesh, "CG", 1, dim=value_size)
+        functions[comp] = (Function(V, name=name), vertex_to_dof_map(V))
+        files[comp] = XDMFFile(comm, filename)
+        files[comp].parameters["rewrite_function_mesh"] = False
+        files[comp].parameters["flush_output"] = True
+
+    while True:
+        item = parent.recv(source=rank, tag=1)
+        if item is None:
+            break
+
+        tstep, data = item
+        for comp, (f, v2d) in functions.items():
+            vs = f.value_size()
+            values = data[comp].reshape((vs, -1))
+            received = comm.alltoall([values[:, i] for i in sent_pos])
+            values = np.concatenate(received, axis=1)
+            received = comm.alltoall([values[:, i] for i in fetch])
+            vertex_values = np.empty((vs, len(local)))
+            for d in range(size):
+                vertex_values[:, need_pos[d]] = received[d]
+            x = np.empty(len(v2d))
+            x[v2d] = vertex_values.T.ravel()
+            f.vector().set_local(x[:f.vector().local_size()])
+            f.vector().apply("insert")
+            as_backend_type(f.vector()).update_ghost_values()
+            files[comp].write(f, tstep)
+        parent.send(tstep, dest=rank, tag=2)
+
+    for xdmf in files.values():
+        xdmf.close()
+    parent.Disconnect()
+
+
+def create_solution_writer(tstepfiles, async_output, async_output_buffers,
+                           output_timeseries_as_vector, newfolder, **NS_namespace):
+    """Return AsyncSolutionWriter if async_output, otherwise None."""
+    if not async_output:
+        return None
+
+    return AsyncSolutionWriter(tstepfiles, output_timeseries_as_vector,
+                               newfolder, async_output_buffers)
+
+
 def save_tstep_solution_h5(tstep, q_, u_, newfolder, tstepfiles, constrained_domain,
                            output_timeseries_as_vector, u_components, AssignedVectorFunction,
                            scalar_components, NS_parameters):
@@ -0,0 +1,146 @@
+"""
+Explicit control over when the preconditioners of the Krylov solvers are
+rebuilt.
+
+The pressure Laplacian is assembled once, so its preconditioner (normally
+an algebraic multigrid hierarchy) only needs to be built once. The
+coefficient matrices of tentative velocity and scalars change values every
+timestep, but keep the same sparsity pattern. Their preconditioners may be
+rebuilt every timestep (default), or kept for a number of timesteps at the
+cost of some extra Krylov iterations. Within a timestep, the components
+solved with the same solver reuse the preconditioner.
+
+A ManagedKrylovSolver wraps a dolfin Krylov solver and sets the PETSc flag
+KSPSetReusePreconditioner on each solve. The preconditioner setup is timed
+separately from the solve.
+
+"""
+
+__license__ = "GNU Lesser GPL version 3 or any later version"
+
+from time import perf_counter
+from dolfin import Timer, as_backend_type
+
+__all__ = ["ManagedKrylovSolver", "operator_state"]
+
+
+def operator_state(A):
+    """Return the PETSc object state of matrix A, which is increased by
+    every change of its values, or None if not available."""
+    mat = as_backend_type(A).mat()
+    if not hasattr(mat, "stateGet"):
+        return None
+    return (mat.handle, mat.stateGet())
+
+
+class ManagedKrylovSolver(object):
+    """Krylov solver with preconditioner reuse.
+
+      solver  : dolfin KrylovSolver or PETScKrylovSolver
+      refresh : Number of timesteps between rebuilding the preconditioner.
+                0 builds the preconditioner only when the operator is a
+                new matrix (constant operators). Timesteps are counted
+                by calls to new_step.
+      name    : Name used for timings
+      boomeramg : Dictionary of BoomerAMG parameters, e.g.,
+                  dict(strong_threshold=0.5, agg_nl=1), set as the PETSc
+                  options -pc_hypre_boomeramg_<key> of this solver only.
+
+    All other attributes are taken from the wrapped solver.
+
+    """
+
+    def __init__(self, solver, refresh=1, name="", boomeramg={}):
+        self.solver = solver
+        self.refresh = refresh
+        self.name = name
+        self.operator = None
+        self.num_solves = 0
+        self.num_steps = 0
+        self.setup_step = 0
+        self.setup_state = None
+        self.num_setups = 0
+        self.setup_time = 0.
+        self.solve_time = 0.
+        self.last_setup_time = 0.
+        self.telemetry = None
+        if boomeramg:
+            self.set_boomeramg_parameters(boomeramg)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on self
+        return getattr(self.__dict__["solver"], name)
+
+    def ksp(self):
+        solver = self.solver
+        return solver.ksp() if hasattr(solver, "ksp") else as_backend_type(solver).ksp()
+
+    def set_boomeramg_parameters(self, boomeramg):
+        from petsc4py import PETSc
+        ksp = self.ksp()
+        prefix = "oasis_{}_{}_".format(self.name, id(self))
+        ksp.setOptionsPrefix(prefix)
+        opts = PETSc.Options(prefix)
+        for key, val in boomeramg.items():
+            opts["pc_hypre_boomeramg_" + key] = val
+        ksp.getPC().setFromOptions()
+
+    def new_step(self):
+        """Called at the start of each timestep."""
+        self.num_steps += 1
+
+    def set_operator(self, A):
+        """Set operator and rebuild the preconditioner if required.
+
+        The preconditioner is rebuilt for a new operator, and every refresh
+        timesteps if the values of the operator have changed since the
+        last setup.
+        """
+        state = operator_state(A)
+        new_operator = A is not self.operator
+        rebuild = new_operator or (
+            self.refresh > 0 and self.num_steps - self.setup_step >= self.refresh
+            and (state is None or state != self.setup_state))
+        self.operator = A
+        self.solver.set_operator(A)
+        ksp = self.ksp()
+        ksp.setReusePreconditioner(not rebuild)
+        if rebuild:
+            self.setup_step = self.num_steps
+            self.setup_state = state
+            t0 = Timer("{} preconditioner setup".format(self.name))
+            t1 = perf_counter()
+            ksp.setUp()
+            self.last_setup_time = perf_counter() - t1
+            self.setup_time += self.last_setup_time
+            self.num_setups += 1
+            t0.stop()
+            if self.telemetry is not None:
+                self.telemetry.add("{}:pc_setup".format(self.name), self.last_setup_time)
+                self.telemetry.count("{}:pc_setups".format(self.name), 1)
+
+    def solve(self, A, x, b):
+        self.set_operator(A)
+        t1 = perf_counter()
+        result = self.solver.solve(x, b)
+        self.solve_time += perf_counter() - t1
+        self.num_solves += 1
+        if self.telemetry is not None:
+            self.telemetry.record_solver(self.name, self)
+        return result
+
+    def mat_solve(self, A, B, X):
+        """Solve A*X = B for all columns of the dense matrices B and X
+        (KSPMatSolve). Counted as one solve for each column."""
+        self.set_operator(A)
+        t1 = perf_counter()
+        self.ksp().matSolve(B, X)
+        self.solve_time += perf_counter() - t1
+        num_rhs = B.getSize()[1]
+        self.num_solves += num_rhs
+        if self.telemetry is not None:
+            self.telemetry.record_solver(self.name, self, num_rhs)
+
+    def report(self):
+        return ("Solver {0}: {1:d} solves in {2:f} s, {3:d} preconditioner setups in {4:f} s").format(
+            self.name, self.num_solves, self.solve_time, self.num_setups, self.setup_time)
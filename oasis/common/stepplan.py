@@ -0,0 +1,142 @@
+"""
+Compiled dispatch of the solver functions and hooks called in the time loop.
+
+All solver functions and hooks take their arguments by name from the global
+namespace of the NSfracStep module, i.e., func(**vars()). Unpacking the
+complete namespace creates a new dictionary with hundreds of items for every
+call. A StepPlan inspects the signature of each function once and then
+calls it with only the arguments it actually needs, looked up by name in the
+live namespace. Functions that make use of their **NS_namespace dictionary
+are still called with the complete namespace.
+
+"""
+
+__license__ = "GNU Lesser GPL version 3 or any later version"
+
+import dis
+import inspect
+from time import perf_counter
+
+__all__ = ["StepPlan", "PlannedCall"]
+
+# Builtins that give a function access to more than its named arguments
+_namespace_builtins = ("vars", "locals", "eval", "exec")
+
+
+def uses_namespace(func, varkw):
+    """Return True if func makes use of its variable keyword dictionary."""
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return True
+
+    # Referenced from a nested function or comprehension
+    if varkw in code.co_cellvars:
+        return True
+
+    for ins in dis.get_instructions(code):
+        if ins.argval == varkw and ins.opname != "DELETE_FAST":
+            return True
+        if (ins.opname in ("LOAD_GLOBAL", "LOAD_NAME")
+                and ins.argval in _namespace_builtins):
+            return True
+    return False
+
+
+class PlannedCall(object):
+    """Call func with the named arguments it requires from namespace.
+
+    The signature of func is resolved once on creation. On each call the
+    current values are looked up by name in the namespace, so arguments
+    that are rebound in the time loop (t, tstep, ui, ...) are always
+    up to date.
+
+      compiled = False
+        Fall back to calling func with the complete namespace.
+
+      telemetry
+        Telemetry object that records the wall time of each call, under
+        the name of func, extended with the value of the namespace item
+        component if given (e.g., "velocity_tentative_solve:u0").
+
+    """
+
+    def __init__(self, func, namespace, compiled=True, telemetry=None,
+                 component=None):
+        self.func = func
+        self.name = getattr(func, "__name__", str(func))
+        self.namespace = namespace
+        self.telemetry = telemetry
+        self.component = component
+        self.required = []
+        self.optional = []
+        self.needs_namespace = not compiled
+        try:
+            signature = inspect.signature(func)
+        except (TypeError, ValueError):
+            self.needs_namespace = True
+            return
+
+        for name, par in signature.parameters.items():
+            if par.kind == par.VAR_KEYWORD:
+                if uses_namespace(func, name):
+                    self.needs_namespace = True
+            elif par.kind == par.VAR_POSITIONAL:
+                continue
+            elif par.default is par.empty:
+                self.required.append(name)
+            else:
+                self.optional.append(name)
+
+    def __call__(self):
+        if self.telemetry is None:
+            return self.call()
+
+        t0 = perf_counter()
+        result = self.call()
+        ns = self.namespace
+        name = self.name
+        if self.component is not None:
+            name += ":" + str(ns[self.component])
+        self.telemetry.add(name, perf_counter() - t0)
+        return result
+
+    def call(self):
+        ns = self.namespace
+        if self.needs_namespace:
+            return self.func(**ns)
+
+        try:
+            kwargs = {name: ns[name] for name in self.required}
+        except KeyError as e:
+            raise TypeError("{}() missing required argument {} in namespace".format(
+                self.func.__name__, e))
+
+        for name in self.optional:
+            if name in ns:
+                kwargs[name] = ns[name]
+        return self.func(**kwargs)
+
+
+class StepPlan(object):
+    """Collection of PlannedCalls for the functions named in names.
+
+    The functions are looked up once in the namespace and are afterwards
+    available as attributes, e.g.,
+
+        plan = StepPlan(vars(), ["pressure_solve"])
+        plan.pressure_solve()
+
+    components is a dictionary mapping function names to the name of the
+    component recorded by telemetry.
+
+    """
+
+    def __init__(self, namespace, names, compiled=True, telemetry=None,
+                 components={}):
+        self.names = tuple(names)
+        for name in self.names:
+            setattr(self, name, PlannedCall(namespace[name], namespace, compiled,
+                                            telemetry, components.get(name)))
+
+    def __iter__(self):
+        return iter((name, getattr(self, name)) for name in self.names)
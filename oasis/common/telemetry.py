@@ -0,0 +1,137 @@
+"""
+Machine readable timings and solver statistics for each timestep.
+
+A Telemetry object accumulates the wall time spent in each phase of a
+timestep (normally the solver functions and hooks called through a
+StepPlan), together with Krylov iteration counts and final residuals of the
+linear solvers. At the end of each timestep the timings are reduced across
+processes (min, max and mean) and rank 0 writes one JSON object per line
+to the file telemetry.jsonl in the results folder.
+
+Vectors and matrices allocated by the helpers used in the time loop are
+counted in allocations, and in telemetry as <kind>_allocations for the
+timestep they are allocated in.
+
+"""
+
+__license__ = "GNU Lesser GPL version 3 or any later version"
+
+import json
+from os import path
+from time import perf_counter
+import numpy as np
+from dolfin import MPI, as_backend_type
+
+__all__ = ["Telemetry", "get_ksp", "allocations"]
+
+
+def get_ksp(sol):
+    """Return the petsc4py KSP of linear algebra solver sol, or None."""
+    try:
+        if hasattr(sol, "ksp"):
+            return sol.ksp()
+        return as_backend_type(sol).ksp()
+    except Exception:
+        return None
+
+
+class Allocations(dict):
+    """Number of vectors and matrices allocated, for each kind.
+
+    Each allocation is also counted in telemetry (if set), such that
+    temporaries allocated every timestep show up in telemetry.jsonl.
+    """
+    telemetry = None
+
+    def add(self, kind, number=1):
+        self[kind] = self.get(kind, 0) + number
+        if self.telemetry is not None:
+            self.telemetry.count(kind + "_allocations", number)
+
+    def total(self):
+        return sum(self.values())
+
+
+allocations = Allocations()
+
+
+class Telemetry(object):
+    """Record wall time per phase and linear solver statistics.
+
+    Phases are added with add(name, seconds). Solver statistics are read
+    from the PETSc KSP with record_solver(name, sol) by the caller of each
+    solve (see ManagedKrylovSolver.solve and solve_multiple).
+
+    """
+
+    def __init__(self, folder, filename="telemetry.jsonl", comm=None):
+        from mpi4py import MPI as pyMPI
+        self.ops = (pyMPI.MIN, pyMPI.MAX, pyMPI.SUM)
+        self.comm = MPI.comm_world if comm is None else comm
+        self.size = self.comm.Get_size()
+        self.filename = path.join(folder, filename)
+        self.file = None
+        if self.comm.Get_rank() == 0:
+            self.file = open(self.filename, "w", buffering=1)
+        self.phases = {}
+        self.counters = {}
+        self.solvers = {}
+        self._step_start = perf_counter()
+
+    def add(self, phase, seconds):
+        """Add seconds of wall time to phase."""
+        self.phases[phase] = self.phases.get(phase, 0.) + seconds
+
+    def count(self, name, value):
+        """Add value to counter name (reduced across processes)."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_solver(self, name, sol, solves=1):
+        """Record iterations and final residual of the last solve with sol,
+        which solved for solves right hand sides."""
+        ksp = get_ksp(sol)
+        if ksp is None:
+            return
+        s = self.solvers.setdefault(name, dict(solves=0, iterations=0, residual=0.))
+        s["solves"] += solves
+        s["iterations"] += ksp.getIterationNumber()
+        s["residual"] = ksp.getResidualNorm()
+
+    def reduce(self, values):
+        """Return min, max and mean over all processes of values."""
+        local = np.array(values, dtype=float)
+        result = []
+        for op in self.ops:
+            glob = np.empty_like(local)
+            self.comm.Allreduce(local, glob, op=op)
+            result.append(glob)
+        result[2] /= self.size
+        return result
+
+    def end_step(self, tstep, t, dt, **info):
+        """Reduce and write all data of the current timestep."""
+        self.add("timestep", perf_counter() - self._step_start)
+        names = sorted(self.phases)
+        counters = sorted(self.counters)
+        mins, maxs, means = self.reduce([self.phases[n] for n in names]
+                                        + [self.counters[n] for n in counters])
+        if self.file is not None:
+            record = dict(tstep=tstep, t=t, dt=dt)
+            record.update(info)
+            stats = [dict(min=a, max=b, mean=c) for a, b, c in
+                     zip(mins.tolist(), maxs.tolist(), means.tolist())]
+            record["wall"] = dict(zip(names, stats[:len(names)]))
+            if counters:
+                record["counters"] = dict(zip(counters, stats[len(names):]))
+            record["solvers"] = self.solvers
+            self.file.write(json.dumps(record) + "\n")
+
+        self.phases = {}
+        self.counters = {}
+        self.solvers = {}
+        self._step_start = perf_counter()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,62 @@
+"""
+Update of the solution history without copying vectors.
+
+At the end of each timestep the solution is shifted back one time level,
+x_2 <- x_1 <- x_. Instead of copying the vectors, the TimeLevelRing holds
+the data of all levels in its own arrays, placed in the PETSc vectors with
+VecPlaceArray. A shift then only rotates which array is placed in which
+vector. The PETSc vectors, and thus all Functions and forms using them
+(u_1, u_2, U_AB etc.), remain the same objects.
+
+After a rotation the newest level is set to x_1 with one VecCopy, since x_
+is used as initial guess and by hooks at the start of the next timestep.
+This replaces the two copies (zero + axpy) of each component. The ghost
+values of all levels are updated after a rotation. The arrays cost one
+extra vector of memory for each time level.
+
+"""
+
+__license__ = "GNU Lesser GPL version 3 or any later version"
+
+import numpy as np
+from dolfin import as_backend_type
+
+__all__ = ["TimeLevelRing"]
+
+
+class TimeLevelRing(object):
+    """Rotate the arrays of time levels instead of copying data.
+
+      levels : List of lists of vectors, from newest to oldest, e.g.,
+               [[x_['u0'], x_1['u0'], x_2['u0']], [x_['c'], x_1['c']]]
+
+    """
+
+    def __init__(self, levels):
+        self.vectors = []
+        self.arrays = []
+        for level in levels:
+            vecs = [as_backend_type(x) for x in level]
+            arrays = []
+            for x in vecs:
+                vec = x.vec()
+                with vec.localForm() as loc:
+                    a = np.array(loc.getArray() if loc.handle else vec.getArray())
+                vec.placeArray(a)
+                arrays.append(a)
+            self.vectors.append(vecs)
+            self.arrays.append(arrays)
+
+    def rotate(self):
+        """Shift all time levels one step back and set x_ = x_1."""
+        for vecs, arrays in zip(self.vectors, self.arrays):
+            arrays.insert(0, arrays.pop())
+            for x, a in zip(vecs, arrays):
+                vec = x.vec()
+                vec.resetArray()
+                vec.placeArray(a)
+            vecs[1].vec().copy(vecs[0].vec())
+            # The ghost values of a rotated array may be from before the
+            # solve that set its owned values
+            for x in vecs:
+                x.update_ghost_values()
@@ -0,0 +1,136 @@
+"""
+Adaptive timestepping for the NSfracStep solvers controlled by the CFL number.
+
+The CFL number is computed cheaply from the velocity solution vectors and a
+length scale for each velocity degree of freedom, which is computed once.
+The timestep is then adjusted towards a target CFL number with bounded
+growth and shrink. Only solvers that handle a variable timestep (variable
+step Adams-Bashforth/Crank-Nicolson or BDF coefficients) may be used, see
+the variable_timestep attribute of the solver modules.
+
+"""
+
+__license__ = "GNU Lesser GPL version 3 or any later version"
+
+from dolfin import MPI, DOLFIN_EPS
+import numpy as np
+
+__all__ = ["CFLTimestepper", "dof_cell_size"]
+
+
+def dof_cell_size(V):
+    """Return the smallest size of all cells sharing each owned dof of V.
+
+    The cell size is divided by the polynomial degree of V, since the
+    distance between dofs on higher order elements is smaller than h.
+
+    """
+    mesh = V.mesh()
+    dofmap = V.dofmap()
+    start, end = dofmap.ownership_range()
+    n = end - start
+
+    # Cell size is the largest distance between two vertices (as Cell.h)
+    x = mesh.coordinates()[mesh.cells()]
+    nv = x.shape[1]
+    i, j = np.triu_indices(nv, 1)
+    cell_h = np.sqrt(((x[:, i] - x[:, j])**2).sum(axis=2)).max(axis=1)
+
+    # Smallest size of the cells sharing each dof
+    dofs = np.array([dofmap.cell_dofs(c) for c in range(mesh.num_cells())])
+    cell_h = np.repeat(cell_h, dofs.shape[1])
+    dofs = dofs.ravel()
+    owned = dofs < n
+    h = np.full(n, np.inf)
+    np.minimum.at(h, dofs[owned], cell_h[owned])
+
+    return h / max(V.ufl_element().degree(), 1)
+
+
+class CFLTimestepper(object):
+    """Compute new timesteps from the CFL number of the velocity solution.
+
+      CFL        : Target CFL number
+      dt_min     : Smallest allowed timestep
+      dt_max     : Largest allowed timestep
+      max_growth : Largest allowed factor of increase for one timestep
+      max_shrink : Smallest allowed factor of decrease for one timestep
+      tolerance  : Keep dt unless the relative change is larger than tolerance.
+                   Changing dt forces new coefficients for the time
+                   discretization, so small changes are not worth it.
+
+    """
+
+    def __init__(self, V, dt, CFL=0.5, dt_min=1e-8, dt_max=1e8,
+                 max_growth=1.2, max_shrink=0.5, tolerance=0.1, **kwargs):
+        assert 0 < max_shrink <= 1 <= max_growth
+        self.CFL_target = CFL
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.max_growth = max_growth
+        self.max_shrink = max_shrink
+        self.tolerance = tolerance
+        self.h_inv = 1. / dof_cell_size(V)
+        self.CFL = 0
+        self.CFL_max = 0
+        self.num_steps = 0
+        self.num_changes = 0
+        self.dt_smallest = dt
+        self.dt_largest = dt
+        self.dt_initial = dt
+        self.t_start = None
+        self.T = None
+
+    def compute_CFL(self, x_, u_components, dt):
+        """Return max(|u|/h)*dt over all processes."""
+        umag = np.zeros(len(self.h_inv))
+        for ui in u_components:
+            umag += x_[ui].get_local()**2
+        local_max = (np.sqrt(umag) * self.h_inv).max() if len(umag) > 0 else 0.
+        return MPI.max(MPI.comm_world, float(local_max)) * dt
+
+    def __call__(self, x_, u_components, t, dt, T):
+        """Return timestep to use for next timestep."""
+        if self.t_start is None:
+            self.t_start = t - dt
+        self.T = T
+        self.num_steps += 1
+        self.dt_smallest = min(self.dt_smallest, dt)
+        self.dt_largest = max(self.dt_largest, dt)
+        self.CFL = CFL = self.compute_CFL(x_, u_components, dt)
+        self.CFL_max = max(self.CFL_max, CFL)
+
+        factor = self.CFL_target / max(CFL, DOLFIN_EPS)
+        factor = min(max(factor, self.max_shrink), self.max_growth)
+        dt_new = min(max(dt * factor, self.dt_min), self.dt_max)
+        if abs(dt_new - dt) < self.tolerance * dt:
+            dt_new = dt
+
+        # Do not step past the end time
+        if t + dt_new > T and T - t > DOLFIN_EPS:
+            dt_new = T - t
+
+        if dt_new != dt:
+            self.num_changes += 1
+        return dt_new
+
+    def report(self, wall_time):
+        """Return string with statistics of the timesteps used.
+
+        The wall time saved is estimated as the wall time per timestep times
+        the number of timesteps saved compared to a fixed timestep equal to
+        the initial dt. For a measured comparison with a fixed timestep see
+        benchmarks/adaptive_timestep.py.
+
+        """
+        per_step = wall_time / max(self.num_steps, 1)
+        fixed_steps = 0
+        if self.T is not None:
+            fixed_steps = int(np.ceil((self.T - self.t_start) / self.dt_initial
+                                      - DOLFIN_EPS))
+        saved = (fixed_steps - self.num_steps) * per_step
+        return ("Adaptive timestepping: {0:d} timesteps ({1:d} changes of dt, max CFL = {2:2.4f}), "
+                "dt in [{3:2.4e}, {4:2.4e}], wall time per timestep = {5:2.4e}, "
+                "estimated wall time saved = {6:2.4e} ({7:d} timesteps with fixed dt = {8:2.4e})").format(
+            self.num_steps, self.num_changes, self.CFL_max, self.dt_smallest,
+            self.dt_largest, per_step, saved, fixed_steps, self.dt_initial)
@@ -7,31 +7,259 @@ from dolfin import (assemble, KrylovSolver, LUSolver,  Function,
     TrialFunction,TestFunction, dx, Vector, Matrix,
     FunctionSpace, Timer, div, Form, inner, grad,
     as_backend_type, VectorFunctionSpace, FunctionAssigner, PETScKrylovSolver,
-    PETScPreconditioner, DirichletBC)
+    PETScPreconditioner, DirichletBC, PETScMatrix, MPI, FacetNormal, ds)
+from dolfin import __version__ as dolfin_version
 
 from ufl.tensors import ListTensor
 from ufl import Coefficient
+from os import path, makedirs, remove, replace
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+from time import perf_counter
+from sys import getrefcount
+import hashlib
+from oasis.problems import matrix_memory, info_red
+from .telemetry import allocations
+
+
+def matrix_cache_key(form, bcs):
+    """Return hash identifying the assembled matrix of form with bcs applied.
+
+    The hash is computed from the form signature (including the elements),
+    the mesh, the dofmaps of the arguments (i.e., partitioning and
+    constrained domains), the boundary values of the bcs, the number of
+    processes and the versions of dolfin and PETSc.
+    """
+    from petsc4py import PETSc
+    h = hashlib.sha1(form.signature().encode())
+    for arg in form.arguments():
+        dofmap = arg.function_space().dofmap()
+        h.update(repr(dofmap.ownership_range()).encode())
+        h.update(dofmap.tabulate_local_to_global_dofs().tobytes())
+
+    mesh = form.arguments()[0].function_space().mesh()
+    h.update(mesh.coordinates().tobytes())
+    h.update(mesh.cells().tobytes())
+    for bc in bcs:
+        h.update(repr(sorted(bc.get_boundary_values().items())).encode())
+
+    comm = MPI.comm_world
+    versions = repr((dolfin_version, PETSc.Sys.getVersion()))
+    key = "".join(comm.allgather(h.hexdigest())) + versions
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def save_matrix(A, filename):
+    """Store matrix A in PETSc binary format."""
+    from petsc4py import PETSc
+    comm = MPI.comm_world
+    tmpfile = filename + ".tmp"
+    viewer = PETSc.Viewer().createBinary(tmpfile, "w", comm=comm)
+    as_backend_type(A).mat().view(viewer)
+    viewer.destroy()
+    MPI.barrier(comm)
+    # Move complete file in place, such that an interrupted save is never loaded
+    if MPI.rank(comm) == 0:
+        replace(tmpfile, filename)
+        if path.exists(tmpfile + ".info"):
+            remove(tmpfile + ".info")
+    MPI.barrier(comm)
+
+
+def load_matrix(filename, form):
+    """Return matrix of form stored in filename, or None if not found."""
+    comm = MPI.comm_world
+    if MPI.min(comm, int(path.exists(filename))) == 0:
+        return None
+
+    from petsc4py import PETSc
+    spaces = [arg.function_space() for arg in form.arguments()]
+    sizes = [V.dofmap().ownership_range() for V in spaces]
+    mat = PETSc.Mat().create(comm=comm)
+    mat.setSizes([(r[1] - r[0], None) for r in sizes])
+    mat.setType("aij")
+    viewer = PETSc.Viewer().createBinary(filename, "r", comm=comm)
+    mat.load(viewer)
+    viewer.destroy()
+    lgmaps = [PETSc.LGMap().create(V.dofmap().tabulate_local_to_global_dofs(),
+                                   comm=comm) for V in spaces]
+    mat.setLGMap(*lgmaps)
+    return Matrix(PETScMatrix(mat))
+
+
+def solver_memory(sol):
+    """Return bytes of memory used by factorizations in solver sol."""
+    try:
+        ksp = sol.ksp() if hasattr(sol, "ksp") else as_backend_type(sol).ksp()
+        F = ksp.getPC().getFactorMatrix()
+        info = F.getInfo()
+        return max(int(info["memory"]), int(info["nz_allocated"] * 12))
+    except Exception:
+        return 0
+
+
+class LRU_cache_dict(OrderedDict):
+    """Dictionary of objects built on first access and stored for reuse.
+
+    Subclasses implement build(key) and nbytes(value). The cache counts hits
+    and misses and the time spent building each entry. If memory_budget
+    (in MB) is set, the least recently used entries are evicted when the
+    memory of all entries exceeds the budget. Only rebuildable entries are
+    evicted, i.e., entries created by build that are not referenced outside
+    the cache, since evicting an object still in use frees no memory.
+    Entries set explicitly with cache[key] = value are never evicted.
+    """
+
+    def __init__(self, name):
+        OrderedDict.__init__(self)
+        self.name = name
+        self.memory_budget = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stats = {}
+
+    def set_memory_budget(self, memory_budget):
+        """Set memory budget in MB (None for unlimited)."""
+        self.memory_budget = memory_budget
+        self.evict()
+
+    def __getitem__(self, key):
+        if key in self:
+            self.hits += 1
+            self.stats[key]["hits"] += 1
+            self.move_to_end(key)
+            return OrderedDict.__getitem__(self, key)
+
+        self.misses += 1
+        t0 = perf_counter()
+        value = self.build(key)
+        OrderedDict.__setitem__(self, key, value)
+        self.stats[key] = dict(hits=0, build_time=perf_counter() - t0,
+                               rebuildable=True)
+        self.evict(keep=key)
+        return value
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self.stats[key] = dict(hits=0, build_time=0., rebuildable=False)
+
+    def __delitem__(self, key):
+        OrderedDict.__delitem__(self, key)
+        self.stats.pop(key, None)
+
+    def memory(self, key):
+        """Return bytes of memory used by entry key on this process."""
+        try:
+            return self.nbytes(OrderedDict.__getitem__(self, key))
+        except Exception:
+            return 0
+
+    def total_memory(self):
+        return sum(self.memory(key) for key in self)
+
+    def evict(self, keep=None):
+        """Evict least recently used entries until within memory budget."""
+        if self.memory_budget is None:
+            return
+        budget = self.memory_budget * 1024**2
+        total = self.total_memory()
+        for key in list(self):
+            if total <= budget:
+                break
+            value = OrderedDict.__getitem__(self, key)
+            # References: cache, value and argument to getrefcount
+            if (key == keep or not self.stats[key]["rebuildable"]
+                    or getrefcount(value) > 3):
+                continue
+            total -= self.memory(key)
+            del value
+            del self[key]
+            self.evictions += 1
+
+    def report(self):
+        """Return string with memory, hits and build time for all entries.
+
+        Memory is summed over all processes, so this must be called on all
+        processes.
+        """
+        comm = MPI.comm_world
+        lines = []
+        total = 0
+        for i, key in enumerate(self):
+            mem = MPI.sum(comm, float(self.memory(key))) / 1024**2
+            total += mem
+            st = self.stats[key]
+            lines.append("  {0:3d} {1:10.3f} MB {2:6d} hits {3:10.4f} s  {4}".format(
+                i, mem, st["hits"], st["build_time"], self.describe(key)))
+        head = ("{0}: {1:d} entries using {2:.3f} MB, {3:d} hits, {4:d} misses, "
+                "{5:d} evictions").format(self.name, len(self), total, self.hits,
+                                           self.misses, self.evictions)
+        return "\n".join([head] + lines)
+
+    def describe(self, key):
+        return str(key[0])[:60]
+
+    def build(self, key):
+        raise NotImplementedError
+
+    def nbytes(self, value):
+        raise NotImplementedError
+
 
 # Create some dictionaries to hold work matrices
-class Mat_cache_dict(dict):
-    """Items in dictionary are matrices stored for efficient reuse."""
+class Mat_cache_dict(LRU_cache_dict):
+    """Items in dictionary are matrices stored for efficient reuse.
+
+    If folder is set, then matrices of forms without coefficients are
+    also stored on disk in folder, and loaded instead of assembled on the
+    next run. Files are named by matrix_cache_key, so any change of mesh,
+    partitioning, form, elements or bcs leads to a new file.
+    """
+    folder = None
+
+    def __init__(self):
+        LRU_cache_dict.__init__(self, "A_cache")
 
-    def __missing__(self, key):
+    def set_folder(self, folder):
+        """Use folder as persistent matrix cache (None to switch off)."""
+        if folder is not None and MPI.rank(MPI.comm_world) == 0:
+            if not path.exists(folder):
+                makedirs(folder)
+        MPI.barrier(MPI.comm_world)
+        self.folder = folder
+
+    def build(self, key):
         form, bcs = key
+        filename = None
+        if self.folder is not None and len(form.coefficients()) == 0:
+            filename = path.join(self.folder, matrix_cache_key(form, bcs) + ".dat")
+            A = load_matrix(filename, form)
+            if A is not None:
+                return A
+
         A = assemble(form)
         for bc in bcs:
             bc.apply(A)
 
-        self[key] = A
-        return self[key]
+        if filename is not None:
+            save_matrix(A, filename)
+
+        return A
+
+    def nbytes(self, A):
+        return matrix_memory(A)
 
 
 # Create some dictionaries to hold solvers used for projection
-class Solver_cache_dict(dict):
+class Solver_cache_dict(LRU_cache_dict):
     """Items in dictionary are Linear algebra solvers stored for efficient reuse.
     """
 
-    def __missing__(self, key):
+    def __init__(self):
+        LRU_cache_dict.__init__(self, "Solver_cache")
+
+    def build(self, key):
         assert len(key) == 4
         form, bcs, solver_type, preconditioner_type = key
         prec = PETScPreconditioner(preconditioner_type)
@@ -43,8 +271,13 @@ class Solver_cache_dict(dict):
         sol.parameters["error_on_nonconvergence"] = False
         sol.parameters["monitor_convergence"] = False
         sol.parameters["report"] = False
-        self[key] = sol
-        return self[key]
+        return sol
+
+    def nbytes(self, sol):
+        return solver_memory(sol)
+
+    def describe(self, key):
+        return "{} {}: {}".format(key[2], key[3], str(key[0])[:40])
 
 
 A_cache = Mat_cache_dict()
@@ -58,6 +291,466 @@ def assemble_matrix(form, bcs=[]):
     return A_cache[(form, tuple(bcs))]
 
 
+# Dense blocks used by solve_multiple for each matrix. The blocks are freed
+# with the matrix
+solve_blocks = WeakKeyDictionary()
+
+
+def solve_multiple(sol, A, x, b):
+    """Solve A*x[i] = b[i] for all i, using one call to the linear algebra
+    solver sol if possible.
+
+    Krylov solvers use KSPMatSolve (requires PETSc >= 3.14), which may use
+    a block Krylov method. A ManagedKrylovSolver solves through its
+    mat_solve, which counts the solves and rebuilds the preconditioner as
+    for sol.solve. Otherwise the systems are solved one after another. The
+    solver must already have been used once through sol.solve, such that
+    the parameters of sol are set on the PETSc KSP. The dense blocks
+    holding b and x are allocated (and counted in allocations) on the
+    first call for each A.
+
+    """
+    ksp = sol.ksp() if hasattr(sol, "ksp") else None
+    if (len(x) == 1 or ksp is None or not hasattr(ksp, "matSolve") or
+            not getattr(sol, "multiple_rhs_ready", False)):
+        for xi, bi in zip(x, b):
+            sol.solve(A, xi, bi)
+        if ksp is not None:
+            sol.multiple_rhs_ready = True
+        return
+
+    from petsc4py import PETSc
+    blocks = solve_blocks.setdefault(A, {})
+    if len(b) not in blocks:
+        bv = as_backend_type(b[0]).vec()
+        B = PETSc.Mat().createDense((bv.getSizes(), (None, len(b))),
+                                    comm=bv.getComm())
+        B.setUp()
+        blocks[len(b)] = (B, B.duplicate())
+        allocations.add("dense_block", 2)
+
+    B, X = blocks[len(b)]
+    Ba, Xa = B.getDenseArray(), X.getDenseArray()
+    for j, (xi, bi) in enumerate(zip(x, b)):
+        Ba[:, j] = as_backend_type(bi).vec().array_r
+        Xa[:, j] = as_backend_type(xi).vec().array_r
+    B.assemble()
+    X.assemble()
+
+    if hasattr(sol, "mat_solve"):
+        sol.mat_solve(A, B, X)
+    else:
+        sol.set_operator(A)
+        ksp.matSolve(B, X)
+
+    Xa = X.getDenseArray()
+    for j, xi in enumerate(x):
+        with as_backend_type(xi).vec() as xa:
+            xa[:] = Xa[:, j]
+
+
+# Create a dictionary to hold work vectors
+class Work_vector_dict(dict):
+    """Work vectors reused between calls, one for each vector layout and tag.
+
+    A work vector with the layout of vector x is obtained as
+    work_vectors[(x, tag)]. Different tags give different vectors, such
+    that nested helpers never share a work vector. Vectors are only
+    allocated on first use, and each allocation is counted in allocations
+    as work_vector.
+    """
+
+    def __getitem__(self, key):
+        x, tag = key
+        layout = (tag, x.size(), x.local_range())
+        if layout not in self:
+            dict.__setitem__(self, layout, Vector(x))
+            allocations.add("work_vector")
+        return dict.__getitem__(self, layout)
+
+
+work_vectors = Work_vector_dict()
+
+
+def matvec_axpy(a, A, x, y):
+    """Compute y += a*A*x using a work vector from the pool."""
+    w = work_vectors[(y, "matvec_axpy")]
+    A.mult(x, w)
+    y.axpy(a, w)
+
+
+def waxpy(w, a, x, y):
+    """Compute w = a*x + y in place (VecWAXPY). w must differ from x and y."""
+    as_backend_type(w).vec().waxpy(a, as_backend_type(x).vec(),
+                                   as_backend_type(y).vec())
+
+
+def pointwise_mult(w, x, y):
+    """Compute w = x*y elementwise in place."""
+    as_backend_type(w).vec().pointwiseMult(as_backend_type(x).vec(),
+                                           as_backend_type(y).vec())
+
+
+def matvec_add(A, x, y, z):
+    """Compute z = y + A*x with one call to PETSc (MatMultAdd), without
+    temporary vectors. y and z may be the same vector.
+    """
+    as_backend_type(A).mat().multAdd(as_backend_type(x).vec(),
+                                     as_backend_type(y).vec(),
+                                     as_backend_type(z).vec())
+
+
+# Dense blocks used by matvec_add_multiple for each matrix. The blocks are
+# freed with the matrix
+dense_blocks = WeakKeyDictionary()
+
+
+def matvec_add_multiple(A, xs, ys, zs, a=1., batched=True):
+    """Compute zs[j] = ys[j] + a*A*xs[j] for all j. ys and zs may be the same.
+
+    With batched=True all products are computed with one sparse matrix
+    times dense matrix product (MatMatMult), such that A is read from memory
+    once instead of once for each vector. The dense blocks holding the
+    vectors are allocated (and counted in allocations) on the first call
+    for each A. The vectors are
+    copied straight into the columns of the block, and the columns of the
+    product are added to zs in place.
+    """
+    if not batched:
+        for x, y, z in zip(xs, ys, zs):
+            if a == 1.:
+                matvec_add(A, x, y, z)
+            else:
+                if z is not y:
+                    z.zero()
+                    z.axpy(1., y)
+                matvec_axpy(a, A, x, z)
+        return
+
+    from petsc4py import PETSc
+    blocks = dense_blocks.setdefault(A, {})
+    if len(xs) not in blocks:
+        x = as_backend_type(xs[0]).vec()
+        X = PETSc.Mat().createDense((x.getSizes(), (None, len(xs))),
+                                    comm=x.getComm())
+        X.setUp()
+        X.assemble()
+        blocks[len(xs)] = [X, None]
+        allocations.add("dense_block")
+
+    block = blocks[len(xs)]
+    X = block[0]
+    Xa = X.getDenseArray()
+    for j, x in enumerate(xs):
+        Xa[:, j] = as_backend_type(x).vec().array_r
+    if block[1] is None:
+        allocations.add("dense_block")
+    block[1] = Y = as_backend_type(A).mat().matMult(X, block[1])
+    Ya = Y.getDenseArray()
+    if a != 1.:
+        Ya *= a
+    for j, (y, z) in enumerate(zip(ys, zs)):
+        z = as_backend_type(z).vec()
+        with z as za:
+            if y is not zs[j]:
+                za[:] = as_backend_type(y).vec().array_r
+            za += Ya[:, j]
+
+
+def matvec_transpose_add(A, x, y, z):
+    """Compute z = y + A^T*x with one call to PETSc (MatMultTransposeAdd).
+    y and z may be the same vector.
+    """
+    as_backend_type(A).mat().multTransposeAdd(as_backend_type(x).vec(),
+                                              as_backend_type(y).vec(),
+                                              as_backend_type(z).vec())
+
+
+_combine_code = """
+#include <algorithm>
+#include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+#include <dolfin/la/PETScMatrix.h>
+#include <petscmat.h>
+
+namespace py = pybind11;
+
+// The sequential AIJ blocks holding the local values of A
+std::vector<Mat> local_blocks(Mat A)
+{
+  PetscBool mpi;
+  PetscObjectTypeCompare((PetscObject) A, MATMPIAIJ, &mpi);
+  if (!mpi)
+    return {A};
+  Mat Ad, Ao;
+  const PetscInt* colmap;
+  MatMPIAIJGetSeqAIJ(A, &Ad, &Ao, &colmap);
+  return {Ad, Ao};
+}
+
+PetscInt num_values(Mat A)
+{
+  MatInfo info;
+  MatGetInfo(A, MAT_LOCAL, &info);
+  return (PetscInt) info.nz_used;
+}
+
+// True if the row pointers and column indices of two sequential AIJ
+// blocks are equal
+bool same_block_pattern(Mat A, Mat X)
+{
+  PetscInt na, nx;
+  const PetscInt *ia, *ja, *ix, *jx;
+  PetscBool done_a, done_x;
+  MatGetRowIJ(A, 0, PETSC_FALSE, PETSC_FALSE, &na, &ia, &ja, &done_a);
+  MatGetRowIJ(X, 0, PETSC_FALSE, PETSC_FALSE, &nx, &ix, &jx, &done_x);
+  bool same = done_a && done_x && na == nx
+    && std::equal(ia, ia + na + 1, ix)
+    && std::equal(ja, ja + ia[na], jx);
+  MatRestoreRowIJ(A, 0, PETSC_FALSE, PETSC_FALSE, &na, &ia, &ja, &done_a);
+  MatRestoreRowIJ(X, 0, PETSC_FALSE, PETSC_FALSE, &nx, &ix, &jx, &done_x);
+  return same;
+}
+
+// True if A and X are AIJ matrices with the same local sparsity pattern
+bool same_pattern(std::shared_ptr<dolfin::PETScMatrix> A,
+                  std::shared_ptr<dolfin::PETScMatrix> X)
+{
+  PetscBool aij_a, aij_x;
+  PetscObjectTypeCompareAny((PetscObject) A->mat(), &aij_a, MATSEQAIJ, MATMPIAIJ, "");
+  PetscObjectTypeCompareAny((PetscObject) X->mat(), &aij_x, MATSEQAIJ, MATMPIAIJ, "");
+  if (!aij_a || !aij_x)
+    return false;
+
+  std::vector<Mat> a_blocks = local_blocks(A->mat());
+  std::vector<Mat> x_blocks = local_blocks(X->mat());
+  if (a_blocks.size() != x_blocks.size())
+    return false;
+  for (std::size_t b = 0; b < a_blocks.size(); ++b)
+    if (!same_block_pattern(a_blocks[b], x_blocks[b]))
+      return false;
+
+  if (a_blocks.size() == 2)
+  {
+    // Global columns of the off-diagonal blocks
+    Mat Ad, Ao, Xd, Xo;
+    const PetscInt *colmap_a, *colmap_x;
+    PetscInt m, na, nx;
+    MatMPIAIJGetSeqAIJ(A->mat(), &Ad, &Ao, &colmap_a);
+    MatMPIAIJGetSeqAIJ(X->mat(), &Xd, &Xo, &colmap_x);
+    MatGetSize(Ao, &m, &na);
+    MatGetSize(Xo, &m, &nx);
+    if (na != nx || !std::equal(colmap_a, colmap_a + na, colmap_x))
+      return false;
+  }
+  return true;
+}
+
+// Set A = alpha*A + c[0]*X[0] + c[1]*X[1] + ... in one pass over the values
+void combine(std::shared_ptr<dolfin::PETScMatrix> A, double alpha,
+             std::vector<double> c,
+             std::vector<std::shared_ptr<dolfin::PETScMatrix>> X)
+{
+  std::vector<Mat> a_blocks = local_blocks(A->mat());
+  std::vector<std::vector<Mat>> x_blocks;
+  for (auto& Xj : X)
+    x_blocks.push_back(local_blocks(Xj->mat()));
+
+  for (std::size_t b = 0; b < a_blocks.size(); ++b)
+  {
+    const PetscInt n = num_values(a_blocks[b]);
+    std::vector<PetscScalar*> x(X.size());
+    for (std::size_t j = 0; j < X.size(); ++j)
+    {
+      if (num_values(x_blocks[j][b]) != n)
+        throw std::runtime_error("Matrices must have the same sparsity pattern");
+      MatSeqAIJGetArray(x_blocks[j][b], &x[j]);
+    }
+
+    PetscScalar* a;
+    MatSeqAIJGetArray(a_blocks[b], &a);
+    for (PetscInt i = 0; i < n; ++i)
+    {
+      PetscScalar s = alpha*a[i];
+      for (std::size_t j = 0; j < X.size(); ++j)
+        s += c[j]*x[j][i];
+      a[i] = s;
+    }
+    MatSeqAIJRestoreArray(a_blocks[b], &a);
+    for (std::size_t j = 0; j < X.size(); ++j)
+      MatSeqAIJRestoreArray(x_blocks[j][b], &x[j]);
+  }
+  PetscObjectStateIncrease((PetscObject) A->mat());
+}
+
+PYBIND11_MODULE(SIGNATURE, m)
+{
+  m.def("combine", &combine);
+  m.def("same_pattern", &same_pattern);
+}
+"""
+_combine_module = []
+
+# Result of the sparsity pattern comparison for each pair of matrices
+_same_pattern = WeakKeyDictionary()
+
+
+def combine_matrices(A, terms):
+    """Set A = c_0*X_0 + c_1*X_1 + ... for terms [(c_0, X_0), (c_1, X_1), ...].
+
+    A may be one of the X_i. A is computed with a compiled loop over the
+    matrix values, which is one pass over A and each X_i, instead of one
+    pass over A for each term (MatAXPY). The loop is used for the X_i that
+    are AIJ matrices with the same sparsity pattern as A, which is checked
+    once for each pair of matrices. MatAXPY is used for the other X_i, and
+    for all if the loop cannot be compiled.
+    """
+    if not _combine_module:
+        try:
+            from dolfin import compile_cpp_code
+            _combine_module.append(compile_cpp_code(_combine_code))
+        except Exception as e:
+            info_red("Could not compile combine_matrices ({}). Using MatAXPY".format(e))
+            _combine_module.append(None)
+
+    module = _combine_module[0]
+    Aa = as_backend_type(A)
+    handle = Aa.mat().handle
+    patterns = _same_pattern.setdefault(A, WeakKeyDictionary())
+    alpha, c, X, others = 0., [], [], []
+    for ci, Xi in terms:
+        Xa = as_backend_type(Xi)
+        if Xa.mat().handle == handle:
+            alpha += ci
+        elif ci == 0:
+            continue
+        else:
+            if module is not None and Xi not in patterns:
+                patterns[Xi] = module.same_pattern(Aa, Xa)
+            if module is not None and patterns[Xi]:
+                c.append(ci)
+                X.append(Xa)
+            else:
+                others.append((ci, Xa))
+
+    if module is not None:
+        module.combine(Aa, alpha, c, X)
+    else:
+        Aa *= alpha
+    for ci, Xa in others:
+        Aa.axpy(ci, Xa, False)
+    if others:
+        # The pattern of A may have grown
+        del _same_pattern[A]
+
+
+# Preconditioners that work with symmetric (SBAIJ) storage
+symmetric_preconditioners = ("default", "jacobi", "icc", "sor", "none")
+
+
+def as_symmetric_storage(A, preconditioner_type="default"):
+    """Return symmetric matrix A in symmetric storage (SBAIJ).
+
+    Only the upper triangle is stored, which halves the memory and the
+    memory traffic of matvecs. The matrix cannot be used with axpy on
+    general (AIJ) matrices, or with preconditioners that require AIJ
+    (e.g., hypre_amg and ilu). A is returned unchanged if
+    preconditioner_type is not one of symmetric_preconditioners.
+    Note that a matrix with Dirichlet bcs applied is not symmetric.
+    """
+    from petsc4py import PETSc
+    if preconditioner_type not in symmetric_preconditioners:
+        info_red("Symmetric storage not used with preconditioner " +
+                 preconditioner_type)
+        return A
+    mat = as_backend_type(A).mat()
+    mat.setOption(PETSc.Mat.Option.SYMMETRIC, True)
+    return PETScMatrix(mat.convert(PETSc.Mat.Type.SBAIJ))
+
+
+def hrz_lumped_mass(Mass, bcs=[]):
+    """Return the diagonal of the HRZ lumped mass matrix of Mass.
+
+    HRZ lumping scales the diagonal of each element mass matrix such that
+    its sum equals the element volume. The scaling factor is the same for
+    all cells of an affine simplex mesh, so the lumped mass matrix is the
+    diagonal of the global mass matrix scaled by total mass / trace. All
+    entries are positive for any degree of the Lagrange elements, unlike
+    the row-sum lumping that gives zero or negative entries for P2.
+    Entries of dofs in bcs are set to 1. The mesh must be an affine simplex
+    mesh.
+    """
+    domain = Mass.ufl_domain()
+    assert (domain.ufl_cell().is_simplex() and
+            domain.ufl_coordinate_element().degree() == 1), \
+        "HRZ lumping requires a simplex mesh with affine cells"
+    M = A_cache[(Mass, ())]
+    ML = Vector()
+    M.init_vector(ML, 0)
+    M.get_diagonal(ML)
+    ones = Vector(ML)
+    ones[:] = 1.
+    ML *= (M * ones).sum() / ML.sum()
+    if len(bcs) > 0:
+        ml = ML.get_local()
+        for bc in bcs:
+            dofs = [dof for dof in bc.get_boundary_values().keys()
+                    if dof < len(ml)]
+            ml[dofs] = 1.
+        ML.set_local(ml)
+        ML.apply("insert")
+    return ML
+
+
+def weighted_average_matrix(mesh):
+    """Return matrix W that maps DG0 to CG1 by weighted averaging.
+
+    For b with b[c] = int_c f dx, W*b is the average in each CG1 dof i of
+    the cell means of f, weighted by A[i, c] = int_c phi_i dx. That is,
+    W = diag(1/rowsum(A)) * A * diag(1/|c|). W is computed once for each
+    mesh and stored in A_cache.
+    """
+    DG = FunctionSpace(mesh, 'DG', 0)
+    form = TrialFunction(DG) * TestFunction(FunctionSpace(mesh, 'CG', 1)) * dx()
+    key = (form, ("weighted_average",))
+    if key not in A_cache:
+        W = assemble(form)
+        volume = assemble(TestFunction(DG) * dx())
+        ones = Vector(volume)
+        ones[:] = 1.
+        rowsum = W * ones
+        for v in (rowsum, volume):
+            v.set_local(1. / v.get_local())
+            v.apply("insert")
+        as_backend_type(W).mat().diagonalScale(as_backend_type(rowsum).vec(),
+                                               as_backend_type(volume).vec())
+        A_cache[key] = W
+    return A_cache[key]
+
+
+def project_multiple(functions):
+    """Compute the projections of all OasisFunctions in functions.
+
+    The right hand sides must be assembled. Functions that use the
+    default method with the same matrix and solver are solved with one
+    call to solve_multiple.
+
+    """
+    groups = {}
+    for f in functions:
+        if f.method.lower() == "default":
+            groups.setdefault((id(f.A), id(f.sol)), []).append(f)
+        else:
+            f(assemb_rhs=False)
+
+    for group in groups.values():
+        for f in group:
+            for bc in f.bcs:
+                bc.apply(f.rhs)
+        solve_multiple(group[0].sol, group[0].A, [f.vector() for f in group],
+                       [f.rhs for f in group])
+
+
 class OasisFunction(Function):
     """Function with more or less efficient projection methods
     of associated linear form.
@@ -71,7 +764,8 @@ class OasisFunction(Function):
         and preconditioner_type
 
       method = "lumping"
-        Solve through lumping of mass matrix
+        Solve through lumping of mass matrix. Row-sum lumping for
+        linear elements and HRZ lumping for higher degrees
 
     """
 
@@ -99,11 +793,13 @@ class OasisFunction(Function):
                 bcs), solver_type, preconditioner_type)]
 
         elif method.lower() == "lumping":
-            assert Space.ufl_element().degree() < 2
-            self.A = A_cache[(Mass, tuple(bcs))]
-            ones = Function(Space)
-            ones.vector()[:] = 1.
-            self.ML = self.A * ones.vector()
+            if Space.ufl_element().degree() < 2:
+                self.A = A_cache[(Mass, tuple(bcs))]
+                ones = Function(Space)
+                ones.vector()[:] = 1.
+                self.ML = self.A * ones.vector()
+            else:
+                self.ML = hrz_lumped_mass(Mass, bcs)
             self.ML.set_local(1. / self.ML.array())
 
     def assemble_rhs(self):
@@ -112,8 +808,7 @@ class OasisFunction(Function):
         """
         if not self.matvec[0] is None:
             mat, func = self.matvec
-            self.rhs.zero()
-            self.rhs.axpy(1.0, mat * func.vector())
+            mat.mult(func.vector(), self.rhs)
 
         else:
             assemble(self.bf, tensor=self.rhs)
@@ -134,8 +829,7 @@ class OasisFunction(Function):
             self.sol.solve(self.A, self.vector(), self.rhs)
 
         else:
-            self.vector().zero()
-            self.vector().axpy(1.0, self.rhs * self.ML)
+            pointwise_mult(self.vector(), self.rhs, self.ML)
 
 
 class GradFunction(OasisFunction):
@@ -191,8 +885,7 @@ class GradFunction(OasisFunction):
 
         if not self.matvec[0] is None:
             mat, func = self.matvec
-            self.rhs.zero()
-            self.rhs.axpy(1.0, mat * func.vector())
+            mat.mult(func.vector(), self.rhs)
         else:
             assemble(self.bf, tensor=self.rhs)
 
@@ -202,8 +895,7 @@ class GradFunction(OasisFunction):
             self.bf = u.dx(self.i) * self.test * dx()
 
         if self.method.lower() == "gradient_matrix":
-            self.vector().zero()
-            self.vector().axpy(1.0, self.WGM * self.matvec[1].vector())
+            self.WGM.mult(self.matvec[1].vector(), self.vector())
         else:
             OasisFunction.__call__(self, assemb_rhs=assemb_rhs)
 
@@ -214,6 +906,17 @@ class DivFunction(OasisFunction):
 
     Typically used for computing divergence of velocity on pressure function space.
 
+    With method['transposed_gradient'] = True the rhs is computed from the
+    gradient matrices of GradFunction, through integration by parts
+
+        div(u)*q*dx = -sum_i u[i]*q.dx(i)*dx + sum_i u[i]*q*n[i]*ds
+
+    The gradient matrices are shared with GradFunction (through A_cache)
+    and the boundary matrices only have rows for dofs on the boundary.
+    Periodic boundaries cancel in the assembled boundary matrices. This
+    only saves memory if the gradient matrices are assembled anyway, so it
+    is off by default.
+
     """
 
     def __init__(self, u_, Space, bcs=[], name="div", method={}):
@@ -222,15 +925,27 @@ class DivFunction(OasisFunction):
         preconditioner_type = method.get('preconditioner_type', 'default')
         solver_method = method.get('method', 'default')
         low_memory_version = method.get('low_memory_version', False)
+        self.transposed_gradient = method.get('transposed_gradient', False)
 
         OasisFunction.__init__(self, div(u_), Space, bcs=bcs, name=name,
                                method=solver_method, solver_type=solver_type,
                                preconditioner_type=preconditioner_type)
 
         Source = u_[0].function_space()
-        if not low_memory_version:
+        dim = Space.mesh().geometry().dim()
+        if not low_memory_version and self.transposed_gradient:
+            # Same forms as GradFunction(p_, Source, i) with p_ on Space
+            st = TrialFunction(Space)
+            v = TestFunction(Source)
+            n = FacetNormal(Space.mesh())
+            self.matvec = [[A_cache[(v * st.dx(i) * dx, ())], u_[i]]
+                           for i in range(dim)]
+            self.boundary = [A_cache[(self.test * TrialFunction(Source) * n[i] * ds, ())]
+                             for i in range(dim)]
+
+        elif not low_memory_version:
             self.matvec = [[A_cache[(self.test * TrialFunction(Source).dx(i) * dx, ())], u_[i]]
-                           for i in range(Space.mesh().geometry().dim())]
+                           for i in range(dim)]
 
         if solver_method.lower() == "gradient_matrix":
             from fenicstools import compiled_gradient_module
@@ -248,10 +963,20 @@ class DivFunction(OasisFunction):
         """
         Assemble right hand side (form*test*dx) in projection
         """
-        if not self.matvec[0] is None:
-            self.rhs.zero()
-            for mat, vec in self.matvec:
-                self.rhs.axpy(1.0, mat * vec.vector())
+        if not self.matvec[0] is None and self.transposed_gradient:
+            mat, vec = self.matvec[0]
+            mat.transpmult(vec.vector(), self.rhs)
+            for mat, vec in self.matvec[1:]:
+                matvec_transpose_add(mat, vec.vector(), self.rhs, self.rhs)
+            self.rhs *= -1.
+            for mat, (_, vec) in zip(self.boundary, self.matvec):
+                matvec_add(mat, vec.vector(), self.rhs, self.rhs)
+
+        elif not self.matvec[0] is None:
+            mat, vec = self.matvec[0]
+            mat.mult(vec.vector(), self.rhs)
+            for mat, vec in self.matvec[1:]:
+                matvec_add(mat, vec.vector(), self.rhs, self.rhs)
 
         else:
             assemble(self.bf, tensor=self.rhs)
@@ -262,10 +987,10 @@ class DivFunction(OasisFunction):
             # Note that assembling rhs is not necessary using gradient_matrix
             if assemb_rhs:
                 self.assemble_rhs()
-            self.vector().zero()
-            for i in range(self.function_space().mesh().geometry().dim()):
-                self.vector().axpy(
-                    1., self.WGM[i] * self.matvec[i][1].vector())
+            self.WGM[0].mult(self.matvec[0][1].vector(), self.vector())
+            for i in range(1, self.function_space().mesh().geometry().dim()):
+                matvec_add(self.WGM[i], self.matvec[i][1].vector(),
+                           self.vector(), self.vector())
 
         else:
             OasisFunction.__call__(self, assemb_rhs=assemb_rhs)
@@ -277,6 +1002,13 @@ class CG1Function(OasisFunction):
 
     Typically used for computing turbulent viscosity in LES.
 
+    Methods are those of OasisFunction and
+      - "WeightedAverage": Weighted average of the cell means of form,
+        see weighted_average_matrix.
+      - "vertex": Evaluate form in the vertices of each cell (vertex
+        quadrature), and average over the cells of each dof, weighted
+        by int_c phi_i dx. Same as lumping with vertex quadrature.
+
     """
 
     def __init__(self, form, mesh, bcs=[], name="CG1", method={}, bounded=False):
@@ -287,19 +1019,20 @@ class CG1Function(OasisFunction):
         self.bounded = bounded
 
         Space = FunctionSpace(mesh, "CG", 1)
+        vertex = solver_method.lower() == "vertex"
         OasisFunction.__init__(self, form, Space,
                                bcs=bcs, name=name,
-                               method=solver_method, solver_type=solver_type,
+                               method="lumping" if vertex else solver_method,
+                               solver_type=solver_type,
                                preconditioner_type=preconditioner_type)
 
-        if solver_method.lower() == "weightedaverage":
-            from fenicstools import compiled_gradient_module
+        if vertex:
+            self.bf = inner(form, self.test) * dx(scheme="vertex", degree=1)
+
+        elif solver_method.lower() == "weightedaverage":
             DG = FunctionSpace(mesh, 'DG', 0)
-            # Cannot use cache. Matrix will be modified
-            self.A = assemble(TrialFunction(DG) * self.test * dx())
-            self.dg = dg = Function(DG)
-            compiled_gradient_module.compute_DG0_to_CG_weight_matrix(
-                self.A, dg)
+            self.A = weighted_average_matrix(mesh)
+            self.dg = Function(DG)
             self.bf_dg = inner(form, TestFunction(DG)) * dx()
 
     def __call__(self):
@@ -308,8 +1041,7 @@ class CG1Function(OasisFunction):
             assemble(self.bf_dg, tensor=self.dg.vector())
 
             # Compute weighted average on CG1
-            self.vector().zero()
-            self.vector().axpy(1.0, self.A * self.dg.vector())
+            self.A.mult(self.dg.vector(), self.vector())
             self.vector().apply("insert")
             [bc.apply(self.vector()) for bc in self.bcs]
 
@@ -92,7 +92,7 @@ def initialize(q_, q_1, q_2, VV, initial_fields, OasisFunction, **NS_namespace):
 
 def temporal_hook(u_, p_, tstep, plot_interval, print_dkdt_info, nu,
                   dt, t, oasis_memory, kin, **NS_namespace):
-    oasis_memory("tmp", True)
+    oasis_memory("tmp", tstep % print_dkdt_info == 0)
     if (tstep % print_dkdt_info == 0 or
             tstep % print_dkdt_info == 1):
         kinetic = assemble(0.5 * dot(u_, u_) * dx) / (2 * pi)**3
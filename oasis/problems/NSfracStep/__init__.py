@@ -18,13 +18,42 @@ NS_parameters.update(
     AB_projection_pressure=False,
     solver="IPCS_ABCN",  # "IPCS_ABCN", "IPCS_ABE", "IPCS", "Chorin", "BDFPC", "BDFPC_Fast"
 
+    # Adapt dt to a target CFL number (only IPCS_ABCN, IPCS_ABE and BDFPC_Fast)
+    adaptive_timestep=dict(
+        active=False,
+        CFL=0.5,          # Target CFL number
+        dt_min=1e-8,      # Smallest allowed timestep
+        dt_max=1e8,       # Largest allowed timestep
+        max_growth=1.2,   # Largest increase of dt in one timestep
+        max_shrink=0.5,   # Largest decrease of dt in one timestep
+        tolerance=0.1),   # Keep dt unless the relative change is larger
+
     # Parameters used to tweek solver
     max_iter=1,                 # Number of inner pressure velocity iterations on timestep
     max_error=1e-6,             # Tolerance for inner iterations (pressure velocity iterations)
     iters_on_first_timestep=2,  # Number of iterations on first timestep
     use_krylov_solvers=True,    # Otherwise use LU-solver
+    matrix_cache_folder=None,   # Folder for storing constant matrices between runs
+    cache_memory_budget=None,   # Max MB kept in each of A_cache and Solver_cache
+    report_cache=False,         # Print memory, hits and build time of cached entries
+    report_memory=False,        # Print memory use per phase and of PETSc objects
+
+    # Initial guess for Krylov solvers of pressure and tentative velocity
+    # ("previous", "extrapolation" or "projection" of initial_guess_history solutions)
+    pressure_initial_guess="previous",
+    velocity_initial_guess="previous",
+    initial_guess_history=3,
     print_intermediate_info=10,
     print_velocity_pressure_convergence=False,
+    record_telemetry=False,     # Write timings and solver statistics to telemetry.jsonl
+    use_step_plan=True,         # Resolve arguments of solver functions and hooks once
+    solve_multiple_rhs=False,   # Solve all components sharing a matrix in one call (not with hooks)
+    fused_assembly=False,       # Combine mass, diffusion, convection and LES matrices in one pass
+    batched_matvec=False,       # Velocity rhs matvecs as one MatMatMult per matrix
+    precomputed_convection=False,  # Convection matrix from precomputed element data
+    time_level_ring=False,      # Shift x_1, x_2 by rotating arrays (one extra vector per level)
+    symmetric_storage=False,    # Store constant symmetric Ap and LES filter matrix in SBAIJ format
+    split_forms=False,          # Naive solvers: preassemble constant parts of forms
 
     # Parameters used to tweek output
     plot_interval=10,
@@ -32,6 +61,8 @@ NS_parameters.update(
     save_step=10,        # Store solution each save_step
     restart_folder=None, # If restarting solution, set the folder holding the solution to start from here
     output_timeseries_as_vector=True,  # Store velocity as vector in Timeseries
+    async_output=False,       # Write Timeseries from dedicated writer processes
+    async_output_buffers=2,   # Number of solutions that may wait for writing
 
     # Choose LES model and set default parameters
     # NoModel, Smagorinsky, Wale, DynamicLagrangian, ScaleDepDynamicLagrangian
@@ -40,7 +71,8 @@ NS_parameters.update(
     # LES model parameters
     Smagorinsky=dict(Cs=0.1677),              # Standard Cs, same as OpenFOAM
     Wale=dict(Cw=0.325),
-    DynamicSmagorinsky=dict(Cs_comp_step=1),  # Time step interval for Cs to be recomputed
+    DynamicSmagorinsky=dict(Cs_comp_step=1,   # Time step interval for Cs to be recomputed
+                            strain_solver='default'),  # Or 'cached', 'lumping'
     KineticEnergySGS=dict(Ck=0.08, Ce=1.05),
 
     # Parameter set when enabling test mode
@@ -61,22 +93,29 @@ NS_parameters.update(
         method='default',  # "lumping", "gradient_matrix"
         solver_type='cg',
         preconditioner_type='jacobi',
-        low_memory_version=False),
+        low_memory_version=False,
+        transposed_gradient=False),  # Divergence rhs from gradient matrices (opt-in)
 
+    # preconditioner_refresh: Rebuild preconditioner every n'th timestep (0 for once)
     velocity_krylov_solver=dict(
         solver_type='bicgstab',
-        preconditioner_type='jacobi'),
+        preconditioner_type='jacobi',
+        preconditioner_refresh=1),
 
+    # boomeramg: options -pc_hypre_boomeramg_<key>, e.g., strong_threshold=0.5
     pressure_krylov_solver=dict(
         solver_type='gmres',
-        preconditioner_type='hypre_amg'),
+        preconditioner_type='hypre_amg',
+        preconditioner_refresh=0,
+        boomeramg=dict()),
 
     scalar_krylov_solver=dict(
         solver_type='bicgstab',
-        preconditioner_type='jacobi'),
+        preconditioner_type='jacobi',
+        preconditioner_refresh=1),
 
     nut_krylov_solver=dict(
-        method='WeightedAverage',  # Or 'default'
+        method='WeightedAverage',  # Or 'default', 'lumping', 'vertex'
         solver_type='cg',
         preconditioner_type='jacobi'),
 )
@@ -5,8 +5,9 @@ __license__ = "GNU Lesser GPL version 3 or any later version"
 
 from dolfin import *
 import subprocess
-from os import getpid, path
-from collections import defaultdict
+import importlib
+from os import getpid, path, sysconf
+from collections import defaultdict, OrderedDict
 from numpy import array, maximum, zeros
 
 # UnitSquareMesh(20, 20) # Just due to MPI bug on Scinet
@@ -17,7 +18,10 @@ from numpy import array, maximum, zeros
 # except:
 
 
-def getMemoryUsage(rss=True):
+_page_size = sysconf("SC_PAGE_SIZE")
+
+
+def _getMemoryUsage_ps(rss=True):
     mypid = str(getpid())
     rss = "rss" if rss else "vsz"
     process = subprocess.Popen(['ps', '-o', rss, mypid],
@@ -27,6 +31,109 @@ def getMemoryUsage(rss=True):
     return eval(mymemory) / 1024
 
 
+def getMemoryUsage(rss=True):
+    """Return resident (rss=True) or virtual memory of this process in MB.
+
+    Read from /proc/self/statm, falling back on ps where /proc is missing.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            size, resident = f.read().split()[:2]
+    except (IOError, OSError):
+        return _getMemoryUsage_ps(rss)
+    return int(resident if rss else size) * _page_size / 1024.**2
+
+
+def getPeakMemoryUsage():
+    """Return peak resident memory (high water mark) of this process in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    import resource
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def resetPeakMemoryUsage():
+    """Reset the high water mark of resident memory, if allowed (Linux >= 4.0).
+
+    Returns False if the peak could not be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def getMemoryDetails():
+    """Return dictionary of Rss, Pss, Shared and Anonymous memory in MB.
+
+    Read from /proc/self/smaps_rollup (Linux >= 4.14), empty if missing.
+    Pss divides shared pages between the processes sharing them, which
+    avoids counting shared libraries once per MPI process.
+    """
+    details = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Anonymous"):
+                    details[key] = int(value.split()[0]) / 1024.
+    except (IOError, OSError):
+        pass
+    return details
+
+
+def matrix_memory(A):
+    """Return bytes of memory used by PETSc matrix A on this process."""
+    info = as_backend_type(A).mat().getInfo()
+    # Newer PETSc does not track memory in MatInfo, so estimate from nonzeros
+    rows = A.local_range(0)
+    estimate = info["nz_allocated"] * 12 + (rows[1] - rows[0]) * 4
+    return max(int(info["memory"]), int(estimate))
+
+
+def petsc_memory(namespace):
+    """Return bytes of memory used by the PETSc matrices and vectors found in
+    namespace, including in dictionaries, lists and tuples of the namespace.
+    Each object is counted once.
+    """
+    seen = set()
+    memory = dict(matrices=0, vectors=0)
+
+    def add(obj):
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        try:
+            if isinstance(obj, GenericMatrix):
+                memory["matrices"] += matrix_memory(obj)
+            elif isinstance(obj, GenericVector):
+                memory["vectors"] += obj.local_size() * 8
+            elif isinstance(obj, Function):
+                add(obj.vector())
+        except Exception:
+            # Not a PETSc object
+            pass
+
+    for obj in list(namespace.values()):
+        if isinstance(obj, dict):
+            for o in list(obj.values()):
+                add(o)
+        elif isinstance(obj, (list, tuple)):
+            for o in obj:
+                add(o)
+        else:
+            add(obj)
+    return memory
+
+
 parameters["linear_algebra_backend"] = "PETSc"
 parameters["form_compiler"]["optimize"] = True
 parameters["form_compiler"]["cpp_optimize"] = True
@@ -91,20 +198,89 @@ class OasisTimer(Timer):
 
 
 class OasisMemoryUsage:
+    """Track memory use of this process, in total and for phases of a run.
+
+    Calls only read /proc on this process. Memory is summed over all
+    processes (self.memory, self.memory_vm) only when printing (verbose)
+    or in reduce and report, which must be called on all processes.
+
+    Phases are started with begin_phase(name), which ends the current
+    phase. The resident memory at the start and end, and the peak resident
+    memory during each phase are recorded.
+    """
+
     def __init__(self, s):
         self.memory = 0
         self.memory_vm = 0
+        self.local = 0
+        self.local_vm = 0
+        self.phases = OrderedDict()
+        self.phase = None
+        self.reset_peak = resetPeakMemoryUsage()
         self(s)
 
     def __call__(self, s, verbose=False):
-        self.prev = self.memory
-        self.prev_vm = self.memory_vm
-        self.memory = MPI.sum(MPI.comm_world, getMemoryUsage())
-        self.memory_vm = MPI.sum(MPI.comm_world, getMemoryUsage(False))
-        if MPI.rank(MPI.comm_world) == 0 and verbose:
-            info_blue('{0:26s}  {1:10d} MB {2:10d} MB {3:10d} MB {4:10d} MB'.format(s,
-                        int(self.memory - self.prev), int(self.memory),
-                        int(self.memory_vm - self.prev_vm), int(self.memory_vm)))
+        self.local = getMemoryUsage()
+        self.local_vm = getMemoryUsage(False)
+        if self.phase is not None:
+            ph = self.phases[self.phase]
+            ph["peak"] = max(ph["peak"], self.local)
+        if verbose:
+            prev, prev_vm = self.memory, self.memory_vm
+            self.reduce()
+            if MPI.rank(MPI.comm_world) == 0:
+                info_blue('{0:26s}  {1:10d} MB {2:10d} MB {3:10d} MB {4:10d} MB'.format(s,
+                            int(self.memory - prev), int(self.memory),
+                            int(self.memory_vm - prev_vm), int(self.memory_vm)))
+
+    def reduce(self):
+        """Sum memory use of last call over all processes."""
+        self.memory = MPI.sum(MPI.comm_world, self.local)
+        self.memory_vm = MPI.sum(MPI.comm_world, self.local_vm)
+
+    def begin_phase(self, name):
+        self.end_phase()
+        self.reset_peak = resetPeakMemoryUsage()
+        rss = getMemoryUsage()
+        self.phases[name] = dict(start=rss, end=rss, peak=rss)
+        self.phase = name
+
+    def end_phase(self):
+        if self.phase is None:
+            return
+        ph = self.phases[self.phase]
+        ph["end"] = getMemoryUsage()
+        # The high water mark covers the whole run if it could not be reset
+        peak = getPeakMemoryUsage() if self.reset_peak else 0
+        ph["peak"] = max(ph["peak"], ph["end"], peak)
+        self.phase = None
+
+    def report(self, namespace=None):
+        """Print memory use per phase and of PETSc objects.
+
+        Increase and peak are summed over processes, and the largest
+        peak of any single process is listed as well. Must be called on
+        all processes.
+        """
+        self.end_phase()
+        comm = MPI.comm_world
+        info_blue('{0:26s}  {1:>13s} {2:>13s} {3:>13s}'.format(
+            'Memory use per phase', 'Increase', 'Peak', 'Max rank peak'))
+        for name, ph in self.phases.items():
+            info_blue('{0:26s}  {1:10.1f} MB {2:10.1f} MB {3:10.1f} MB'.format(
+                name, MPI.sum(comm, ph["end"] - ph["start"]),
+                MPI.sum(comm, ph["peak"]), MPI.max(comm, ph["peak"])))
+
+        details = getMemoryDetails()
+        if "Pss" in details:
+            info_blue('{0:26s}  {1:10.1f} MB'.format(
+                'Proportional set size', MPI.sum(comm, details["Pss"])))
+
+        if namespace is not None:
+            mem = petsc_memory(namespace)
+            for key in ("matrices", "vectors"):
+                total = MPI.sum(comm, float(mem[key])) / 1024.**2
+                info_blue('{0:26s}  {1:10.1f} MB'.format('PETSc ' + key, total))
 
 
 # Print memory use up til now
@@ -145,6 +321,7 @@ def recursive_update(dst, src):
 class OasisXDMFFile(XDMFFile, object):
     def __init__(self, comm, filename):
         XDMFFile.__init__(self, comm, filename)
+        self.filename = filename
 
 def add_function_to_tstepfiles(function, newfolder, tstepfiles, tstep):
     name = function.name()
@@ -207,6 +384,14 @@ def post_import_problem(NS_parameters, mesh, commandline_kwargs,
         else:
             NS_parameters[key] = val
 
+    # Adaptive timestepping requires a solver that handles a variable dt
+    if NS_parameters.get('adaptive_timestep', {}).get('active', False):
+        solver = importlib.import_module('.'.join(('oasis.solvers.NSfracStep',
+                                                   NS_parameters['solver'])))
+        if not getattr(solver, 'variable_timestep', False):
+            raise ValueError("adaptive_timestep is not implemented for solver "
+                             + NS_parameters['solver'])
+
     # If the mesh is a callable function, then create the mesh here.
     if callable(mesh):
         mesh = mesh(**NS_parameters)
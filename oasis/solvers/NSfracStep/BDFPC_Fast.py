@@ -8,13 +8,36 @@ differencing solver with pressure correction in rotational form.
 """
 from dolfin import *
 from .IPCS_ABCN import *  # reuse code from IPCS_ABCN
-from .IPCS_ABCN import __all__, attach_pressure_nullspace
+from .IPCS_ABCN import (__all__, attach_pressure_nullspace,
+                        symmetric_pressure_matrix)
+
+# The timestep may change between timesteps (adaptive_timestep)
+variable_timestep = True
+
+
+def bdf_coefficients(beta, dt, dt_1):
+    """Return coefficients (a0, a1, a2) of the BDF2 scheme
+
+        du/dt = (a0*u - a1*u_1 + a2*u_2) / dt
+
+    for a variable timestep, where dt_1 is the previous timestep.
+    For beta = 3 (Euler on first timestep) the coefficients are
+    3/beta, 4/beta and 1/beta.
+
+    """
+    if beta(0) > 2.:
+        return 3. / beta(0), 4. / beta(0), 1. / beta(0)
+    w = dt / dt_1
+    return (1. + 2. * w) / (1. + w), 1. + w, w**2 / (1. + w)
 
 
 def setup(u_components, u, v, p, q, nu, nut_, LESsource,
           bcs, scalar_components, V, Q, x_, u_, p_, q_1, q_2,
           velocity_update_solver, assemble_matrix, les_model,
-          DivFunction, GradFunction, homogenize, **NS_namespace):
+          DivFunction, GradFunction, homogenize,
+          precomputed_convection, ConvectionOperator,
+          symmetric_storage, as_symmetric_storage, use_krylov_solvers,
+          pressure_krylov_solver, A_cache, **NS_namespace):
     """Set up all equations to be solved."""
 
     # Mass matrix
@@ -36,6 +59,9 @@ def setup(u_components, u, v, p, q, nu, nut_, LESsource,
             Ap.compressed(Bp)
             Ap = Bp
 
+    # Store pressure Laplacian in symmetric storage if possible
+    Ap = symmetric_pressure_matrix(**vars())
+
     # Allocate coefficient matrix (needs reassembling)
     A = Matrix(M)
 
@@ -79,17 +105,22 @@ def setup(u_components, u, v, p, q, nu, nut_, LESsource,
     u_convecting = as_vector([Function(V) for i in range(len(u_components))])
     a_conv = inner(v, dot(u_convecting, nabla_grad(u))) * dx  # Faster version
     a_scalar = inner(v, dot(u_, nabla_grad(u))) * dx
+    convection = (ConvectionOperator(V, u_convecting)
+                  if precomputed_convection else None)
     LT = None if les_model is "NoModel" else LESsource(
         (nu + nut_), u_convecting, V, name='LTd')
-    d.update(u_convecting=u_convecting, a_conv=a_conv,
+    d.update(u_convecting=u_convecting, a_conv=a_conv, convection=convection,
              a_scalar=a_scalar, LT=LT, KT=KT)
     return d
 
 
-def assemble_first_inner_iter(A, a_conv, dt, M, scalar_components, KT, LT,
+def assemble_first_inner_iter(A, a_conv, dt, dt_1, M, scalar_components, KT, LT,
                               a_scalar, K, nu, u_components, les_model, nut_,
                               b_tmp, b0, x_1, x_2, u_convecting,
-                              bcs, beta, **NS_namespace):
+                              bcs, beta, b, matvec_add_multiple,
+                              batched_matvec, convection, fused_assembly,
+                              combine_matrices,
+                              **NS_namespace):
     """Called on first inner iteration of velocity/pressure system.
 
     Assemble convection matrix, compute rhs of tentative velocity and
@@ -97,13 +128,18 @@ def assemble_first_inner_iter(A, a_conv, dt, M, scalar_components, KT, LT,
 
     """
     t0 = Timer("Assemble first inner iter")
-    # Update u_convecting used as convecting velocity
+    a0, a1, a2 = bdf_coefficients(beta, dt, dt_1)
+    # Update u_convecting used as convecting velocity (extrapolated to t)
+    w = dt / dt_1
     for i, ui in enumerate(u_components):
         u_convecting[i].vector().zero()
-        u_convecting[i].vector().axpy(2.0, x_1[ui])
-        u_convecting[i].vector().axpy(-1.0, x_2[ui])
+        u_convecting[i].vector().axpy(1.0 + w, x_1[ui])
+        u_convecting[i].vector().axpy(-w, x_2[ui])
 
-    assemble(a_conv, tensor=A)
+    if convection is not None:
+        convection.assemble(A)
+    else:
+        assemble(a_conv, tensor=A)
 
     # Set up scalar matrix
     if len(scalar_components) > 0:
@@ -114,22 +150,35 @@ def assemble_first_inner_iter(A, a_conv, dt, M, scalar_components, KT, LT,
         else:
             assemble(a_scalar, tensor=Ta)
 
-    # Compute rhs for all velocity components
+    # Compute rhs for all velocity components, with one matvec of
+    # M*(a1*x_1 - a2*x_2)/dt. b is only used as work vector here
+    for ui in u_components:
+        b[ui].zero()
+        b[ui].axpy(a1 / dt, x_1[ui])
+        b[ui].axpy(-a2 / dt, x_2[ui])
+    # start with body force
+    matvec_add_multiple(M, [b[ui] for ui in u_components],
+                        [b0[ui] for ui in u_components],
+                        [b_tmp[ui] for ui in u_components], batched=batched_matvec)
     for ui in u_components:
-        b_tmp[ui].zero()              # start with body force
-        b_tmp[ui].axpy(1., b0[ui])
-        b_tmp[ui].axpy(4.0 / (beta(0) * dt), M * x_1[ui])
-        b_tmp[ui].axpy(-1.0 / (beta(0) * dt), M * x_2[ui])
         if not les_model is "NoModel":
             LT.assemble_rhs(i)
             b_tmp[ui].axpy(1., LT.vector())
 
-    A.axpy(nu, K, True)
     if not les_model is "NoModel":
         assemble(nut_ * KT[1] * dx, tensor=KT[0])
-        A.axpy(1., KT[0], True)
 
-    A.axpy(3.0 / beta(0) / dt, M, True)
+    if fused_assembly:
+        # Add mass, diffusion and LES in one pass
+        terms = [(1., A), (a0 / dt, M), (nu, K)]
+        if not les_model is "NoModel":
+            terms.append((1., KT[0]))
+        combine_matrices(A, terms)
+    else:
+        A.axpy(nu, K, True)
+        A.axpy(a0 / dt, M, True)
+        if not les_model is "NoModel":
+            A.axpy(1., KT[0], True)
     [bc.apply(A) for bc in bcs['u0']]
 
 
@@ -141,18 +190,23 @@ def velocity_tentative_assemble(ui, b, b_tmp, x_, gradp, p_, **NS_namespace):
     b[ui].axpy(-1., gradp[ui].rhs)
 
 
-def pressure_assemble(b, dt, divu, beta, Ap, x_, nu, u_, q, **NS_namespace):
+def pressure_assemble(b, dt, dt_1, divu, beta, Ap, x_, nu, u_, q, work_vectors,
+                      waxpy, matvec_add, **NS_namespace):
     """Assemble rhs of pressure equation."""
+    a0 = bdf_coefficients(beta, dt, dt_1)[0]
     divu()  # Both computes div(u_) and the rhs div(u_)*q*dx
     b['p'][:] = divu.rhs
-    b['p'] *= (-3.0 / beta(0) / dt)
-    b['p'].axpy(1., Ap * x_['p'])
+    b['p'] *= (-a0 / dt)
+    # Add Ap*(x_p - nu*divu) with one matvec
     # There's a small difference here from BDFPC in the assembling of divu
-    b['p'].axpy(-nu, Ap * divu.vector())  # This is fast
+    w = work_vectors[(x_['p'], 'pressure')]
+    waxpy(w, -nu, divu.vector(), x_['p'])
+    matvec_add(Ap, w, b['p'], b['p'])  # This is fast
     # b['p'].axpy(-nu, assemble(inner(grad(div(u_)), grad(q))*dx)) # This is exact
 
 
-def pressure_solve(dp_, x_, Ap, b, p_sol, bcs, nu, divu, Q, beta, **NS_namespace):
+def pressure_solve(dp_, x_, Ap, b, p_sol, bcs, nu, divu, Q, beta, dt, dt_1,
+                   initial_guess, inner_iter, **NS_namespace):
     """Solve pressure equation."""
     [bc.apply(b['p']) for bc in bcs['p']]
     dp_.vector().zero()
@@ -162,9 +216,15 @@ def pressure_solve(dp_, x_, Ap, b, p_sol, bcs, nu, divu, Q, beta, **NS_namespace
     if hasattr(Ap, 'null_space'):
         Ap.null_space.orthogonalize(b['p'])
 
+    # Initial guess from previous timesteps
+    if 'p' in initial_guess and inner_iter == 1:
+        initial_guess['p'](Ap, b['p'], x_['p'])
+
     t1 = Timer("Pressure Linear Algebra Solve")
     p_sol.solve(Ap, x_['p'], b['p'])
     t1.stop()
+    if 'p' in initial_guess:
+        initial_guess['p'].record(p_sol, Ap, x_['p'], inner_iter > 1)
     # LUSolver use normalize directly for normalization of pressure
     if hasattr(p_sol, 'normalize'):
         normalize(x_['p'])
@@ -173,13 +233,20 @@ def pressure_solve(dp_, x_, Ap, b, p_sol, bcs, nu, divu, Q, beta, **NS_namespace
     dpv *= -1
     dpv.axpy(1.0, x_['p'])
     dpv.axpy(nu, divu.vector())
-    dpv *= (beta(0) / 3.0)  # To reuse code from IPCS_ABCN
+    dpv *= (1. / bdf_coefficients(beta, dt, dt_1)[0])  # To reuse code from IPCS_ABCN
 
 
-def velocity_update(u_components, bcs, dp_, dt, x_, gradp, beta, **NS_namespace):
+def velocity_update(u_components, bcs, dp_, dt, x_, gradp, beta, solve_multiple_rhs,
+                    project_multiple, **NS_namespace):
     """Update the velocity after regular pressure velocity iterations."""
+    if solve_multiple_rhs:
+        for ui in u_components:
+            gradp[ui].assemble_rhs(dp_)
+        project_multiple([gradp[ui] for ui in u_components])
+
     for ui in u_components:
-        gradp[ui](dp_)     # Computes gradient of pressure correction
+        if not solve_multiple_rhs:
+            gradp[ui](dp_)     # Computes gradient of pressure correction
         x_[ui].axpy(-dt, gradp[ui].vector())
         [bc.apply(x_[ui]) for bc in bcs[ui]]
     beta.assign(2.0)
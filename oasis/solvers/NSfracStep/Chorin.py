@@ -22,7 +22,8 @@ iters_on_first_timestep = 1
 
 def setup(u, q_, q_1, uc_comp, u_components, dt, v, U_AB, u_1,
           nu, p_, dp_, mesh, f, fs, q, p, u_, Schmidt,
-          scalar_components, **NS_namespace):
+          scalar_components, split_forms, SplitForm,
+          **NS_namespace):
     """Set up all equations to be solved."""
     # Implicit Crank Nicholson velocity at t - dt/2
     U_CN = dict((ui, 0.5 * (u + q_1[ui])) for ui in uc_comp)
@@ -52,30 +53,36 @@ def setup(u, q_, q_1, uc_comp, u_components, dt, v, U_AB, u_1,
                  + nu / Schmidt[ci] * inner(grad(U_CN[ci]),
                             grad(vw)) * dx - inner(fs[ci], vw) * dx)
 
+    if split_forms:
+        # Preassemble constant parts of all forms
+        F = {ui: SplitForm(form) for ui, form in F.items()}
+        Fu = {ui: SplitForm(form) for ui, form in Fu.items()}
+        Fp = SplitForm(Fp)
+
     return dict(F=F, Fu=Fu, Fp=Fp)
 
 
-def velocity_tentative_solve(ui, F, q_, bcs, x_, b_tmp, udiff, **NS_namespace):
+def velocity_tentative_solve(ui, F, q_, bcs, x_, b_tmp, udiff, solve_form, **NS_namespace):
     """Linear algebra solve of tentative velocity component."""
     b_tmp[ui][:] = x_[ui]
-    A, L = system(F[ui])
-    solve(A == L, q_[ui], bcs[ui])
-    udiff[0] += norm(b_tmp[ui] - x_[ui])
+    solve_form(F[ui], q_[ui], bcs[ui])
+    b_tmp[ui].axpy(-1., x_[ui])
+    udiff[0] += norm(b_tmp[ui])
 
 
-def pressure_solve(Fp, p_, bcs, **NS_namespace):
+def pressure_solve(Fp, p_, bcs, solve_form, **NS_namespace):
     """Solve pressure equation."""
-    solve(lhs(Fp) == rhs(Fp), p_, bcs['p'])
+    solve_form(Fp, p_, bcs['p'])
     if bcs['p'] == []:
         normalize(p_.vector())
 
 
-def velocity_update(u_components, q_, bcs, Fu, **NS_namespace):
+def velocity_update(u_components, q_, bcs, Fu, solve_form, **NS_namespace):
     """Update the velocity after finishing pressure velocity iterations."""
     for ui in u_components:
-        solve(lhs(Fu[ui]) == rhs(Fu[ui]), q_[ui], bcs[ui])
+        solve_form(Fu[ui], q_[ui], bcs[ui])
 
 
-def scalar_solve(ci, F, q_, bcs, **NS_namespace):
+def scalar_solve(ci, F, q_, bcs, solve_form, **NS_namespace):
     """Solve scalar equation."""
-    solve(lhs(F[ci]) == rhs(F[ci]), q_[ci], bcs[ci])
+    solve_form(F[ci], q_[ci], bcs[ci])
@@ -16,7 +16,8 @@ from ..NSfracStep import __all__
 
 def setup(u, q_, q_1, uc_comp, u_components, dt, v, U_AB, u_1, u_2, q_2,
           nu, p_, dp_, mesh, f, fs, q, p, u_, Schmidt, Schmidt_T, les_model, nut_,
-          scalar_components, **NS_namespace):
+          scalar_components, split_forms, SplitForm,
+          **NS_namespace):
     """Set up all equations to be solved."""
     # Implicit Crank Nicolson velocity at t - dt/2
     U_CN = dict((ui, 0.5 * (u + q_1[ui])) for ui in uc_comp)
@@ -57,21 +58,27 @@ def setup(u, q_, q_1, uc_comp, u_components, dt, v, U_AB, u_1, u_2, q_2,
                  * inner(grad(U_CN[ci]), grad(vw)) * dx - inner(fs[ci], vw) * dx)
             #-(nu/Schmidt[ci]+nut_/Schmidt_T[ci])*inner(dot(grad(U_CN[ci]), n), vw)*ds
 
+    if split_forms:
+        # Preassemble constant parts of all forms
+        F = {ui: SplitForm(form) for ui, form in F.items()}
+        Fu = {ui: SplitForm(form) for ui, form in Fu.items()}
+        Fp = SplitForm(Fp)
+
     return dict(F=F, Fu=Fu, Fp=Fp)
 
 
-def velocity_tentative_solve(ui, F, q_, bcs, x_, b_tmp, udiff, **NS_namespace):
+def velocity_tentative_solve(ui, F, q_, bcs, x_, b_tmp, udiff, solve_form, **NS_namespace):
     """Linear algebra solve of tentative velocity component."""
     b_tmp[ui][:] = x_[ui]
-    A, L = system(F[ui])
-    solve(A == L, q_[ui], bcs[ui])
-    udiff[0] += norm(b_tmp[ui] - x_[ui])
+    solve_form(F[ui], q_[ui], bcs[ui])
+    b_tmp[ui].axpy(-1., x_[ui])
+    udiff[0] += norm(b_tmp[ui])
 
 
-def pressure_solve(Fp, p_, bcs, dp_, x_, u_, q_, Q, **NS_namespace):
+def pressure_solve(Fp, p_, bcs, solve_form, dp_, x_, u_, q_, Q, **NS_namespace):
     """Solve pressure equation."""
     dp_.vector()[:] = x_['p']
-    solve(lhs(Fp) == rhs(Fp), p_, bcs['p'])
+    solve_form(Fp, p_, bcs['p'])
     if bcs['p'] == []:
         normalize(p_.vector())
     dpv = dp_.vector()
@@ -79,12 +86,12 @@ def pressure_solve(Fp, p_, bcs, dp_, x_, u_, q_, Q, **NS_namespace):
     dpv.axpy(1.0, x_['p'])
 
 
-def velocity_update(u_components, q_, bcs, Fu, dp_, V, dt, **NS_namespace):
+def velocity_update(u_components, q_, bcs, Fu, solve_form, dp_, V, dt, **NS_namespace):
     """Update the velocity after finishing pressure velocity iterations."""
     for ui in u_components:
-        solve(lhs(Fu[ui]) == rhs(Fu[ui]), q_[ui], bcs[ui])
+        solve_form(Fu[ui], q_[ui], bcs[ui])
 
 
-def scalar_solve(ci, F, q_, bcs, **NS_namespace):
+def scalar_solve(ci, F, q_, bcs, solve_form, **NS_namespace):
     """Solve scalar equation."""
-    solve(lhs(F[ci]) == rhs(F[ci]), q_[ci], bcs[ci])
+    solve_form(F[ci], q_[ci], bcs[ci])
@@ -6,12 +6,19 @@ __license__ = "GNU Lesser GPL version 3 or any later version"
 from dolfin import *
 from ..NSfracStep import *
 from ..NSfracStep import __all__
+from oasis.problems import info_blue
+
+# The timestep may change between timesteps (adaptive_timestep)
+variable_timestep = True
 
 
 def setup(u_components, u, v, p, q, bcs, les_model, nu, nut_,
           scalar_components, V, Q, x_, p_, u_, A_cache,
           velocity_update_solver, assemble_matrix, homogenize,
-          GradFunction, DivFunction, LESsource, **NS_namespace):
+          GradFunction, DivFunction, LESsource, Schmidt,
+          precomputed_convection, ConvectionOperator,
+          symmetric_storage, as_symmetric_storage, use_krylov_solvers,
+          pressure_krylov_solver, **NS_namespace):
     """Preassemble mass and diffusion matrices.
 
     Set up and prepare all equations to be solved. Called once, before
@@ -40,6 +47,9 @@ def setup(u_components, u, v, p, q, bcs, les_model, nu, nut_,
     # Replace cached matrix with compressed version
     #A_cache[(inner(grad(q), grad(p))*dx, tuple(bcs['p']))] = Ap
 
+    # Store pressure Laplacian in symmetric storage if possible
+    Ap = symmetric_pressure_matrix(**vars())
+
     # Allocate coefficient matrix (needs reassembling)
     A = Matrix(M)
 
@@ -67,24 +77,39 @@ def setup(u_components, u, v, p, q, bcs, les_model, nu, nut_,
             Tb = Matrix(M)
             bb = Vector(x_[scalar_components[0]])
             bx = Vector(x_[scalar_components[0]])
-            d.update(Tb=Tb, bb=bb, bx=bx)
+            d.update(Tb=Tb, bb=bb, bx=bx, scalar_groups=group_scalars(**vars()))
 
     # Setup for solving convection
     u_ab = as_vector([Function(V) for i in range(len(u_components))])
     a_conv = inner(v, dot(u_ab, nabla_grad(u))) * dx
     a_scalar = a_conv
+    convection = ConvectionOperator(V, u_ab) if precomputed_convection else None
     LT = None if les_model is "NoModel" else LESsource(
         nut_, u_ab, V, name='LTd')
 
     if bcs['p'] == []:
         attach_pressure_nullspace(Ap, x_, Q)
 
-    d.update(u_ab=u_ab, a_conv=a_conv, a_scalar=a_scalar, LT=LT, KT=KT)
+    d.update(u_ab=u_ab, a_conv=a_conv, a_scalar=a_scalar, LT=LT, KT=KT,
+             convection=convection)
     return d
 
+def group_scalars(scalar_components, Schmidt, bcs, **NS_namespace):
+    """Return lists of scalars with the same Schmidt number and boundary
+    conditions. The scalars in one list share the coefficient matrix and
+    may be solved for with one call to the linear algebra solver.
+    """
+    groups = {}
+    for ci in scalar_components:
+        key = (Schmidt[ci], tuple(id(bc) for bc in bcs[ci]))
+        groups.setdefault(key, []).append(ci)
+    return list(groups.values())
+
+
 def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
                 x_, Q, scalar_components, velocity_krylov_solver,
-                pressure_krylov_solver, scalar_krylov_solver, **NS_namespace):
+                pressure_krylov_solver, scalar_krylov_solver, ManagedKrylovSolver,
+                **NS_namespace):
     """Return linear solvers.
 
     We are solving for
@@ -94,6 +119,9 @@ def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
        and possibly:
        - scalars
 
+    Krylov solvers are wrapped in ManagedKrylovSolver, which rebuilds the
+    preconditioner every preconditioner_refresh solve (0 for once).
+
     """
     if use_krylov_solvers:
         ## tentative velocity solver ##
@@ -104,21 +132,19 @@ def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
         #u_sol.prec = u_prec  # Keep from going out of scope
         # u_sol = KrylovSolver(velocity_krylov_solver['solver_type'],
         #                     velocity_krylov_solver['preconditioner_type'])
-        #u_sol.parameters['preconditioner']['structure'] = 'same_nonzero_pattern'
         u_sol.parameters.update(krylov_solvers)
+        u_sol = ManagedKrylovSolver(
+            u_sol, velocity_krylov_solver.get('preconditioner_refresh', 1), 'Tentative')
 
         ## pressure solver ##
-        #p_prec = PETScPreconditioner('hypre_amg')
-        #p_prec.parameters['report'] = True
-        #p_prec.parameters['hypre']['BoomerAMG']['agressive_coarsening_levels'] = 0
-        #p_prec.parameters['hypre']['BoomerAMG']['strong_threshold'] = 0.5
-        #PETScOptions.set('pc_hypre_boomeramg_truncfactor', 0)
-        #PETScOptions.set('pc_hypre_boomeramg_agg_num_paths', 1)
+        # Ap is constant, so the AMG hierarchy is built once by default
         p_sol = KrylovSolver(pressure_krylov_solver['solver_type'],
                              pressure_krylov_solver['preconditioner_type'])
-        #p_sol.parameters['preconditioner']['structure'] = 'same'
         #p_sol.parameters['profile'] = True
         p_sol.parameters.update(krylov_solvers)
+        p_sol = ManagedKrylovSolver(
+            p_sol, pressure_krylov_solver.get('preconditioner_refresh', 0), 'Pressure',
+            pressure_krylov_solver.get('boomeramg', {}))
 
         sols = [u_sol, p_sol]
         ## scalar solver ##
@@ -131,7 +157,8 @@ def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
             # c_sol = KrylovSolver(scalar_krylov_solver['solver_type'],
             # scalar_krylov_solver['preconditioner_type'])
             c_sol.parameters.update(krylov_solvers)
-            #c_sol.parameters['preconditioner']['structure'] = 'same_nonzero_pattern'
+            c_sol = ManagedKrylovSolver(
+                c_sol, scalar_krylov_solver.get('preconditioner_refresh', 1), 'Scalar')
             sols.append(c_sol)
         else:
             sols.append(None)
@@ -153,9 +180,11 @@ def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
     return sols
 
 
-def assemble_first_inner_iter(A, a_conv, dt, M, scalar_components, les_model,
+def assemble_first_inner_iter(A, a_conv, dt, dt_1, M, scalar_components, les_model,
                               a_scalar, K, nu, nut_, u_components, LT, KT,
-                              b_tmp, b0, x_1, x_2, u_ab, bcs, **NS_namespace):
+                              b_tmp, b0, x_1, x_2, u_ab, bcs, matvec_add_multiple,
+                              batched_matvec, convection, fused_assembly,
+                              combine_matrices, **NS_namespace):
     """Called on first inner iteration of velocity/pressure system.
 
     Assemble convection matrix, compute rhs of tentative velocity and
@@ -163,42 +192,64 @@ def assemble_first_inner_iter(A, a_conv, dt, M, scalar_components, les_model,
 
     """
     t0 = Timer("Assemble first inner iter")
-    # Update u_ab used as convecting velocity
+    # Update u_ab used as convecting velocity. Adams-Bashforth projection
+    # to t - dt/2, with weights for a variable timestep (dt_1 previous dt)
+    w = 0.5 * dt / dt_1
     for i, ui in enumerate(u_components):
         u_ab[i].vector().zero()
-        u_ab[i].vector().axpy(1.5, x_1[ui])
-        u_ab[i].vector().axpy(-0.5, x_2[ui])
-
-    A = assemble(a_conv, tensor=A)
-    A *= -0.5                 # Negative convection on the rhs
-    A.axpy(1. / dt, M, True)  # Add mass
-
-    # Set up scalar matrix for rhs using the same convection as velocity
-    if len(scalar_components) > 0:
-        Ta = NS_namespace['Ta']
-        if a_scalar is a_conv:
-            Ta.zero()
-            Ta.axpy(1., A, True)
+        u_ab[i].vector().axpy(1. + w, x_1[ui])
+        u_ab[i].vector().axpy(-w, x_2[ui])
 
-    # Add diffusion and compute rhs for all velocity components
-    A.axpy(-0.5 * nu, K, True)
+    if convection is not None:
+        convection.assemble(A)
+    else:
+        A = assemble(a_conv, tensor=A)
     if not les_model is "NoModel":
         assemble(nut_ * KT[1] * dx, tensor=KT[0])
-        A.axpy(-0.5, KT[0], True)
 
+    if fused_assembly:
+        # Set up scalar matrix for rhs using the same convection as velocity
+        if len(scalar_components) > 0 and a_scalar is a_conv:
+            combine_matrices(NS_namespace['Ta'], [(-0.5, A), (1. / dt, M)])
+
+        # Negative convection, mass, diffusion and LES in one pass
+        terms = [(-0.5, A), (1. / dt, M), (-0.5 * nu, K)]
+        if not les_model is "NoModel":
+            terms.append((-0.5, KT[0]))
+        combine_matrices(A, terms)
+
+    else:
+        A *= -0.5                 # Negative convection on the rhs
+        A.axpy(1. / dt, M, True)  # Add mass
+
+        # Set up scalar matrix for rhs using the same convection as velocity
+        if len(scalar_components) > 0:
+            Ta = NS_namespace['Ta']
+            if a_scalar is a_conv:
+                Ta.zero()
+                Ta.axpy(1., A, True)
+
+        # Add diffusion
+        A.axpy(-0.5 * nu, K, True)
+
+        if not les_model is "NoModel":
+            A.axpy(-0.5, KT[0], True)
+
+    # Body force plus transient, convection and diffusion
+    matvec_add_multiple(A, [x_1[ui] for ui in u_components],
+                        [b0[ui] for ui in u_components],
+                        [b_tmp[ui] for ui in u_components], batched=batched_matvec)
     for i, ui in enumerate(u_components):
-        # Start with body force
-        b_tmp[ui].zero()
-        b_tmp[ui].axpy(1., b0[ui])
-        # Add transient, convection and diffusion
-        b_tmp[ui].axpy(1., A * x_1[ui])
         if not les_model is "NoModel":
             LT.assemble_rhs(i)
             b_tmp[ui].axpy(1., LT.vector())
 
     # Reset matrix for lhs
-    A *= -1.
-    A.axpy(2. / dt, M, True)
+    if fused_assembly:
+        combine_matrices(A, [(-1., A), (2. / dt, M)])
+    else:
+        A *= -1.
+        A.axpy(2. / dt, M, True)
     [bc.apply(A) for bc in bcs['u0']]
 
 def attach_pressure_nullspace(Ap, x_, Q):
@@ -212,6 +263,28 @@ def attach_pressure_nullspace(Ap, x_, Q):
     Aa.null_space = null_space
 
 
+def symmetric_pressure_matrix(Ap, K, q, p, bcs, A_cache, symmetric_storage,
+                              as_symmetric_storage, use_krylov_solvers,
+                              pressure_krylov_solver, **NS_namespace):
+    """Return pressure Laplacian Ap, in symmetric storage if requested and
+    possible.
+
+    Ap is converted only without pressure bcs (bcs make Ap nonsymmetric),
+    with Krylov solvers, if Ap is not the same matrix as K (used in axpy),
+    and if the pressure preconditioner supports SBAIJ. The converted
+    matrix replaces Ap in A_cache.
+    """
+    if not (symmetric_storage and use_krylov_solvers and bcs['p'] == [] and
+            not Ap.id() == K.id()):
+        return Ap
+
+    As = as_symmetric_storage(Ap, pressure_krylov_solver['preconditioner_type'])
+    if As is not Ap:
+        A_cache[(inner(grad(q), grad(p)) * dx, ())] = As
+        info_blue("Pressure Laplacian stored in symmetric storage (SBAIJ)")
+    return As
+
+
 def velocity_tentative_assemble(ui, b, b_tmp, p_, gradp, **NS_namespace):
     """Add pressure gradient to rhs of tentative velocity system."""
     b[ui].zero()
@@ -220,7 +293,8 @@ def velocity_tentative_assemble(ui, b, b_tmp, p_, gradp, **NS_namespace):
     b[ui].axpy(-1., gradp[ui].rhs)
 
 def velocity_tentative_solve(ui, A, bcs, x_, x_2, u_sol, b, udiff,
-                             use_krylov_solvers, **NS_namespace):
+                             use_krylov_solvers, u_components, solve_multiple_rhs,
+                             solve_multiple, initial_guess, inner_iter, **NS_namespace):
     """Linear algebra solve of tentative velocity component."""
     #if use_krylov_solvers:
         #if ui == 'u0':
@@ -231,32 +305,64 @@ def velocity_tentative_solve(ui, A, bcs, x_, x_2, u_sol, b, udiff,
     # x_2 only used on inner_iter 1, so use here as work vector
     x_2[ui].zero()
     x_2[ui].axpy(1., x_[ui])
+    if solve_multiple_rhs:
+        # All components share A. Solve for all when the last rhs is ready
+        if ui != u_components[-1]:
+            return
+        if ui in initial_guess and inner_iter == 1:
+            for uj in u_components:
+                initial_guess[uj](A, b[uj], x_[uj])
+        t1 = Timer("Tentative Linear Algebra Solve")
+        solve_multiple(u_sol, A, [x_[uj] for uj in u_components],
+                       [b[uj] for uj in u_components])
+        t1.stop()
+        for uj in u_components:
+            if uj in initial_guess:
+                initial_guess[uj].record(u_sol, A, x_[uj], inner_iter > 1)
+            x_2[uj].axpy(-1., x_[uj])
+            udiff[0] += norm(x_2[uj])
+        return
+
+    # Initial guess from previous timesteps
+    if ui in initial_guess and inner_iter == 1:
+        initial_guess[ui](A, b[ui], x_[ui])
+
     t1 = Timer("Tentative Linear Algebra Solve")
     u_sol.solve(A, x_[ui], b[ui])
     t1.stop()
-    udiff[0] += norm(x_2[ui] - x_[ui])
+    if ui in initial_guess:
+        initial_guess[ui].record(u_sol, A, x_[ui], inner_iter > 1)
+    x_2[ui].axpy(-1., x_[ui])
+    udiff[0] += norm(x_2[ui])
 
 
-def pressure_assemble(b, x_, dt, Ap, divu, **NS_namespace):
+def pressure_assemble(b, x_, dt, Ap, divu, matvec_add, **NS_namespace):
     """Assemble rhs of pressure equation."""
     divu.assemble_rhs()  # Computes div(u_)*q*dx
     b['p'][:] = divu.rhs
     b['p'] *= (-1. / dt)
-    b['p'].axpy(1., Ap * x_['p'])
+    matvec_add(Ap, x_['p'], b['p'], b['p'])
 
 
-def pressure_solve(dp_, x_, Ap, b, p_sol, bcs, **NS_namespace):
+def pressure_solve(dp_, x_, Ap, b, p_sol, bcs, initial_guess, inner_iter,
+                   **NS_namespace):
     """Solve pressure equation."""
     [bc.apply(b['p']) for bc in bcs['p']]
     dp_.vector().zero()
     dp_.vector().axpy(1., x_['p'])
     # KrylovSolvers use nullspace for normalization of pressure
     if hasattr(Ap, 'null_space'):
-        p_sol.null_space.orthogonalize(b['p'])
+        Ap.null_space.orthogonalize(b['p'])
+
+    # Initial guess from previous timesteps
+    if 'p' in initial_guess and inner_iter == 1:
+        initial_guess['p'](Ap, b['p'], x_['p'])
 
     t1 = Timer("Pressure Linear Algebra Solve")
     p_sol.solve(Ap, x_['p'], b['p'])
     t1.stop()
+    if 'p' in initial_guess:
+        initial_guess['p'].record(p_sol, Ap, x_['p'], inner_iter > 1)
     # LUSolver use normalize directly for normalization of pressure
     if bcs['p'] == []:
         normalize(x_['p'])
@@ -266,15 +372,23 @@ def pressure_solve(dp_, x_, Ap, b, p_sol, bcs, **NS_namespace):
     dpv *= -1.
 
 
-def velocity_update(u_components, bcs, gradp, dp_, dt, x_, **NS_namespace):
+def velocity_update(u_components, bcs, gradp, dp_, dt, x_, solve_multiple_rhs,
+                    project_multiple, **NS_namespace):
     """Update the velocity after regular pressure velocity iterations."""
+    if solve_multiple_rhs:
+        for ui in u_components:
+            gradp[ui].assemble_rhs(dp_)
+        project_multiple([gradp[ui] for ui in u_components])
+
     for ui in u_components:
-        gradp[ui](dp_)
+        if not solve_multiple_rhs:
+            gradp[ui](dp_)
         x_[ui].axpy(-dt, gradp[ui].vector())
         [bc.apply(x_[ui]) for bc in bcs[ui]]
 
 def scalar_assemble(a_scalar, a_conv, Ta, dt, M, scalar_components, Schmidt_T, KT,
-                    nu, nut_, Schmidt, b, K, x_1, b0, les_model, **NS_namespace):
+                    nu, nut_, Schmidt, b, K, x_1, b0, les_model, matvec_add,
+                    matvec_axpy, **NS_namespace):
     """Assemble scalar equation."""
     # Just in case you want to use a different scalar convection
     if not a_scalar is a_conv:
@@ -282,22 +396,13 @@ def scalar_assemble(a_scalar, a_conv, Ta, dt, M, scalar_components, Schmidt_T, K
         Ta *= -0.5            # Negative convection on the rhs
         Ta.axpy(1. / dt, M, True)    # Add mass
 
-    # Compute rhs for all scalars
+    # Compute rhs for all scalars. Diffusion is added through matvecs,
+    # which is cheaper than adding and subtracting it from Ta
     for ci in scalar_components:
-        # Add diffusion
-        Ta.axpy(-0.5 * nu / Schmidt[ci], K, True)
+        matvec_add(Ta, x_1[ci], b0[ci], b[ci])
+        matvec_axpy(-0.5 * nu / Schmidt[ci], K, x_1[ci], b[ci])
         if not les_model is "NoModel":
-            Ta.axpy(-0.5 / Schmidt_T[ci], KT[0], True)
-
-        # Compute rhs
-        b[ci].zero()
-        b[ci].axpy(1., Ta * x_1[ci])
-        b[ci].axpy(1., b0[ci])
-
-        # Subtract diffusion
-        Ta.axpy(0.5 * nu / Schmidt[ci], K, True)
-        if not les_model is "NoModel":
-            Ta.axpy(0.5 / Schmidt_T[ci], KT[0], True)
+            matvec_axpy(-0.5 / Schmidt_T[ci], KT[0], x_1[ci], b[ci])
 
     # Reset matrix for lhs - Note scalar matrix does not contain diffusion
     Ta *= -1.
@@ -305,8 +410,25 @@ def scalar_assemble(a_scalar, a_conv, Ta, dt, M, scalar_components, Schmidt_T, K
 
 
 def scalar_solve(ci, scalar_components, Ta, b, x_, bcs, c_sol,
-                 nu, Schmidt, K, **NS_namespace):
+                 nu, Schmidt, K, solve_multiple_rhs, solve_multiple,
+                 **NS_namespace):
     """Solve scalar equation."""
+    if solve_multiple_rhs and len(scalar_components) > 1:
+        # Scalars with the same Schmidt number and bcs are solved for
+        # together, when the last scalar of the group is reached.
+        group = [g for g in NS_namespace['scalar_groups'] if ci in g][0]
+        if ci != group[-1]:
+            return
+        Tb = NS_namespace['Tb']
+        Ta.axpy(0.5 * nu / Schmidt[ci], K, True)  # Add diffusion
+        Tb.zero()
+        Tb.axpy(1., Ta, True)
+        [bc.apply(Tb) for bc in bcs[ci]]
+        for cj in group:
+            [bc.apply(b[cj]) for bc in bcs[cj]]
+        solve_multiple(c_sol, Tb, [x_[cj] for cj in group], [b[cj] for cj in group])
+        Ta.axpy(-0.5 * nu / Schmidt[ci], K, True)  # Subtract diffusion
+        return
 
     Ta.axpy(0.5 * nu / Schmidt[ci], K, True)  # Add diffusion
     if len(scalar_components) > 1:
@@ -5,15 +5,22 @@ __license__ = "GNU Lesser GPL version 3 or any later version"
 
 from dolfin import *
 from .IPCS_ABCN import *
-from .IPCS_ABCN import __all__, attach_pressure_nullspace
+from .IPCS_ABCN import (__all__, attach_pressure_nullspace,
+                        symmetric_pressure_matrix)
 
 docstrings = {func: eval(func + ".__doc__") for func in __all__}
 
+# The timestep may change between timesteps (adaptive_timestep)
+variable_timestep = True
+
 
 def setup(u_components, u, v, p, q, nu, nut_, les_model, LESsource,
-          bcs, scalar_components, V, Q, x_, U_AB, A_cache,
+          bcs, scalar_components, V, Q, x_, A_cache,
           velocity_update_solver, u_, u_1, u_2, p_, assemble_matrix,
-          GradFunction, DivFunction, **NS_namespace):
+          GradFunction, DivFunction,
+          precomputed_convection, ConvectionOperator, symmetric_storage,
+          as_symmetric_storage, use_krylov_solvers, pressure_krylov_solver,
+          **NS_namespace):
     """Preassemble mass and diffusion matrices.
 
     Set up and prepare all equations to be solved. Called once, before
@@ -43,6 +50,9 @@ def setup(u_components, u, v, p, q, nu, nut_, les_model, LESsource,
             key = (inner(grad(q), grad(p)) * dx, tuple(bcs['p']))
             A_cache[key] = (Ap, A_cache[key][1])
 
+    # Store pressure Laplacian in symmetric storage if possible
+    Ap = symmetric_pressure_matrix(**vars())
+
     # Allocate coefficient matrix (needs reassembling)
     A = Matrix(M)
 
@@ -77,16 +87,20 @@ def setup(u_components, u, v, p, q, nu, nut_, les_model, LESsource,
     # Setup for solving convection
     a_conv = inner(v, dot(u_1, nabla_grad(u))) * dx
     A_conv = assemble(inner(v, dot(u_2, nabla_grad(u))) * dx)
+    convection = ConvectionOperator(V, u_1) if precomputed_convection else None
+
+    # Adams-Bashforth projection of velocity, used by LES and scalars
+    u_ab = None
+    if not les_model is "NoModel" or len(scalar_components) > 0:
+        u_ab = as_vector([Function(V) for i in range(len(u_components))])
 
     # A scalar always uses the Standard convection form
     a_scalar = None
     if len(scalar_components) > 0:
-        a_scalar = 0.5 * inner(v, dot(grad(u), U_AB)) * dx
-    u_ab = None if les_model is "NoModel" else as_vector(
-        [Function(V) for i in range(len(u_components))])
+        a_scalar = 0.5 * inner(v, dot(grad(u), u_ab)) * dx
     LT = None if les_model is "NoModel" else LESsource(
         (nu + nut_), u_ab, V, name='LTd')
-    d.update(a_conv=a_conv, A_conv=A_conv,
+    d.update(a_conv=a_conv, A_conv=A_conv, convection=convection,
              a_scalar=a_scalar, LT=LT, KT=KT, u_ab=u_ab)
 
     return d
@@ -94,7 +108,8 @@ def setup(u_components, u, v, p, q, nu, nut_, les_model, LESsource,
 
 def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
                 x_, Q, scalar_components, velocity_krylov_solver,
-                pressure_krylov_solver, scalar_krylov_solver, **NS_namespace):
+                pressure_krylov_solver, scalar_krylov_solver, ManagedKrylovSolver,
+                **NS_namespace):
     """Return linear solvers.
 
     We are solving for
@@ -104,26 +119,27 @@ def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
        and possibly:
        - scalars
 
+    Krylov solvers are wrapped in ManagedKrylovSolver, which rebuilds the
+    preconditioner every preconditioner_refresh solve (0 for once).
+
     """
     if use_krylov_solvers:
         ## tentative velocity solver ##
         u_sol = KrylovSolver(velocity_krylov_solver['solver_type'],
                              velocity_krylov_solver['preconditioner_type'])
-        #u_sol.parameters['preconditioner']['structure'] = 'same'
         u_sol.parameters.update(krylov_solvers)
+        u_sol = ManagedKrylovSolver(
+            u_sol, velocity_krylov_solver.get('preconditioner_refresh', 1), 'Tentative')
 
         ## pressure solver ##
-        #p_prec = PETScPreconditioner('hypre_amg')
-        #p_prec.parameters['report'] = True
-        #p_prec.parameters['hypre']['BoomerAMG']['agressive_coarsening_levels'] = 0
-        #p_prec.parameters['hypre']['BoomerAMG']['strong_threshold'] = 0.5
-        #PETScOptions.set('pc_hypre_boomeramg_truncfactor', 0)
-        #PETScOptions.set('pc_hypre_boomeramg_agg_num_paths', 1)
+        # Ap is constant, so the AMG hierarchy is built once by default
         p_sol = KrylovSolver(pressure_krylov_solver['solver_type'],
                              pressure_krylov_solver['preconditioner_type'])
-        #p_sol.parameters['preconditioner']['structure'] = 'same'
         #p_sol.parameters['profile'] = True
         p_sol.parameters.update(krylov_solvers)
+        p_sol = ManagedKrylovSolver(
+            p_sol, pressure_krylov_solver.get('preconditioner_refresh', 0), 'Pressure',
+            pressure_krylov_solver.get('boomeramg', {}))
 
         sols = [u_sol, p_sol]
         ## scalar solver ##
@@ -131,6 +147,8 @@ def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
             c_sol = KrylovSolver(scalar_krylov_solver['solver_type'],
                                  scalar_krylov_solver['preconditioner_type'])
             c_sol.parameters.update(krylov_solvers)
+            c_sol = ManagedKrylovSolver(
+                c_sol, scalar_krylov_solver.get('preconditioner_refresh', 1), 'Scalar')
             #c_sol.parameters['preconditioner']['structure'] = 'same_nonzero_pattern'
             sols.append(c_sol)
         else:
@@ -155,73 +173,119 @@ def get_solvers(use_krylov_solvers, krylov_solvers, bcs,
     return sols
 
 
-def assemble_first_inner_iter(A, dt, M, nu, K, b0, b_tmp, A_conv, x_2, x_1, les_model, KT,
-                              a_conv, u_components, bcs, u_ab, nut_, LT, **NS_namespace):
+def assemble_first_inner_iter(A, dt, dt_1, M, nu, K, b0, b_tmp, A_conv, x_2, x_1, les_model, KT,
+                              a_conv, u_components, bcs, u_ab, nut_, LT,
+                              matvec_add_multiple, batched_matvec, convection,
+                              fused_assembly, combine_matrices, **NS_namespace):
     t0 = Timer("Assemble first inner iter")
-    A.zero()
-    A.axpy(1. / dt, M, True)
-    A.axpy(-0.5 * nu, K, True)  # Add diffusion
-    if not les_model is "NoModel":
-        # Update u_ab used as convecting velocity
+    # Adams-Bashforth weights for a variable timestep (dt_1 previous dt)
+    w = 0.5 * dt / dt_1
+    if not fused_assembly:
+        A.zero()
+        A.axpy(1. / dt, M, True)
+        A.axpy(-0.5 * nu, K, True)  # Add diffusion
+    if u_ab is not None:
+        # Update u_ab used as convecting velocity by LES and scalars
         for i, ui in enumerate(u_components):
             u_ab[i].vector().zero()
-            u_ab[i].vector().axpy(1.5, x_1[ui])
-            u_ab[i].vector().axpy(-0.5, x_2[ui])
+            u_ab[i].vector().axpy(1. + w, x_1[ui])
+            u_ab[i].vector().axpy(-w, x_2[ui])
 
+    if not les_model is "NoModel":
         assemble(nut_ * KT[1] * dx, tensor=KT[0])
-        A.axpy(-0.5, KT[0], True)
+        if not fused_assembly:
+            A.axpy(-0.5, KT[0], True)
 
+    # Body force and convection
+    matvec_add_multiple(A_conv, [x_2[ui] for ui in u_components],
+                        [b0[ui] for ui in u_components],
+                        [b_tmp[ui] for ui in u_components], w, batched_matvec)
     for ui in u_components:
-        b_tmp[ui].zero()
-        b_tmp[ui].axpy(1.0, b0[ui])  # body force
-        b_tmp[ui].axpy(0.5, A_conv * x_2[ui])
         if not les_model is "NoModel":
             LT.assemble_rhs(i)
             b_tmp[ui].axpy(1., LT.vector())
 
-    A_conv = assemble(a_conv, tensor=A_conv)
-    A.axpy(-1.5, A_conv, True)
-    for ui in u_components:
-        # Add transient and diffusion
-        b_tmp[ui].axpy(1.0, A * x_1[ui])
-
-    A.axpy(nu, K, True)        # Reset for lhs
-    A.axpy(1.5, A_conv, True)  # Remove convection
+    if convection is not None:
+        convection.assemble(A_conv)
+    else:
+        A_conv = assemble(a_conv, tensor=A_conv)
+    if fused_assembly:
+        # Mass, diffusion, LES and convection in one pass
+        terms = [(1. / dt, M), (-0.5 * nu, K), (-(1. + w), A_conv)]
+        if not les_model is "NoModel":
+            terms.append((-0.5, KT[0]))
+        combine_matrices(A, terms)
+    else:
+        A.axpy(-(1. + w), A_conv, True)
+    # Add transient and diffusion
+    matvec_add_multiple(A, [x_1[ui] for ui in u_components],
+                        [b_tmp[ui] for ui in u_components],
+                        [b_tmp[ui] for ui in u_components], batched=batched_matvec)
+
+    if fused_assembly:
+        # Set lhs directly, instead of adding and removing terms
+        terms = [(1. / dt, M), (0.5 * nu, K)]
+        if not les_model is "NoModel":
+            terms.append((-0.5, KT[0]))  # As in the unfused version above
+        combine_matrices(A, terms)
+    else:
+        A.axpy(nu, K, True)        # Reset for lhs
+        A.axpy(1. + w, A_conv, True)  # Remove convection
     [bc.apply(A) for bc in bcs['u0']]
 
 
 def velocity_tentative_solve(ui, A, bcs, x_, x_2, u_sol, b, udiff,
-                             **NS_namespace):
+                             u_components, solve_multiple_rhs, solve_multiple,
+                             initial_guess, inner_iter, **NS_namespace):
     """Linear algebra solve of tentative velocity component."""
     [bc.apply(b[ui]) for bc in bcs[ui]]
     # x_2 only used on inner_iter 1, so use here as work vector
     x_2[ui].zero()
     x_2[ui].axpy(1., x_[ui])
+    if solve_multiple_rhs:
+        # All components share A. Solve for all when the last rhs is ready
+        if ui != u_components[-1]:
+            return
+        if ui in initial_guess and inner_iter == 1:
+            for uj in u_components:
+                initial_guess[uj](A, b[uj], x_[uj])
+        t1 = Timer("Tentative Linear Algebra Solve")
+        solve_multiple(u_sol, A, [x_[uj] for uj in u_components],
+                       [b[uj] for uj in u_components])
+        t1.stop()
+        for uj in u_components:
+            if uj in initial_guess:
+                initial_guess[uj].record(u_sol, A, x_[uj], inner_iter > 1)
+            x_2[uj].axpy(-1., x_[uj])
+            udiff[0] += norm(x_2[uj])
+        return
+
+    # Initial guess from previous timesteps
+    if ui in initial_guess and inner_iter == 1:
+        initial_guess[ui](A, b[ui], x_[ui])
+
     t1 = Timer("Tentative Linear Algebra Solve")
     u_sol.solve(A, x_[ui], b[ui])
     t1.stop()
-    udiff[0] += norm(x_2[ui] - x_[ui])
+    if ui in initial_guess:
+        initial_guess[ui].record(u_sol, A, x_[ui], inner_iter > 1)
+    x_2[ui].axpy(-1., x_[ui])
+    udiff[0] += norm(x_2[ui])
 
 
 def scalar_assemble(Ta, a_scalar, dt, M, scalar_components, les_model, Schmidt_T,
-                    b, nu, Schmidt, K, x_1, b0, KT, **NS_namespace):
+                    b, nu, Schmidt, K, x_1, b0, KT, matvec_add, matvec_axpy, **NS_namespace):
     Ta = assemble(a_scalar, tensor=Ta)
     Ta._scale(-1.)              # Negative convection on the rhs
     Ta.axpy(1. / dt, M, True)   # Add mass
 
-    # Compute rhs for all scalars
+    # Compute rhs for all scalars. Diffusion is added through matvecs,
+    # which is cheaper than adding and subtracting it from Ta
     for ci in scalar_components:
-        Ta.axpy(-0.5 * nu / Schmidt[ci], K, True)  # Add diffusion
-        if not les_model is "NoModel":
-            Ta.axpy(-0.5 / Schmidt_T[ci], KT[0], True)
-
-        # Compute rhs
-        b[ci].zero()
-        b[ci].axpy(1., Ta * x_1[ci])
-        b[ci].axpy(1., b0[ci])
-        Ta.axpy(0.5 * nu / Schmidt[ci], K, True)  # Subtract diffusion
+        matvec_add(Ta, x_1[ci], b0[ci], b[ci])
+        matvec_axpy(-0.5 * nu / Schmidt[ci], K, x_1[ci], b[ci])
         if not les_model is "NoModel":
-            Ta.axpy(0.5 / Schmidt_T[ci], KT[0], True)
+            matvec_axpy(-0.5 / Schmidt_T[ci], KT[0], x_1[ci], b[ci])
 
     # Reset matrix for lhs - Note scalar matrix does not contain diffusion
     Ta._scale(-1.)
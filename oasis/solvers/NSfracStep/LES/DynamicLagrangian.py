@@ -5,15 +5,18 @@ __license__ = 'GNU Lesser GPL version 3 or any later version'
 
 from dolfin import (Function, FunctionSpace, TestFunction, sym, grad, dx, inner,
     sqrt, TrialFunction, project, CellVolume, as_vector, solve, Constant,
-    LagrangeInterpolator, assemble, MeshFunction, DirichletBC)
+    assemble, MeshFunction, DirichletBC, Vector)
 from .DynamicModules import (tophatfilter, lagrange_average, compute_Lij,
-                            compute_Mij)
+                            compute_Mij, stacked_functions, local_array,
+                            filter_matrix, interpolation_matrix)
 import numpy as np
 
 __all__ = ['les_setup', 'les_update']
 
 
-def les_setup(u_, mesh, assemble_matrix, CG1Function, nut_krylov_solver, bcs, **NS_namespace):
+def les_setup(u_, mesh, V, assemble_matrix, CG1Function, nut_krylov_solver, bcs,
+              symmetric_storage, as_symmetric_storage, DynamicSmagorinsky,
+              Solver_cache, **NS_namespace):
     """
     Set up for solving the Germano Dynamic LES model applying
     Lagrangian Averaging.
@@ -46,27 +49,36 @@ def les_setup(u_, mesh, assemble_matrix, CG1Function, nut_krylov_solver, bcs, **
     nut_ = CG1Function(nut_form, mesh, method=nut_krylov_solver,
                        bcs=bcs_nut, bounded=True, name="nut")
 
-    # Create functions for holding the different velocities
-    u_CG1 = as_vector([Function(CG1) for i in range(dim)])
-    u_filtered = as_vector([Function(CG1) for i in range(dim)])
+    # Create functions for holding the different velocities. All components
+    # share one (dim, ndofs) array, such that products of components may be
+    # computed without copying.
+    u_CG1, u_CG1_array = stacked_functions(CG1, dim)
+    u_filtered, u_filtered_array = stacked_functions(CG1, dim)
+    u_CG1 = as_vector(u_CG1)
+    u_filtered = as_vector(u_filtered)
     dummy = Function(CG1)
-    ll = LagrangeInterpolator()
+    # Interpolation of velocity components to CG1 as one matvec
+    u_interp = interpolation_matrix(V, CG1)
 
     # Assemble required filter matrices and functions
     G_under = Function(CG1, assemble(TestFunction(CG1) * dx))
     G_under.vector().set_local(1. / G_under.vector().array())
     G_under.vector().apply("insert")
     G_matr = assemble(inner(p, q) * dx)
-
-    # Set up functions for Lij and Mij
-    Lij = [Function(CG1) for i in range(dim * dim)]
-    Mij = [Function(CG1) for i in range(dim * dim)]
-    # Check if case is 2D or 3D and set up uiuj product pairs and
-    # Sij forms, assemble required matrices
-    Sijcomps = [Function(CG1) for i in range(dim * dim)]
-    Sijfcomps = [Function(CG1) for i in range(dim * dim)]
-    # Assemble some required matrices for solving for rate of strain terms
-    Sijmats = [assemble_matrix(p.dx(i) * q * dx) for i in range(dim)]
+    # Precompute the normalized filter and its work vectors
+    G_filter = filter_matrix(G_matr, G_under)
+    filter_work = [Vector(G_under.vector()) for i in range(2)]
+    if symmetric_storage:
+        # Only used in solves with default preconditioner
+        G_matr = as_symmetric_storage(G_matr)
+
+    # Solver for the rate of strain components, see solve_strain_rates
+    strain_solver = DynamicSmagorinsky.get("strain_solver", "default")
+    G_solver = None
+    if strain_solver == "cached":
+        G_solver = Solver_cache[(inner(p, q) * dx, (), "cg", "default")]
+
+    # Check if case is 2D or 3D and set up uiuj product pairs
     if dim == 3:
         tensdim = 6
         uiuj_pairs = ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2))
@@ -74,6 +86,15 @@ def les_setup(u_, mesh, assemble_matrix, CG1Function, nut_krylov_solver, bcs, **
         tensdim = 3
         uiuj_pairs = ((0, 0), (0, 1), (1, 1))
 
+    # Set up functions for the tensdim components of Lij, Mij, Sij and F(Sij),
+    # each tensor with its components stacked in one (tensdim, ndofs) array
+    Lij, Lij_array = stacked_functions(CG1, tensdim)
+    Mij, Mij_array = stacked_functions(CG1, tensdim)
+    Sijcomps, Sij_array = stacked_functions(CG1, tensdim)
+    Sijfcomps, Sijf_array = stacked_functions(CG1, tensdim)
+    # Assemble some required matrices for solving for rate of strain terms
+    Sijmats = [assemble_matrix(p.dx(i) * q * dx) for i in range(dim)]
+
     # Set up Lagrange functions
     JLM = Function(CG1)
     JLM.vector()[:] += 1E-32
@@ -82,16 +103,22 @@ def les_setup(u_, mesh, assemble_matrix, CG1Function, nut_krylov_solver, bcs, **
 
     return dict(Sij=Sij, nut_form=nut_form, nut_=nut_, delta=delta, bcs_nut=bcs_nut,
                 delta_CG1_sq=delta_CG1_sq, CG1=CG1, Cs=Cs, u_CG1=u_CG1,
-                u_filtered=u_filtered, ll=ll, Lij=Lij, Mij=Mij, Sijcomps=Sijcomps,
+                u_filtered=u_filtered, u_interp=u_interp, Lij=Lij, Mij=Mij, Sijcomps=Sijcomps,
                 Sijfcomps=Sijfcomps, Sijmats=Sijmats, JLM=JLM, JMM=JMM, dim=dim,
                 tensdim=tensdim, G_matr=G_matr, G_under=G_under, dummy=dummy,
-                uiuj_pairs=uiuj_pairs)
+                uiuj_pairs=uiuj_pairs, u_CG1_array=u_CG1_array,
+                u_filtered_array=u_filtered_array, Lij_array=Lij_array,
+                Mij_array=Mij_array, Sij_array=Sij_array, Sijf_array=Sijf_array,
+                strain_solver=strain_solver, G_solver=G_solver,
+                G_filter=G_filter, filter_work=filter_work)
 
 def les_update(u_ab, nut_, nut_form, dt, CG1, delta, tstep,
                DynamicSmagorinsky, Cs, u_CG1, u_filtered, Lij, Mij,
-               JLM, JMM, dim, tensdim, G_matr, G_under, ll,
+               JLM, JMM, dim, tensdim, G_matr, G_under, u_interp,
                dummy, uiuj_pairs, Sijmats, Sijcomps, Sijfcomps, delta_CG1_sq,
-               **NS_namespace):
+               u_CG1_array, u_filtered_array, Lij_array, Mij_array, Sij_array,
+               Sijf_array, strain_solver, G_solver, solve_multiple, G_filter,
+               filter_work, work_vectors, **NS_namespace):
 
     # Check if Cs is to be computed, if not update nut_ and break
     if tstep % DynamicSmagorinsky["Cs_comp_step"] != 0:
@@ -103,32 +130,32 @@ def les_update(u_ab, nut_, nut_form, dt, CG1, delta, tstep,
     # All velocity components must be interpolated to CG1 then filtered
     for i in range(dim):
         # Interpolate to CG1
-        ll.interpolate(u_CG1[i], u_ab[i])
+        u_interp.mult(u_ab[i].vector(), u_CG1[i].vector())
         # Filter
         tophatfilter(unfiltered=u_CG1[i], filtered=u_filtered[i], **vars())
 
     # Compute Lij applying dynamic modules function
-    compute_Lij(u=u_CG1, uf=u_filtered, **vars())
+    compute_Lij(u=u_CG1_array, uf=u_filtered_array, **vars())
 
     # Compute Mij applying dynamic modules function
     alpha = 2.0
     magS = compute_Mij(alphaval=alpha, u_nf=u_CG1, u_f=u_filtered, **vars())
 
     # Lagrange average Lij and Mij
-    lagrange_average(J1=JLM, J2=JMM, Aij=Lij, Bij=Mij, **vars())
+    lagrange_average(J1=JLM, J2=JMM, Aij=Lij_array, Bij=Mij_array, **vars())
 
     # Update Cs = sqrt(JLM/JMM) and filter/smooth Cs, then clip at 0.3.
     """
     Important that the term in nut_form is Cs**2 and not Cs
     since Cs here is stored as sqrt(JLM/JMM).
     """
-    Cs.vector().set_local(np.sqrt(JLM.vector().array() / JMM.vector().array()))
+    np.sqrt(local_array(JLM) / local_array(JMM), out=local_array(Cs))
     Cs.vector().apply("insert")
     tophatfilter(unfiltered=Cs, filtered=Cs, N=2, weight=1., **vars())
-    Cs.vector().set_local(Cs.vector().array().clip(max=0.3))
+    np.clip(local_array(Cs), None, 0.3, out=local_array(Cs))
     Cs.vector().apply("insert")
 
     # Update nut_
-    nut_.vector().set_local(Cs.vector().array()**2 *
-                            delta_CG1_sq.vector().array() * magS)
+    np.multiply(local_array(Cs)**2 * local_array(delta_CG1_sq), magS,
+                out=local_array(nut_))
     nut_.vector().apply("insert")
@@ -3,9 +3,113 @@ __date__ = '2015-02-04'
 __copyright__ = 'Copyright (C) 2015 ' + __author__
 __license__ = 'GNU Lesser GPL version 3 or any later version'
 
-from dolfin import solve
+from dolfin import solve, Function, as_backend_type, Matrix, PETScMatrix, MPI
 import numpy as np
 
+# Weights of the components of symmetric tensors stored as tensdim vectors
+_tensor_weights = {3: np.array([1., 2., 1.]),
+                   6: np.array([1., 2., 2., 1., 2., 1.])}
+
+
+def stacked_functions(V, n):
+    """Return n Functions on V and a (n, ndofs) array of their local values.
+
+    The rows of the array are placed as the arrays of the PETSc vectors of
+    the Functions, such that the array is a view of all Functions and no
+    data is copied. Writing to the array does not update ghost values.
+    """
+    funcs = [Function(V) for i in range(n)]
+    vec = as_backend_type(funcs[0].vector()).vec()
+    with vec.localForm() as loc:
+        size = loc.getSize() if loc.handle else vec.getLocalSize()
+    array = np.zeros((n, size))
+    for f, a in zip(funcs, array):
+        as_backend_type(f.vector()).vec().placeArray(a)
+    return funcs, array[:, :vec.getLocalSize()]
+
+
+def local_array(f):
+    """Return writable view (no copy) of the local values of Function f."""
+    return as_backend_type(f.vector()).vec().array
+
+
+def interpolation_matrix(V, CG1):
+    """
+    Return matrix I such that I*u.vector() is the interpolant in CG1 of u in V.
+
+    V is a scalar Lagrange space on the same mesh as CG1, of any degree. The
+    vertex dofs of a Lagrange element are its first local dofs, in the same
+    order as the dofs of CG1, so I is a selection matrix with one unit entry
+    per row. It is built from the dofmaps without point location, and is
+    exact also in parallel.
+    """
+    from petsc4py import PETSc
+    mesh = CG1.mesh()
+    nv = mesh.topology().dim() + 1
+    dofs_1 = np.array([CG1.dofmap().cell_dofs(c) for c in range(mesh.num_cells())])
+    dofs_V = np.array([V.dofmap().cell_dofs(c)[:nv] for c in range(mesh.num_cells())])
+    local_cols = np.zeros(CG1.dofmap().tabulate_local_to_global_dofs().shape[0],
+                          dtype=dofs_V.dtype)
+    local_cols[dofs_1.ravel()] = dofs_V.ravel()
+
+    r1, rV = CG1.dofmap().ownership_range(), V.dofmap().ownership_range()
+    n1, nV = r1[1] - r1[0], rV[1] - rV[0]
+    cols = V.dofmap().tabulate_local_to_global_dofs()[local_cols[:n1]]
+    indptr = np.arange(n1 + 1, dtype=PETSc.IntType)
+    mat = PETSc.Mat().createAIJ(((n1, None), (nV, None)),
+                                csr=(indptr, cols.astype(PETSc.IntType),
+                                     np.ones(n1)),
+                                comm=MPI.comm_world)
+    return Matrix(PETScMatrix(mat))
+
+
+def strain_rate_rhs(Sijmats, uiuj_pairs, u, work_vectors, tag):
+    """
+    Return the right hand sides of the components of the rate of strain of
+    the velocity u (list of CG1 Functions), i.e.,
+    0.5*(Sijmats[k]*u[j] + Sijmats[j]*u[k]) for all (j, k) in uiuj_pairs.
+
+    The right hand sides are work vectors (tagged with tag), such that no
+    vectors are allocated after the first call.
+    """
+    b = []
+    for i, (j, k) in enumerate(uiuj_pairs):
+        bi = work_vectors[(u[j].vector(), "{}{}".format(tag, i))]
+        Sijmats[k].mult(u[j].vector(), bi)
+        if j != k:
+            w = work_vectors[(bi, tag)]
+            Sijmats[j].mult(u[k].vector(), w)
+            bi.axpy(1.0, w)
+            bi *= 0.5
+        b.append(bi)
+    return b
+
+
+def solve_strain_rates(G_matr, G_under, x, b, strain_solver="default",
+                       G_solver=None, solve_multiple=None, **NS_namespace):
+    """
+    Solve G_matr*x[i] = b[i] for all components of the rate of strain.
+
+    strain_solver is one of
+      - "default": A new cg solver is created for each component.
+      - "cached": The cached Krylov solver G_solver is used for all
+        components in one call to solve_multiple.
+      - "lumping": Divide by the lumped mass matrix, with inverse G_under.
+    """
+    if strain_solver == "cached":
+        solve_multiple(G_solver, G_matr, [xi.vector() for xi in x], b)
+
+    elif strain_solver == "lumping":
+        for xi, bi in zip(x, b):
+            xv = xi.vector()
+            xv.zero()
+            xv.axpy(1.0, bi)
+            xv *= G_under.vector()
+
+    else:
+        for xi, bi in zip(x, b):
+            solve(G_matr, xi.vector(), bi, "cg", "default")
+
 
 def lagrange_average(u_CG1, dt, CG1, tensdim, delta_CG1_sq, dim,
                      Sijmats, G_matr, J1=None, J2=None, Aij=None, Bij=None, **NS_namespace):
@@ -22,16 +126,19 @@ def lagrange_average(u_CG1, dt, CG1, tensdim, delta_CG1_sq, dim,
     - Tensor contractions of AijBij and BijBij are computed manually.
     - Two equations are solved implicitly and easy, no linear system.
     - J1 is clipped at 1E-32 (not zero, will lead to problems).
+
+    Aij and Bij are (tensdim, ndofs) arrays.
     """
+    j1 = local_array(J1)
+    j2 = local_array(J2)
 
     # Update eps
-    eps = (dt * (J1.vector().array() * J2.vector().array())**(1. / 8.)
-           / (1.5 * np.sqrt(delta_CG1_sq.vector().array())))
-    eps = eps / (1.0 + eps)
+    eps = dt * (j1 * j2)**(1. / 8.) / (1.5 * np.sqrt(local_array(delta_CG1_sq)))
+    eps /= 1.0 + eps
 
     # Compute tensor contractions
-    AijBij = tensor_inner(A=Aij, B=Bij, **vars())
-    BijBij = tensor_inner(A=Bij, B=Bij, **vars())
+    AijBij = tensor_inner(tensdim, A=Aij, B=Bij)
+    BijBij = tensor_inner(tensdim, A=Bij, B=Bij)
 
     # Compute backward convective terms J(x-dt*u) (!! NOT STABLE !!)
     """
@@ -48,37 +155,52 @@ def lagrange_average(u_CG1, dt, CG1, tensdim, delta_CG1_sq, dim,
     J2_back[J2_back < 0] = 1E3
     """
 
-    J1_back = J1.vector().array()
-    J2_back = J2.vector().array()
-
-    # Update J1
-    J1.vector().set_local(eps * AijBij + (1 - eps) * J1_back)
+    # Update J1 and J2 in place, then apply ramp function on J1 to remove
+    # negative values, but not set to 0.
+    j1 *= 1 - eps
+    j1 += eps * AijBij
+    np.clip(j1, 1E-32, None, out=j1)
+    j2 *= 1 - eps
+    j2 += eps * BijBij
+    del j1, j2
     J1.vector().apply("insert")
-
-    # Update J2
-    J2.vector().set_local(eps * BijBij + (1 - eps) * J2_back)
     J2.vector().apply("insert")
 
-    # Apply ramp function on J1 to remove negative values, but not set to 0.
-    J1.vector().set_local(J1.vector().array().clip(min=1E-32))
-    J1.vector().apply("insert")
 
+def filter_matrix(G_matr, G_under):
+    """
+    Return the normalized top hat filter G_under*G_matr, i.e., the CG1 mass
+    matrix with each row divided by its sum. G_matr must use AIJ storage.
+    """
+    G_filter = as_backend_type(G_matr).copy()
+    as_backend_type(G_filter).mat().diagonalScale(
+        L=as_backend_type(G_under.vector()).vec())
+    return G_filter
 
-def tophatfilter(G_matr, G_under, unfiltered=None, filtered=None, N=1,
+
+def tophatfilter(G_filter, filter_work, unfiltered=None, filtered=None, N=1,
                  weight=0.5, **NS_namespace):
     """
     Filtering a CG1 function for applying a generalized top hat filter.
     uf = int(G*u)/int(G).
 
     G = CG1-basis functions.
+
+    G_filter is the precomputed row scaled filter matrix (filter_matrix).
+    The passes alternate between the two vectors of filter_work, such that
+    nothing is allocated. unfiltered and filtered may be the same.
     """
 
     vec_ = unfiltered.vector()
     # Apply filter N times
     for i in range(N):
         # Compute filtered quantity
-        vec_ = (G_matr * vec_) * G_under.vector()
-        vec_ = weight * vec_ + (1 - weight) * unfiltered.vector()
+        work = filter_work[i % 2]
+        G_filter.mult(vec_, work)
+        if weight != 1:
+            work *= weight
+            work.axpy(1 - weight, unfiltered.vector())
+        vec_ = work
 
     # Zero filtered vector
     filtered.vector().zero()
@@ -86,31 +208,31 @@ def tophatfilter(G_matr, G_under, unfiltered=None, filtered=None, N=1,
     filtered.vector().axpy(1.0, vec_)
 
 
-def compute_Lij(Lij, uiuj_pairs, tensdim, G_matr, G_under,
-                u=None, uf=None, Qij=None, **NS_namespace):
+def compute_Lij(Lij, Lij_array, uiuj_pairs, tensdim, G_filter, filter_work,
+                u=None, uf=None, Qij_array=None, **NS_namespace):
     """
     Manually compute the tensor Lij = F(uiuj)-F(ui)F(uj)
-    """
 
-    # Loop over each tensor component
+    u and uf are (dim, ndofs) arrays of the velocity and filtered velocity.
+    """
+    j, k = np.array(uiuj_pairs).T
+    # Compute ujuk for all components
+    Lij_array[:] = u[j] * u[k]
+    # Filter Lij[i] -> F(ujuk)
     for i in range(tensdim):
-        Lij[i].vector().zero()
-        # Extract velocity pair
-        j, k = uiuj_pairs[i]
-        # Add ujuk to Lij[i]
-        Lij[i].vector().axpy(1.0, u[j].vector() * u[k].vector())
-        # Filter Lij[i] -> F(ujuk)
         tophatfilter(unfiltered=Lij[i], filtered=Lij[i], **vars())
-        # Add to Qij if ScaleDep model
-        if Qij != None:
-            Qij[i].vector().zero()
-            Qij[i].vector().axpy(1.0, Lij[i].vector())
-        # Axpy - F(uj)F(uk)
-        Lij[i].vector().axpy(-1.0, uf[j].vector() * uf[k].vector())
-
-
-def compute_Mij(Mij, G_matr, G_under, Sijmats, Sijcomps, Sijfcomps, delta_CG1_sq,
-                tensdim, alphaval=None, u_nf=None, u_f=None, Nij=None, **NS_namespace):
+    # Add to Qij if ScaleDep model
+    if Qij_array is not None:
+        Qij_array[:] = Lij_array
+    # Subtract F(uj)F(uk)
+    Lij_array -= uf[j] * uf[k]
+
+
+def compute_Mij(Mij, Mij_array, G_matr, G_under, G_filter, filter_work,
+                Sijmats, Sijcomps, Sijfcomps, Sij_array, Sijf_array,
+                delta_CG1_sq, tensdim, strain_solver, G_solver, solve_multiple,
+                uiuj_pairs, work_vectors, alphaval=None, u_nf=None, u_f=None,
+                Nij_array=None, **NS_namespace):
     """
     Manually compute the tensor Mij = 2*delta**2*(F(|S|Sij)-alpha**2*F(|S|)F(Sij)
     """
@@ -118,158 +240,91 @@ def compute_Mij(Mij, G_matr, G_under, Sijmats, Sijcomps, Sijfcomps, delta_CG1_sq
     Sij = Sijcomps
     Sijf = Sijfcomps
     alpha = alphaval
-    deltasq = 2 * delta_CG1_sq.vector().array()
+    deltasq = 2 * local_array(delta_CG1_sq)
 
     # Apply pre-assembled matrices and compute right hand sides
-    if tensdim == 3:
-        Ax, Ay = Sijmats
-        u = u_nf[0].vector()
-        v = u_nf[1].vector()
-        uf = u_f[0].vector()
-        vf = u_f[1].vector()
-        # Unfiltered rhs
-        bu = [Ax * u, 0.5 * (Ay * u + Ax * v), Ay * v]
-        # Filtered rhs
-        buf = [Ax * uf, 0.5 * (Ay * uf + Ax * vf), Ay * vf]
-    else:
-        Ax, Ay, Az = Sijmats
-        u = u_nf[0].vector()
-        v = u_nf[1].vector()
-        w = u_nf[2].vector()
-        uf = u_f[0].vector()
-        vf = u_f[1].vector()
-        wf = u_f[2].vector()
-        bu = [Ax * u, 0.5 * (Ay * u + Ax * v), 0.5 * (Az * u + Ax * w),
-              Ay * v, 0.5 * (Az * v + Ay * w), Az * w]
-        buf = [Ax * uf, 0.5 * (Ay * uf + Ax * vf), 0.5 * (Az * uf + Ax * wf),
-               Ay * vf, 0.5 * (Az * vf + Ay * wf), Az * wf]
+    bu = strain_rate_rhs(Sijmats, uiuj_pairs, u_nf, work_vectors, "Sij")
+    buf = strain_rate_rhs(Sijmats, uiuj_pairs, u_f, work_vectors, "Sijf")
 
-    for i in range(tensdim):
-        # Solve for the different components of Sij
-        solve(G_matr, Sij[i].vector(), bu[i], "cg", "default")
-        # Solve for the different components of F(Sij)
-        solve(G_matr, Sijf[i].vector(), buf[i], "cg", "default")
+    # Solve for the different components of Sij and F(Sij)
+    solve_strain_rates(x=Sij + Sijf, b=bu + buf, **vars())
 
     # Compute magnitudes of Sij and Sijf
-    magS = mag(Sij, tensdim)
-    magSf = mag(Sijf, tensdim)
+    magS = mag(Sij_array, tensdim)
+    magSf = mag(Sijf_array, tensdim)
 
-    # Loop over components and add to Mij
+    # Compute |S|*Sij and filter F(|S|*Sij)
+    Mij_array[:] = magS * Sij_array
     for i in range(tensdim):
-        # Compute |S|*Sij
-        Mij[i].vector().set_local(magS * Sij[i].vector().array())
-        Mij[i].vector().apply("insert")
-        # Compute F(|S|*Sij)
         tophatfilter(unfiltered=Mij[i], filtered=Mij[i], **vars())
 
-        # Check if Nij, assign F(|S|Sij) if not None
-        if Nij != None:
-            Nij[i].vector().zero()
-            Nij[i].vector().axpy(1.0, Mij[i].vector())
+    # Check if Nij, assign F(|S|Sij) if not None
+    if Nij_array is not None:
+        Nij_array[:] = Mij_array
 
-        # Compute 2*delta**2*(F(|S|Sij) - alpha**2*F(|S|)F(Sij)) and add to Mij[i]
-        Mij[i].vector().set_local(deltasq * (Mij[i].vector().array() -
-                                             (alpha**2) * magSf * Sijf[i].vector().array()))
-        Mij[i].vector().apply("insert")
+    # Compute 2*delta**2*(F(|S|Sij) - alpha**2*F(|S|)F(Sij))
+    Mij_array -= (alpha**2) * magSf * Sijf_array
+    Mij_array *= deltasq
 
     # Return magS for use when updating nut_
     return magS
 
 
-def compute_Qij(Qij, uiuj_pairs, tensdim, G_matr, G_under, uf=None, **NS_namespace):
+def compute_Qij(Qij, Qij_array, uiuj_pairs, tensdim, G_filter, filter_work,
+                uf=None, **NS_namespace):
     """
     Function for computing Qij in ScaleDepLagrangian
+
+    uf is a (dim, ndofs) array of the filtered velocity.
     """
-    # Compute Qij
+    # Filter components of Qij
     for i in range(tensdim):
-        j, k = uiuj_pairs[i]
-        # Filter component of Qij
         tophatfilter(unfiltered=Qij[i], filtered=Qij[i], weight=1, **vars())
-        # Axpy outer(uf,uf) to Qij
-        Qij[i].vector().axpy(-1.0, uf[j].vector() * uf[k].vector())
+    # Subtract outer(uf,uf) from Qij
+    j, k = np.array(uiuj_pairs).T
+    Qij_array -= uf[j] * uf[k]
 
 
-def compute_Nij(Nij, G_matr, G_under, tensdim, Sijmats, Sijfcomps, delta_CG1_sq,
-                alphaval=None, u_f=None, **NS_namespace):
+def compute_Nij(Nij, Nij_array, G_matr, G_under, G_filter, filter_work,
+                tensdim, Sijmats, Sijfcomps, Sijf_array, delta_CG1_sq,
+                strain_solver, G_solver, solve_multiple, uiuj_pairs,
+                work_vectors, alphaval=None, u_f=None, **NS_namespace):
     """
     Function for computing Nij in ScaleDepLagrangian
     """
 
     Sijf = Sijfcomps
     alpha = alphaval
-    deltasq = 2 * delta_CG1_sq.vector().array()
+    deltasq = 2 * local_array(delta_CG1_sq)
 
     # Need to compute F(F(Sij)), set up right hand sides
-    if tensdim == 3:
-        Ax, Ay = Sijmats
-        uf = u_f[0].vector()
-        vf = u_f[1].vector()
-        # Filtered rhs
-        buf = [Ax * uf, 0.5 * (Ay * uf + Ax * vf), Ay * vf]
-    else:
-        Ax, Ay, Az = Sijmats
-        uf = u_f[0].vector()
-        vf = u_f[1].vector()
-        wf = u_f[2].vector()
-        buf = [Ax * uf, 0.5 * (Ay * uf + Ax * vf), 0.5 * (Az * uf + Ax * wf),
-               Ay * vf, 0.5 * (Az * vf + Ay * wf), Az * wf]
+    buf = strain_rate_rhs(Sijmats, uiuj_pairs, u_f, work_vectors, "Sijf")
 
-    for i in range(tensdim):
-        # Solve for the diff. components of F(F(Sij)))
-        solve(G_matr, Sijf[i].vector(), buf[i], "cg", "default")
+    # Solve for the diff. components of F(F(Sij)))
+    solve_strain_rates(x=Sijf, b=buf, **vars())
 
     # Compute magSf
-    magSf = mag(Sijf, tensdim)
+    magSf = mag(Sijf_array, tensdim)
 
+    # Filter Nij = F(|S|Sij) --> F(F(|S|Sij))
     for i in range(tensdim):
-        # Filter Nij = F(|S|Sij) --> F(F(|S|Sij))
         tophatfilter(unfiltered=Nij[i], filtered=Nij[i], weight=1, **vars())
-        # Compute 2*delta**2*(F(F(|S|Sij)) - alpha**2*F(F(|S))F(F(Sij)))
-        Nij[i].vector().set_local(deltasq * (Nij[i].vector().array() -
-                                             (alpha**2) * magSf * Sijf[i].vector().array()))
-        Nij[i].vector().apply("insert")
+
+    # Compute 2*delta**2*(F(F(|S|Sij)) - alpha**2*F(F(|S))F(F(Sij)))
+    Nij_array -= (alpha**2) * magSf * Sijf_array
+    Nij_array *= deltasq
 
 
 def tensor_inner(tensdim, A=None, B=None, **NS_namespace):
     """
-    Compute tensor contraction Aij:Bij of two symmetric tensors Aij and Bij.
-    A numpy array is returned.
+    Compute tensor contraction Aij:Bij of two symmetric tensors Aij and Bij,
+    stored as (tensdim, ndofs) arrays. A numpy array is returned.
     """
-    if tensdim == 3:
-        contraction = (A[0].vector().array() * B[0].vector().array()
-                       + 2 * A[1].vector().array() * B[1].vector().array()
-                       + A[2].vector().array() * B[2].vector().array())
-    else:
-        contraction = (A[0].vector().array() * B[0].vector().array()
-                       + 2 * A[1].vector().array() * B[1].vector().array()
-                       + 2 * A[2].vector().array() * B[2].vector().array()
-                       + A[3].vector().array() * B[3].vector().array()
-                       + 2 * A[4].vector().array() * B[4].vector().array()
-                       + A[5].vector().array() * B[5].vector().array())
-    return contraction
+    return np.einsum('i,ij,ij->j', _tensor_weights[tensdim], A, B)
 
 
 def mag(Sij, tensdim, **NS_namespace):
     """
-    Compute |S| = magS = 2*sqrt(inner(Sij,Sij))
+    Compute |S| = magS = 2*sqrt(inner(Sij,Sij)) of (tensdim, ndofs) array Sij
     """
-    if tensdim == 3:
-        # Extract Sij vectors
-        S00 = Sij[0].vector().array()
-        S01 = Sij[1].vector().array()
-        S11 = Sij[2].vector().array()
-        # Compute |S|
-        magS = np.sqrt(2 * (S00 * S00 + 2 * S01 * S01 + S11 * S11))
-    elif tensdim == 6:
-        # Extract Sij vectors
-        S00 = Sij[0].vector().array()
-        S01 = Sij[1].vector().array()
-        S02 = Sij[2].vector().array()
-        S11 = Sij[3].vector().array()
-        S12 = Sij[4].vector().array()
-        S22 = Sij[5].vector().array()
-        # Compute |S|
-        magS = np.sqrt(2 * (S00 * S00 + 2 * S01 * S01 + 2 * S02 * S02 + S11 * S11 +
-                            2 * S12 * S12 + S22 * S22))
-
-    return magS
+    return np.sqrt(2 * tensor_inner(tensdim, A=Sij, B=Sij))
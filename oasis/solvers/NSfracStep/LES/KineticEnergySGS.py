@@ -4,17 +4,22 @@ __copyright__ = 'Copyright (C) 2015 ' + __author__
 __license__ = 'GNU Lesser GPL version 3 or any later version'
 
 from dolfin import (Function, FunctionSpace, assemble, TestFunction, sym, grad,
-    Vector, dx, inner, TrialFunction, sqrt, Matrix, dot, interpolate, Constant,
-    DirichletBC, KrylovSolver)
+    Vector, dx, inner, TrialFunction, sqrt, dot, interpolate, Constant,
+    DirichletBC, PETScKrylovSolver, PETScPreconditioner)
+import numpy as np
 
 from .common import derived_bcs
+from .DynamicModules import local_array
 
 __all__ = ['les_setup', 'les_update']
 
 
-def les_setup(u_, mesh, KineticEnergySGS, assemble_matrix, CG1Function, nut_krylov_solver, bcs, **NS_namespace):
+def les_setup(u_, mesh, dt, KineticEnergySGS, assemble_matrix, CG1Function, nut_krylov_solver, bcs, **NS_namespace):
     """
     Set up for solving the Kinetic Energy SGS-model.
+
+    The forms of the ksgs equation are created here, once, with dt, Ck and
+    Ce as Constants that are updated in les_update.
     """
     DG = FunctionSpace(mesh, "DG", 0)
     CG1 = FunctionSpace(mesh, "CG", 1)
@@ -25,7 +30,9 @@ def les_setup(u_, mesh, KineticEnergySGS, assemble_matrix, CG1Function, nut_kryl
     delta.vector().set_local(delta.vector().array()**(1. / dim))
     delta.vector().apply('insert')
 
-    Ck = KineticEnergySGS["Ck"]
+    Ck = Constant(KineticEnergySGS["Ck"])
+    Ce = Constant(KineticEnergySGS["Ce"])
+    dt_ = Constant(dt)
     ksgs = interpolate(Constant(1E-7), CG1)
     bc_ksgs = DirichletBC(CG1, 0, "on_boundary")
     A_mass = assemble_matrix(TrialFunction(CG1) * TestFunction(CG1) * dx)
@@ -33,41 +40,45 @@ def les_setup(u_, mesh, KineticEnergySGS, assemble_matrix, CG1Function, nut_kryl
     bcs_nut = derived_bcs(CG1, bcs['u0'], u_)
     nut_ = CG1Function(nut_form, mesh, method=nut_krylov_solver,
                        bcs=bcs_nut, bounded=True, name="nut")
-    At = Matrix()
+
+    # Forms of the ksgs equation
+    p, q = TrialFunction(CG1), TestFunction(CG1)
+    Sij = sym(grad(u_))
+    At_form = (dt_ * inner(dot(u_, 0.5 * grad(p)), q) * dx
+               + inner((dt_ * Ce * sqrt(ksgs) / delta) * 0.5 * p, q) * dx
+               + inner(dt_ * Ck * sqrt(ksgs) * delta * grad(0.5 * p), grad(q)) * dx)
+    bt_form = dt_ * 2 * Ck * delta * sqrt(ksgs) * inner(Sij, grad(u_)) * q * dx
+    At = assemble(At_form)
     bt = Vector(nut_.vector())
-    ksgs_sol = KrylovSolver("bicgstab", "additive_schwarz")
-    #ksgs_sol.parameters["preconditioner"]["structure"] = "same_nonzero_pattern"
+
+    # The operator is set once, such that the preconditioner reuses the
+    # symbolic setup for the unchanged sparsity pattern
+    ksgs_sol = PETScKrylovSolver("bicgstab", PETScPreconditioner("additive_schwarz"))
+    ksgs_sol.set_operator(At)
     ksgs_sol.parameters["error_on_nonconvergence"] = False
     ksgs_sol.parameters["monitor_convergence"] = False
     ksgs_sol.parameters["report"] = False
-    del NS_namespace
+    del NS_namespace, p, q
     return locals()
 
 
-def les_update(nut_, nut_form, A_mass, At, u_, dt, bc_ksgs, bt, ksgs_sol,
-               KineticEnergySGS, CG1, ksgs, delta, **NS_namespace):
+def les_update(nut_, At_form, bt_form, A_mass, At, dt, dt_, Ck, Ce, bc_ksgs,
+               bt, ksgs_sol, KineticEnergySGS, ksgs, matvec_axpy, **NS_namespace):
 
-    p, q = TrialFunction(CG1), TestFunction(CG1)
-
-    Ck = KineticEnergySGS["Ck"]
-    Ce = KineticEnergySGS["Ce"]
-
-    Sij = sym(grad(u_))
-    assemble((dt * inner(dot(u_, 0.5 * grad(p)), q) * dx
-             + inner((dt * Ce * sqrt(ksgs) / delta) * 0.5 * p, q) * dx
-             + inner(dt * Ck * sqrt(ksgs) * delta * grad(0.5 * p), grad(q)) * dx),
-             tensor=At)
+    dt_.assign(dt)
+    Ck.assign(KineticEnergySGS["Ck"])
+    Ce.assign(KineticEnergySGS["Ce"])
 
-    assemble((dt * 2 * Ck * delta * sqrt(ksgs) *
-             inner(Sij, grad(u_)) * q * dx), tensor=bt)
-    bt.axpy(1.0, A_mass * ksgs.vector())
-    bt.axpy(-1.0, At * ksgs.vector())
+    assemble(At_form, tensor=At)
+    assemble(bt_form, tensor=bt)
+    matvec_axpy(1.0, A_mass, ksgs.vector(), bt)
+    matvec_axpy(-1.0, At, ksgs.vector(), bt)
     At.axpy(1.0, A_mass, True)
 
     # Solve for ksgs
     bc_ksgs.apply(At, bt)
-    ksgs_sol.solve(At, ksgs.vector(), bt)
-    ksgs.vector().set_local(ksgs.vector().array().clip(min=1e-7))
+    ksgs_sol.solve(ksgs.vector(), bt)
+    np.clip(local_array(ksgs), 1e-7, None, out=local_array(ksgs))
     ksgs.vector().apply("insert")
 
     # Update nut_
@@ -6,7 +6,7 @@ __license__ = 'GNU Lesser GPL version 3 or any later version'
 from dolfin import (Function, assemble, TestFunction, dx, solve, Constant,
     MeshFunction, DirichletBC)
 from .DynamicModules import (tophatfilter, lagrange_average, compute_Lij,
-    compute_Mij, compute_Qij, compute_Nij)
+    compute_Mij, compute_Qij, compute_Nij, stacked_functions, local_array)
 from . import DynamicLagrangian
 import numpy as np
 
@@ -14,7 +14,8 @@ __all__ = ['les_setup', 'les_update']
 
 
 def les_setup(u_, mesh, dt, krylov_solvers, V, assemble_matrix, CG1Function, nut_krylov_solver,
-              bcs, **NS_namespace):
+              bcs, symmetric_storage, as_symmetric_storage, DynamicSmagorinsky,
+              Solver_cache, **NS_namespace):
     """
     Set up for solving the Germano Dynamic LES model applying
     scale dependent Lagrangian Averaging.
@@ -29,22 +30,26 @@ def les_setup(u_, mesh, dt, krylov_solvers, V, assemble_matrix, CG1Function, nut
     JNN = Function(dyn_dict["CG1"])
     JNN.vector()[:] += 1.
 
-    dim = dyn_dict["dim"]
+    tensdim = dyn_dict["tensdim"]
     CG1 = dyn_dict["CG1"]
-    Qij = [Function(CG1) for i in range(dim * dim)]
-    Nij = [Function(CG1) for i in range(dim * dim)]
+    Qij, Qij_array = stacked_functions(CG1, tensdim)
+    Nij, Nij_array = stacked_functions(CG1, tensdim)
 
     # Update and return dict
-    dyn_dict.update(JQN=JQN, JNN=JNN, Qij=Qij, Nij=Nij)
+    dyn_dict.update(JQN=JQN, JNN=JNN, Qij=Qij, Nij=Nij, Qij_array=Qij_array,
+                    Nij_array=Nij_array)
 
     return dyn_dict
 
 
 def les_update(u_ab, nut_, nut_form, dt, CG1, tstep,
                DynamicSmagorinsky, Cs, u_CG1, u_filtered, Lij, Mij,
-               JLM, JMM, dim, tensdim, G_matr, G_under, ll,
+               JLM, JMM, dim, tensdim, G_matr, G_under, u_interp,
                dummy, uiuj_pairs, Sijmats, Sijcomps, Sijfcomps, delta_CG1_sq,
-               Qij, Nij, JNN, JQN, **NS_namespace):
+               Qij, Nij, JNN, JQN, u_CG1_array, u_filtered_array, Lij_array,
+               Mij_array, Sij_array, Sijf_array, Qij_array, Nij_array,
+               strain_solver, G_solver, solve_multiple, G_filter, filter_work,
+               work_vectors, **NS_namespace):
 
     # Check if Cs is to be computed, if not update nut_ and break
     if tstep % DynamicSmagorinsky["Cs_comp_step"] != 0:
@@ -56,19 +61,19 @@ def les_update(u_ab, nut_, nut_form, dt, CG1, tstep,
     # All velocity components must be interpolated to CG1 then filtered
     for i in range(dim):
         # Interpolate to CG1
-        ll.interpolate(u_CG1[i], u_ab[i])
+        u_interp.mult(u_ab[i].vector(), u_CG1[i].vector())
         # Filter
         tophatfilter(unfiltered=u_CG1[i], filtered=u_filtered[i], **vars())
 
     # Compute Lij from dynamic modules function
-    compute_Lij(u=u_CG1, uf=u_filtered, **vars())
+    compute_Lij(u=u_CG1_array, uf=u_filtered_array, **vars())
 
     # Compute Mij from dynamic modules function
     alpha = 2.
     magS = compute_Mij(alphaval=alpha, u_nf=u_CG1, u_f=u_filtered, **vars())
 
     # Lagrange average Lij and Mij
-    lagrange_average(J1=JLM, J2=JMM, Aij=Lij, Bij=Mij, **vars())
+    lagrange_average(J1=JLM, J2=JMM, Aij=Lij_array, Bij=Mij_array, **vars())
 
     # Now u needs to be filtered once more
     for i in range(dim):
@@ -77,24 +82,24 @@ def les_update(u_ab, nut_, nut_form, dt, CG1, tstep,
                      weight=1, **vars())
 
     # Compute Qij from dynamic modules function
-    compute_Qij(uf=u_filtered, **vars())
+    compute_Qij(uf=u_filtered_array, **vars())
 
     # Compute Nij from dynamic modules function
     alpha = 4.
     compute_Nij(alphaval=alpha, u_f=u_filtered, **vars())
 
     # Lagrange average Qij and Nij
-    lagrange_average(J1=JQN, J2=JNN, Aij=Qij, Bij=Nij, **vars())
+    lagrange_average(J1=JQN, J2=JNN, Aij=Qij_array, Bij=Nij_array, **vars())
 
     # UPDATE Cs**2 = (JLM*JMM)/beta, beta = JQN/JNN
-    beta = (JQN.vector().array() / JNN.vector().array()).clip(min=0.5)
-    Cs.vector().set_local((np.sqrt((JLM.vector().array() / JMM.vector().array()) / beta)))
+    beta = (local_array(JQN) / local_array(JNN)).clip(min=0.5)
+    np.sqrt((local_array(JLM) / local_array(JMM)) / beta, out=local_array(Cs))
     Cs.vector().apply("insert")
     tophatfilter(unfiltered=Cs, filtered=Cs, N=2, weight=1, **vars())
-    Cs.vector().set_local(Cs.vector().array().clip(max=0.3))
+    np.clip(local_array(Cs), None, 0.3, out=local_array(Cs))
     Cs.vector().apply("insert")
 
     # Update nut_
-    nut_.vector().set_local(Cs.vector().array()**2 *
-                            delta_CG1_sq.vector().array() * magS)
+    np.multiply(local_array(Cs)**2 * local_array(delta_CG1_sq), magS,
+                out=local_array(nut_))
     nut_.vector().apply("insert")
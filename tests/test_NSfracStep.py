@@ -2,6 +2,8 @@ import pytest
 import subprocess
 import re
 import math
+import json
+import textwrap
 
 number = "([0-9]+.[0-9]+e[+-][0-9]+)"
 
@@ -39,6 +41,32 @@ def test_spatial_rate_of_convergence(num_p, solver):
     assert round(p_conv[-1], 1) == 4.0
 
 
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "BDFPC_Fast"])
+def test_spatial_rate_of_convergence_lumping(solver):
+    # Velocity update with HRZ lumped mass matrix for P2 velocity should
+    # converge at the same rate as with the consistent mass matrix
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "compute_error=1e8 T={} dt={} Nx={} Ny={} velocity_degree=2 "
+           "velocity_update_solver='{{\"method\": \"{}\"}}'")
+    dt = 0.0001
+    T = dt*4
+    N = [8, 12, 16, 20]
+    dx = [math.sqrt(2*(1./n)**2) for n in N]
+    u_conv = []
+    for method in ("default", "lumping"):
+        u0_err = []
+        for n in N:
+            d = subprocess.check_output(cmd.format(solver, T, dt, n, n, method),
+                                        shell=True)
+            match = re.search("Final Error: u0=" + number + " u1="
+                              + number + " p=" + number, str(d))
+            u0_err.append(eval(match.groups()[0]))
+
+        u_conv.append(math.log(u0_err[-2] / u0_err[-1]) / math.log(dx[-2] / dx[-1]))
+
+    assert abs(u_conv[0] - u_conv[1]) < 0.1
+
+
 # FIXME: Should add a working temporal convergence as well
 """
 @pytest.mark.parametrize("solver", ["IPCS"])
@@ -120,6 +148,31 @@ def test_TaylorGreen2D(solver, num_p):
             assert abs(eval(e1) - eval(e2)) < 1e-8
 
 
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+def test_adaptive_timestep(solver):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.1 dt=0.005 Nx=40 Ny=40 "
+           "adaptive_timestep='{{\"active\": True, \"CFL\": 0.2}}'")
+    d = str(subprocess.check_output(cmd.format(solver), shell=True))
+    match = re.search("Final Error: u0=" + number +
+                      " u1=" + number + " p=" + number, d)
+    for e in match.groups()[:2]:
+        assert eval(e) < 1e-3
+
+    # The timestep must have been changed
+    match = re.search(r"\(([0-9]+) changes of dt", d)
+    assert int(match.groups()[0]) > 0
+
+    # The saving is estimated against T/dt = 20 steps with the initial dt
+    assert "(20 timesteps with fixed dt" in d
+
+    # Solvers with a constant timestep are rejected when parsing parameters
+    p = subprocess.run(cmd.format("IPCS"), shell=True, stdout=subprocess.PIPE,
+                       stderr=subprocess.STDOUT)
+    assert p.returncode != 0
+    assert "adaptive_timestep is not implemented" in str(p.stdout)
+
+
 @pytest.mark.parametrize("num_p", [1, 2])
 def test_DrivenCavity(num_p):
     cmd = ("mpirun -np {} oasis NSfracStep problem=DrivenCavity T=0.01 "
@@ -134,6 +187,460 @@ def test_DrivenCavity(num_p):
     err2 = match2.groups()
     assert abs(eval(err[0]) - eval(err2[0])) < 1e-9
 
+
+def test_step_plan():
+    cmd = ("mpirun -np 1 oasis NSfracStep problem=DrivenCavity T=0.01 "
+           "Nx=20 Ny=20 plot_interval=10000 solver=IPCS_ABCN testing=True "
+           "use_step_plan={}")
+    d = subprocess.check_output(cmd.format(True), shell=True)
+    match = re.search("Velocity norm = " + number, str(d))
+    err = match.groups()
+
+    # Calling with the complete namespace must give the same result
+    d2 = subprocess.check_output(cmd.format(False), shell=True)
+    match2 = re.search("Velocity norm = " + number, str(d2))
+    err2 = match2.groups()
+    assert eval(err[0]) == eval(err2[0])
+
+
+@pytest.mark.parametrize("solve_multiple_rhs", [False, True])
+def test_telemetry(tmpdir, solve_multiple_rhs):
+    # DrivenCavity solves for two velocity components and two scalars
+    cmd = ("mpirun -np 1 oasis NSfracStep problem=DrivenCavity T=0.01 "
+           "Nx=20 Ny=20 plot_interval=10000 solver=IPCS_ABCN testing=True "
+           "record_telemetry=True solve_multiple_rhs={} folder={}")
+    subprocess.check_output(cmd.format(solve_multiple_rhs, tmpdir), shell=True)
+    with open(str(tmpdir.join("data", "1", "telemetry.jsonl"))) as f:
+        records = [json.loads(line) for line in f]
+
+    assert len(records) > 0
+    # Every solve is counted, also solves identical to the previous one
+    for record in records:
+        n = record["inner_iterations"]
+        solvers = record["solvers"]
+        assert solvers["Tentative"]["solves"] == 2 * n
+        assert solvers["Pressure"]["solves"] == n
+        assert solvers["Scalar"]["solves"] == 2
+        assert "velocity_tentative_solve:u0" in record["wall"]
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+def test_solve_multiple_rhs(solver):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 Nx=40 Ny=40 solve_multiple_rhs={}")
+    errors = []
+    solves = []
+    for multiple in (False, True):
+        d = subprocess.check_output(cmd.format(solver, multiple), shell=True)
+        match = re.search("Final Error: u0=" + number +
+                          " u1=" + number + " p=" + number, str(d))
+        errors.append(match.groups())
+        solves.append(re.search(r"Solver Tentative: ([0-9]+) solves", str(d)).groups()[0])
+
+    for e1, e2 in zip(*errors):
+        assert abs(eval(e1) - eval(e2)) < 1e-9
+
+    # Block solves are counted once for each right hand side
+    assert solves[0] == solves[1]
+
+
+def test_matrix_cache(tmpdir):
+    cmd = ("mpirun -np 1 oasis NSfracStep problem=DrivenCavity T=0.01 "
+           "Nx=20 Ny=20 plot_interval=10000 solver=IPCS_ABCN testing=True "
+           "matrix_cache_folder={}".format(tmpdir))
+    norms = []
+    for i in range(2):
+        d = subprocess.check_output(cmd, shell=True)
+        match = re.search("Velocity norm = " + number, str(d))
+        norms.append(eval(match.groups()[0]))
+
+    # Second run loads the matrices stored by the first
+    assert len(tmpdir.listdir(lambda f: f.ext == ".dat")) > 0
+    assert abs(norms[0] - norms[1]) < 1e-12
+
+
+@pytest.mark.parametrize("as_vector", [False, True])
+def test_async_output(tmpdir, as_vector):
+    h5py = pytest.importorskip("h5py")
+    cmd = ("mpirun -np 1 oasis NSfracStep problem=DrivenCavity T=0.01 "
+           "Nx=20 Ny=20 plot_interval=10000 solver=IPCS_ABCN testing=True "
+           "save_step=1 checkpoint=10000 output_timeseries_as_vector={} "
+           "folder={} async_output={}")
+    for async_output in (False, True):
+        d = subprocess.check_output(cmd.format(
+            as_vector, tmpdir.join(str(async_output)), async_output), shell=True)
+        assert ("writer processes" in str(d)) == async_output
+
+    # The writer processes must write the same files as a synchronous run
+    sync = tmpdir.join("False", "data", "1", "Timeseries")
+    files = sorted(f.basename for f in sync.listdir(lambda f: f.ext == ".h5"))
+    assert len(files) > 0
+    for name in files:
+        with h5py.File(str(sync.join(name)), "r") as f0, \
+                h5py.File(str(tmpdir.join("True", "data", "1", "Timeseries", name)), "r") as f1:
+            keys = sorted(k for k in f0["VisualisationVector"])
+            assert keys == sorted(k for k in f1["VisualisationVector"])
+            for k in keys:
+                assert abs(f0["VisualisationVector"][k][()] -
+                           f1["VisualisationVector"][k][()]).max() < 1e-14
+
+
+def test_cache_memory_budget():
+    cmd = ("mpirun -np 1 oasis NSfracStep problem=DrivenCavity T=0.01 "
+           "Nx=20 Ny=20 plot_interval=10000 solver=IPCS_ABCN testing=True "
+           "report_cache=True")
+    d = subprocess.check_output(cmd, shell=True)
+    norm = re.search("Velocity norm = " + number, str(d)).groups()[0]
+    assert "A_cache: " in str(d)
+
+    # Evicting everything that may be rebuilt must not change the solution
+    d2 = subprocess.check_output(cmd + " cache_memory_budget=0", shell=True)
+    norm2 = re.search("Velocity norm = " + number, str(d2)).groups()[0]
+    assert eval(norm) == eval(norm2)
+
+
+def test_report_memory():
+    cmd = ("mpirun -np 1 oasis NSfracStep problem=DrivenCavity T=0.01 "
+           "Nx=20 Ny=20 plot_interval=10000 solver=IPCS_ABCN testing=True "
+           "report_memory=True")
+    d = str(subprocess.check_output(cmd, shell=True))
+    for phase in ("mesh", "function spaces", "LES setup", "preassembly", "time loop"):
+        assert phase in d
+    match = re.search("PETSc matrices +([0-9]+.[0-9]+) MB", d)
+    assert float(match.groups()[0]) > 0
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+@pytest.mark.parametrize("method", ["extrapolation", "projection"])
+def test_initial_guess(solver, method):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 Nx=40 Ny=40")
+    guess = " pressure_initial_guess={0} velocity_initial_guess={0}".format(method)
+    errors = []
+    for c in (cmd, cmd + guess):
+        d = subprocess.check_output(c.format(solver), shell=True)
+        match = re.search("Final Error: u0=" + number +
+                          " u1=" + number + " p=" + number, str(d))
+        errors.append(match.groups())
+
+    assert "Krylov iterations" in str(d)
+    for e1, e2 in zip(*errors):
+        assert abs(eval(e1) - eval(e2)) < 1e-6
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE"])
+def test_initial_guess_solve_multiple_rhs(solver):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 Nx=40 Ny=40 velocity_initial_guess=projection "
+           "solve_multiple_rhs=True".format(solver))
+    d = str(subprocess.check_output(cmd, shell=True))
+    # The solutions of all components are recorded in the history
+    for ui in ("u0", "u1"):
+        match = re.search("Initial guess " + ui + r" projection \(k=[0-9]+\): ([0-9]+) solves", d)
+        assert int(match.groups()[0]) > 0
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+def test_pressure_preconditioner_reuse(solver):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 dt=0.001 Nx=20 Ny=20".format(solver))
+    d = str(subprocess.check_output(cmd, shell=True))
+    match = re.search(r"Solver Pressure: ([0-9]+) solves in [0-9.]+ s, "
+                      r"([0-9]+) preconditioner setups", d)
+    solves, setups = map(int, match.groups())
+    assert solves > 1
+    assert setups == 1
+
+    # The velocity preconditioner is rebuilt once per timestep (refresh=1),
+    # not for each component
+    match = re.search(r"Solver Tentative: ([0-9]+) solves in [0-9.]+ s, "
+                      r"([0-9]+) preconditioner setups", d)
+    solves, setups = map(int, match.groups())
+    assert solves >= 2 * 10
+    assert setups == 10
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+def test_fused_assembly(solver):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 Nx=40 Ny=40 fused_assembly={}")
+    errors = []
+    for fused in (False, True):
+        d = subprocess.check_output(cmd.format(solver, fused), shell=True)
+        match = re.search("Final Error: u0=" + number +
+                          " u1=" + number + " p=" + number, str(d))
+        errors.append(match.groups())
+
+    for e1, e2 in zip(*errors):
+        assert abs(eval(e1) - eval(e2)) < 1e-9
+
+
+def test_combine_matrices_patterns():
+    dolfin = pytest.importorskip("dolfin")
+    PETSc = pytest.importorskip("petsc4py.PETSc")
+    from oasis.common import combine_matrices
+
+    def matrix(indptr, indices, values):
+        mat = PETSc.Mat().createAIJ((2, 2), csr=(indptr, indices, values),
+                                    comm=PETSc.COMM_SELF)
+        return dolfin.PETScMatrix(mat)
+
+    # Same number of nonzeros, different patterns
+    A = matrix([0, 1, 2], [0, 1], [1., 2.])
+    X = matrix([0, 1, 2], [1, 0], [3., 4.])
+    Y = matrix([0, 1, 2], [0, 1], [5., 6.])
+    combine_matrices(A, [(2., A), (1., X), (1., Y)])
+    assert (A.array() == [[7., 3.], [4., 10.]]).all()
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+def test_fused_assembly_scalars(solver):
+    # DrivenCavity solves for two scalars
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=DrivenCavity "
+           "T=0.01 Nx=20 Ny=20 plot_interval=10000 testing=True fused_assembly={}")
+    norms = []
+    for fused in (False, True):
+        d = subprocess.check_output(cmd.format(solver, fused), shell=True)
+        norms.append(re.search("Velocity norm = " + number, str(d)).groups()[0])
+
+    assert abs(eval(norms[0]) - eval(norms[1])) < 1e-9
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+def test_batched_matvec(solver):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 Nx=40 Ny=40 batched_matvec={}")
+    errors = []
+    for batched in (False, True):
+        d = subprocess.check_output(cmd.format(solver, batched), shell=True)
+        match = re.search("Final Error: u0=" + number +
+                          " u1=" + number + " p=" + number, str(d))
+        errors.append(match.groups())
+
+    for e1, e2 in zip(*errors):
+        assert abs(eval(e1) - eval(e2)) < 1e-9
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+def test_precomputed_convection(solver):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 Nx=40 Ny=40 precomputed_convection={}")
+    errors = []
+    for precomputed in (False, True):
+        d = subprocess.check_output(cmd.format(solver, precomputed), shell=True)
+        match = re.search("Final Error: u0=" + number +
+                          " u1=" + number + " p=" + number, str(d))
+        errors.append(match.groups())
+
+    for e1, e2 in zip(*errors):
+        assert abs(eval(e1) - eval(e2)) < 1e-9
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE"])
+def test_allocations(tmpdir, solver):
+    # Vectors and matrices (work vectors, dense blocks, solution histories,
+    # LES right hand sides) are only allocated in the first timesteps, such
+    # that the number of allocations is independent of the number of steps
+    cmd = ("mpirun -np 1 oasis NSfracStep problem=DrivenCavity T={} "
+           "Nx=20 Ny=20 plot_interval=10000 solver={} testing=True "
+           "solve_multiple_rhs=True pressure_initial_guess=projection "
+           "les_model=DynamicLagrangian DynamicSmagorinsky='{{\"Cs_comp_step\": 1, "
+           "\"strain_solver\": \"cached\"}}' record_telemetry=True folder={}")
+    allocations = []
+    for T in (0.01, 0.02):
+        folder = tmpdir.join(str(T))
+        subprocess.check_output(cmd.format(T, solver, folder), shell=True)
+        with open(str(folder.join("data", "1", "telemetry.jsonl"))) as f:
+            records = [json.loads(line) for line in f]
+        allocations.append([sum(v["max"] for k, v in r.get("counters", {}).items()
+                                if k.endswith("_allocations")) for r in records])
+
+    assert sum(allocations[0]) > 0
+    assert sum(allocations[0]) == sum(allocations[1])
+    assert allocations[1][-1] == 0
+
+
+@pytest.mark.parametrize("degree", [1, 2])
+def test_divergence_from_gradient_matrices(degree):
+    dolfin = pytest.importorskip("dolfin")
+    from oasis.common import DivFunction
+    mesh = dolfin.UnitSquareMesh(10, 10)
+    V = dolfin.FunctionSpace(mesh, 'CG', degree)
+    Q = dolfin.FunctionSpace(mesh, 'CG', 1)
+    u_ = dolfin.as_vector([dolfin.interpolate(dolfin.Expression(e, degree=2), V)
+                           for e in ("sin(x[0])*x[1]", "cos(x[1])+x[0]")])
+    q = dolfin.TestFunction(Q)
+    exact = dolfin.assemble(dolfin.div(u_) * q * dolfin.dx)
+    for transposed in (False, True):
+        divu = DivFunction(u_, Q, method=dict(transposed_gradient=transposed))
+        divu.assemble_rhs()
+        divu.rhs.axpy(-1., exact)
+        assert divu.rhs.norm('linf') < 1e-12
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+@pytest.mark.parametrize("num_p", [1, 2])
+def test_time_level_ring(solver, num_p):
+    cmd = ("mpirun -np {} oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 Nx=40 Ny=40 time_level_ring={}")
+    errors = []
+    for ring in (False, True):
+        d = subprocess.check_output(cmd.format(num_p, solver, ring), shell=True)
+        match = re.search("Final Error: u0=" + number +
+                          " u1=" + number + " p=" + number, str(d))
+        errors.append(match.groups())
+
+    for e1, e2 in zip(*errors):
+        assert abs(eval(e1) - eval(e2)) < 1e-12
+
+
+@pytest.mark.parametrize("solver", ["IPCS_ABCN", "IPCS_ABE", "BDFPC_Fast"])
+def test_symmetric_storage(solver):
+    # Pressure Laplacian of P1 differs from K of P2, and is stored as SBAIJ.
+    # TaylorGreen2D has no pressure bcs, so the null space of the SBAIJ
+    # matrix is used to orthogonalize the pressure rhs.
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.01 Nx=20 Ny=20 velocity_degree=2 symmetric_storage={} "
+           "pressure_krylov_solver='{{\"solver_type\": \"cg\", "
+           "\"preconditioner_type\": \"jacobi\"}}'")
+    errors = []
+    for symmetric in (False, True):
+        d = subprocess.check_output(cmd.format(solver, symmetric), shell=True)
+        assert ("stored in symmetric storage" in str(d)) == symmetric
+        match = re.search("Final Error: u0=" + number +
+                          " u1=" + number + " p=" + number, str(d))
+        errors.append(match.groups())
+
+    for e1, e2 in zip(*errors):
+        assert abs(eval(e1) - eval(e2)) < 1e-7
+
+
+@pytest.mark.parametrize("solver", ["IPCS", "Chorin", "BDFPC"])
+def test_split_forms(solver):
+    cmd = ("mpirun -np 1 oasis NSfracStep solver={} problem=TaylorGreen2D "
+           "T=0.005 Nx=20 Ny=20 split_forms={}")
+    errors = []
+    for split in (False, True):
+        d = subprocess.check_output(cmd.format(solver, split), shell=True)
+        match = re.search("Final Error: u0=" + number +
+                          " u1=" + number + " p=" + number, str(d))
+        errors.append(match.groups())
+
+    for e1, e2 in zip(*errors):
+        assert abs(eval(e1) - eval(e2)) < 1e-9
+
+
+@pytest.mark.parametrize("les_model", ["DynamicLagrangian", "ScaleDepDynamicLagrangian"])
+def test_les_strain_solver(les_model):
+    cmd = ("mpirun -np 1 oasis NSfracStep problem=DrivenCavity T=0.01 "
+           "Nx=20 Ny=20 plot_interval=10000 solver=IPCS_ABCN testing=True "
+           "les_model={} DynamicSmagorinsky='{{\"Cs_comp_step\": 1, "
+           "\"strain_solver\": \"{}\"}}'")
+    norms = []
+    for strain_solver in ("default", "cached"):
+        d = subprocess.check_output(cmd.format(les_model, strain_solver), shell=True)
+        match = re.search("Velocity norm = " + number, str(d))
+        norms.append(eval(match.groups()[0]))
+
+    assert abs(norms[0] - norms[1]) < 1e-6
+
+
+def test_kinetic_energy_sgs(tmpdir):
+    # ksgs of KineticEnergySGS, which creates its forms once in les_setup,
+    # must equal ksgs of the original update that built the forms and the
+    # solver in every timestep
+    script = tmpdir.join("ksgs.py")
+    script.write(textwrap.dedent("""
+        from dolfin import *
+        from oasis.common import assemble_matrix, CG1Function, matvec_axpy
+        from oasis.solvers.NSfracStep.LES import KineticEnergySGS as model
+
+        mesh = UnitSquareMesh(16, 16)
+        V = FunctionSpace(mesh, "CG", 2)
+        u_ = as_vector([interpolate(Expression(e, degree=2), V) for e in
+                        ("sin(pi*x[0])*sin(pi*x[1])", "x[0]*(1-x[0])*cos(pi*x[1])")])
+        Ck, Ce, dt = 0.08, 1.05, 0.01
+        ns = dict(u_=u_, mesh=mesh, dt=dt, KineticEnergySGS=dict(Ck=Ck, Ce=Ce),
+                  assemble_matrix=assemble_matrix, CG1Function=CG1Function,
+                  matvec_axpy=matvec_axpy,
+                  bcs=dict(u0=[DirichletBC(V, 0, "on_boundary")]),
+                  nut_krylov_solver=dict(method="WeightedAverage",
+                                         solver_type="cg",
+                                         preconditioner_type="jacobi"))
+        ns.update(model.les_setup(**ns))
+        ns["ksgs_sol"].parameters["relative_tolerance"] = 1e-12
+
+        # Original update
+        CG1, delta, A_mass = ns["CG1"], ns["delta"], ns["A_mass"]
+        ksgs = interpolate(Constant(1E-7), CG1)
+        At, bt = Matrix(), Vector(ns["bt"])
+        sol = KrylovSolver("bicgstab", "additive_schwarz")
+        sol.parameters["error_on_nonconvergence"] = False
+        sol.parameters["relative_tolerance"] = 1e-12
+        p, q = TrialFunction(CG1), TestFunction(CG1)
+        Sij = sym(grad(u_))
+        for step in range(5):
+            model.les_update(**ns)
+            assemble((dt * inner(dot(u_, 0.5 * grad(p)), q) * dx
+                     + inner((dt * Ce * sqrt(ksgs) / delta) * 0.5 * p, q) * dx
+                     + inner(dt * Ck * sqrt(ksgs) * delta * grad(0.5 * p), grad(q)) * dx),
+                     tensor=At)
+            assemble((dt * 2 * Ck * delta * sqrt(ksgs) *
+                     inner(Sij, grad(u_)) * q * dx), tensor=bt)
+            bt.axpy(1.0, A_mass * ksgs.vector())
+            bt.axpy(-1.0, At * ksgs.vector())
+            At.axpy(1.0, A_mass, True)
+            ns["bc_ksgs"].apply(At, bt)
+            sol.solve(At, ksgs.vector(), bt)
+            ksgs.vector().set_local(ksgs.vector().get_local().clip(min=1e-7))
+            ksgs.vector().apply("insert")
+
+        print("ksgs norms: {:2.6e} {:2.6e}".format(
+            ns["ksgs"].vector().norm("l2"), ksgs.vector().norm("l2")))
+        """))
+    d = subprocess.check_output("mpirun -np 1 python {}".format(script), shell=True)
+    match = re.search("ksgs norms: " + number + " " + number, str(d))
+    new, original = [eval(n) for n in match.groups()]
+
+    assert abs(new - original) < 1e-8 * original
+
+
+@pytest.mark.parametrize("degree", [1, 2, 3])
+def test_interpolation_matrix(degree):
+    dolfin = pytest.importorskip("dolfin")
+    from oasis.solvers.NSfracStep.LES.DynamicModules import interpolation_matrix
+    mesh = dolfin.UnitCubeMesh(4, 4, 4)
+    V = dolfin.FunctionSpace(mesh, 'CG', degree)
+    CG1 = dolfin.FunctionSpace(mesh, 'CG', 1)
+    u = dolfin.interpolate(dolfin.Expression("sin(x[0])*x[1]+x[2]", degree=3), V)
+    exact = dolfin.interpolate(u, CG1)
+    u_CG1 = dolfin.Function(CG1)
+    interpolation_matrix(V, CG1).mult(u.vector(), u_CG1.vector())
+    u_CG1.vector().axpy(-1., exact.vector())
+    assert u_CG1.vector().norm('linf') < 1e-12
+
+
+@pytest.mark.parametrize("method", ["WeightedAverage", "vertex"])
+def test_CG1Function_averaging(method):
+    dolfin = pytest.importorskip("dolfin")
+    from oasis.common import CG1Function
+    mesh = dolfin.UnitSquareMesh(8, 8)
+    CG1 = dolfin.FunctionSpace(mesh, 'CG', 1)
+    c = dolfin.Constant(2.5)
+    f = CG1Function(c, mesh, method=dict(method=method))
+    f()
+    assert abs(f.vector().max() - 2.5) < 1e-12
+    assert abs(f.vector().min() - 2.5) < 1e-12
+
+    # Vertex evaluation reproduces CG1 Functions exactly
+    if method == "vertex":
+        u = dolfin.interpolate(dolfin.Expression("x[0]*x[1]", degree=2), CG1)
+        g = CG1Function(u, mesh, method=dict(method=method))
+        g()
+        g.vector().axpy(-1., u.vector())
+        assert g.vector().norm('linf') < 1e-12
+
+
 if __name__ == '__main__':
     #test_DrivenCavity()
     #test_TaylorGreen2D()